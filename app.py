@@ -1,4 +1,4 @@
-from flask import Flask, render_template
+from flask import Flask, render_template, request, Response
 import json
 import plotly
 import plotly.graph_objs as go
@@ -9,130 +9,395 @@ from datetime import datetime
 from plotly.subplots import make_subplots
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler
-import time
 from datetime import datetime, timedelta
 import asyncio
+import os
+import queue
+import re
+import threading
+from collections import OrderedDict
 app = Flask(__name__)
 
+# 数据文件路径，可以是 JSON 数组或 NDJSON（每行一条记录）
+VEGA_FILE = os.environ.get('VEGA_FILE', 'New_Vega_1.json')
+VOLUME_FILE = os.environ.get('VOLUME_FILE', 'rec.json')
+# 监视的文件（逗号分隔，预设为上面两个数据文件）及去抖动时间（秒）：
+# 连续的写入只在最后一次写入后 WATCH_DEBOUNCE 秒重新计算一次
+WATCH_PATHS = os.environ.get('WATCH_PATHS', f'{VEGA_FILE},{VOLUME_FILE}')
+WATCH_DEBOUNCE = float(os.environ.get('WATCH_DEBOUNCE', '0.05'))
+# 没有指定 strikes 参数时显示的行权价（逗号分隔）
+DEFAULT_STRIKES = os.environ.get('DEFAULT_STRIKES', '16500')
+# Time 字段的格式（日在前）；不符合时退回逐个推断格式
+TIME_FORMAT = os.environ.get('FEED_TIME_FORMAT', '%d/%m/%Y %H:%M:%S')
+# 缓存上限（MB），按估算的内存占用淘汰最久未使用的条目
+CACHE_MAX_BYTES = int(os.environ.get('CHART_CACHE_MB', '64')) * 1024 * 1024
+
+
+class DataCache:
+    """进程内 LRU 缓存，每个条目带有签名（文件路径、mtime、大小），签名不同视为失效"""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (signature, value, nbytes)
+        self.total = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, signature):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != signature:
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, signature, value, nbytes):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total -= old[2]
+            if nbytes > self.max_bytes:
+                return
+            self.entries[key] = (signature, value, nbytes)
+            self.total += nbytes
+            while self.total > self.max_bytes:
+                _, (_, _, evicted) = self.entries.popitem(last=False)
+                self.total -= evicted
+
+
+cache = DataCache(CACHE_MAX_BYTES)
+chart_lock = threading.Lock()
+
+
+def file_signature(path):
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+class FeedReader:
+    """
+    增量读取不断追加的数据文件，只解析上次读取位置之后的新记录
+
+    支持 JSON 数组（写入方每次追加或整体重写）和 NDJSON。parse 把一批记录转换为
+    以时间为索引的 DataFrame，按日期分块保存，读取某一天时只合并该天的块，刷新成本不随文件增长。
+    文件被截断或已读部分被改写时从头重新读取。
+    """
+
+    def __init__(self, path, parse):
+        self.path = path
+        self.parse = parse
+        self.decoder = json.JSONDecoder()
+        self.reset()
+
+    def reset(self):
+        self.offset = 0          # 已处理到的字节位置
+        self.tail = b''          # 已处理部分的最后一段内容，用于检测改写
+        self.is_array = None
+        self.count = 0
+        self.days = {}           # 日期 -> 该天的 DataFrame 块
+
+    def poll(self):
+        """读取并解析新增的记录，返回新增条数"""
+        with open(self.path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            if size < self.offset or not self._prefix_unchanged(file):
+                print(f"{self.path} 已被改写，重新读取")
+                self.reset()
+            file.seek(self.offset)
+            data = file.read()
+
+        if self.is_array is None:
+            head = data.lstrip()[:1]
+            if not head:
+                return 0
+            self.is_array = head == b'['
+        records, consumed = self._decode_array(data) if self.is_array else self._decode_lines(data)
+        records = [record for record in records if isinstance(record, dict)]
+        # 先解析，成功后才前移读取位置；解析出错时下次重新读取这批记录
+        frame = self.parse(records) if records else None
+        if consumed:
+            self.tail = (self.tail + data[:consumed])[-64:]
+            self.offset += consumed
+        if frame is not None:
+            for day, part in frame.groupby(frame.index.normalize(), sort=False):
+                self.days.setdefault(day, []).append(part)
+            self.count += len(frame)
+        return len(records)
+
+    def day(self, day):
+        """某一天的记录；没有记录时返回 None"""
+        chunks = self.days.get(pd.Timestamp(day))
+        if not chunks:
+            return None
+        if len(chunks) > 1:
+            chunks[:] = [pd.concat(chunks)]
+        return chunks[0]
+
+    def _prefix_unchanged(self, file):
+        if not self.tail:
+            return True
+        file.seek(self.offset - len(self.tail))
+        return file.read(len(self.tail)) == self.tail
+
+    def _decode_lines(self, data):
+        # 最后一行可能尚未写完，只处理到最后一个换行符；无法解析的完整行跳过
+        end = data.rfind(b'\n') + 1
+        records = []
+        for line in data[:end].splitlines():
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                print(f"{self.path} 有一行无法解析，已跳过: {line[:80]!r}")
+        return records, end
+
+    def _decode_array(self, data):
+        # 逐条解码数组元素；遇到结尾的 ']' 或未写完整的记录时停止，下次从该记录开始
+        text = data.decode('utf-8', errors='ignore')
+        records, pos, consumed = [], 0, 0
+        while True:
+            while pos < len(text) and text[pos] in ' \t\r\n,[':
+                pos += 1
+            if pos >= len(text) or text[pos] == ']':
+                break
+            try:
+                record, pos = self.decoder.raw_decode(text, pos)
+            except json.JSONDecodeError:
+                # 之后已有完整的记录（或数组已结束）时说明这条记录损坏，跳过；否则视为尚未写完
+                skip = self._next_element(text, pos)
+                if skip is None:
+                    break
+                print(f"{self.path} 有一条记录无法解析，已跳过: {text[pos:skip][:80]!r}")
+                pos = consumed = skip
+                continue
+            records.append(record)
+            consumed = pos
+        return records, len(text[:consumed].encode('utf-8'))
+
+    _ELEMENT_START = re.compile(r',\s*(?=\{)')
+
+    def _next_element(self, text, pos):
+        """返回 pos 之后下一条可解码记录的位置，数组已结束时返回 ']' 的位置；都没有时返回 None"""
+        for match in self._ELEMENT_START.finditer(text, pos):
+            try:
+                self.decoder.raw_decode(text, match.end())
+            except json.JSONDecodeError:
+                continue
+            return match.end()
+        end = text.rstrip().rfind(']')
+        if end > pos and text.rstrip().endswith(']'):
+            return end
+        return None
+
+
+def parse_times(values):
+    """无法解析的时间为 NaT，由调用方丢弃该行"""
+    try:
+        return pd.to_datetime(values, format=TIME_FORMAT)
+    except (ValueError, TypeError):
+        return pd.to_datetime(values, dayfirst=True, format='mixed', errors='coerce')
+
+
+def drop_bad_times(frame, name):
+    bad = frame.index.isna()
+    if bad.any():
+        print(f"{name} 有 {int(bad.sum())} 条记录的 Time 无法解析，已跳过")
+        frame = frame[~bad]
+    return frame
+
+
+def parse_vega_records(records):
+    """把一批 Vega 记录批量转换为宽表：时间索引，HSI_Index 及每个行权价一列"""
+    raw = pd.DataFrame.from_records(records, columns=['Time', 'HSI_Index', 'Strike', 'Vega'])
+    index = pd.DatetimeIndex(parse_times(raw['Time']), name='Time')
+    hsi = pd.to_numeric(raw['HSI_Index'].astype(str).str.replace(',', '', regex=False), errors='coerce')
+
+    # 行权价排列相同的行一起拆分 Vega 字符串（通常整个文件只有一种排列）
+    parts = []
+    for layout, rows in raw.groupby('Strike', sort=False).groups.items():
+        strikes = layout.split('|')
+        values = raw.loc[rows, 'Vega'].str.split('|', expand=True).iloc[:, :len(strikes)]
+        values.columns = strikes[:values.shape[1]]
+        parts.append(values.apply(pd.to_numeric, errors='coerce'))
+    vegas = pd.concat(parts).sort_index() if parts else pd.DataFrame(index=raw.index)
+
+    frame = pd.concat([hsi.rename('HSI_Index'), vegas], axis=1)
+    frame.index = index
+    return drop_bad_times(frame, 'Vega')
+
+
+def parse_volume_records(records):
+    raw = pd.DataFrame.from_records(records, columns=['Time', 'Volume'])
+    volumes = pd.to_numeric(raw['Volume'], errors='coerce').fillna(0).astype('int64')
+    frame = pd.DataFrame({'Volume': volumes.to_numpy()}, index=pd.DatetimeIndex(parse_times(raw['Time']), name='Time'))
+    return drop_bad_times(frame, 'Volume')
+
+
+vega_feed = FeedReader(VEGA_FILE, parse_vega_records)
+volume_feed = FeedReader(VOLUME_FILE, parse_volume_records)
+
+
+class ChartBroadcaster:
+    """记录已连接的 SSE 客户端，数据更新时通知每一个客户端"""
+
+    def __init__(self):
+        self.clients = set()
+        self.lock = threading.Lock()
+
+    def subscribe(self):
+        # 每个客户端最多保留一个未处理的通知，客户端较慢时多次更新合并为一次
+        updates = queue.Queue(maxsize=1)
+        with self.lock:
+            self.clients.add(updates)
+        return updates
+
+    def unsubscribe(self, updates):
+        with self.lock:
+            self.clients.discard(updates)
+
+    def publish(self):
+        with self.lock:
+            clients = list(self.clients)
+        for updates in clients:
+            try:
+                updates.put_nowait(True)
+            except queue.Full:
+                pass
+
+
+broadcaster = ChartBroadcaster()
+
 
 class FileChangeHandler(FileSystemEventHandler):
+    """数据文件变化时去抖动，重新计算一次图表后通知所有 SSE 客户端"""
+
+    def __init__(self, paths, debounce):
+        self.paths = {os.path.normcase(os.path.abspath(path)) for path in paths}
+        self.debounce = debounce
+        self.timer = None
+        self.lock = threading.Lock()
+
     def on_modified(self, event):
-        global selected_strikes  # 如果 selected_strikes 在函数外定义，需要声明为 global
-        if event.src_path == r"C:\Users\kbl\Desktop\WEB\New_Vega.json":  # 使用完整路径
-            print("File changed, reloading data and updating chart...")
+        if os.path.normcase(os.path.abspath(event.src_path)) in self.paths:
+            self.schedule_reload()
+
+    on_created = on_modified
+
+    def on_moved(self, event):
+        # 写入方先写临时文件再改名替换
+        if os.path.normcase(os.path.abspath(event.dest_path)) in self.paths:
+            self.schedule_reload()
+
+    def schedule_reload(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(self.debounce, self.reload)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def reload(self):
+        print("File changed, reloading data and updating chart...")
+        try:
             load_and_update_chart()  # 调用加载数据和更新图表的函数
+        except Exception as e:
+            print(f"更新图表失败: {e}")
+            return
+        broadcaster.publish()
 
-def start_monitoring(path):
-    event_handler = FileChangeHandler()
+def start_monitoring(paths=None, debounce=None):
+    """在后台线程监视数据文件，返回 Observer"""
+    paths = [path.strip() for path in (paths or WATCH_PATHS).split(',') if path.strip()]
+    event_handler = FileChangeHandler(paths, WATCH_DEBOUNCE if debounce is None else debounce)
     observer = Observer()
-    observer.schedule(event_handler, path=path, recursive=False)
+    observer.daemon = True
+    for folder in {os.path.dirname(os.path.abspath(path)) for path in paths}:
+        observer.schedule(event_handler, path=folder, recursive=False)
     observer.start()
-    try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        observer.stop()
-    observer.join()
+    print(f"Monitoring {', '.join(paths)}")
+    return observer
 
-def load_and_update_chart():
-    selected_strikes = ["16500"]
+def parse_strikes(value):
+    """把 "16000,16500,17000" 转换为行权价列表（去除空白及重复，保持顺序）"""
+    strikes = []
+    for strike in (value or DEFAULT_STRIKES).split(','):
+        strike = strike.strip()
+        if strike and strike not in strikes:
+            strikes.append(strike)
+    return strikes or parse_strikes(DEFAULT_STRIKES)
+
+def load_and_update_chart(selected_strikes=None):
+    selected_strikes = selected_strikes or parse_strikes(None)
     current_date = datetime.now()
 
-    # 加载 JSON 数据
-    with open('New_Vega_1.json', 'r') as file:
-        vega_data = json.load(file)
-    with open('rec.json', 'r') as file:
-        volume_data = json.load(file)
+    # 每组行权价各占一个缓存条目；两个文件及日期都没有变化时直接返回缓存的图表 JSON
+    key = ('figure', tuple(selected_strikes))
+    signature = (current_date.date(), file_signature(vega_feed.path), file_signature(volume_feed.path))
+    graph_json = cache.get(key, signature)
+    if graph_json is not None:
+        return graph_json
+    with chart_lock:
+        # 多个请求同时到达时只计算一次
+        graph_json = cache.get(key, signature)
+        if graph_json is None:
+            # 只解析文件中新增的记录
+            vega_feed.poll()
+            volume_feed.poll()
+            graph_json = build_chart(selected_strikes, current_date)
+            cache.put(key, signature, graph_json, len(graph_json))
+    return graph_json
+
+def build_chart(selected_strikes, current_date):
+    # 数据处理（记录已由 FeedReader 解析为宽表），只取当天的数据
+    vega_today = vega_feed.day(current_date.date())
+    volume_today = volume_feed.day(current_date.date())
+    volume_times = volume_today.index if volume_today is not None else []
+    volumes = volume_today['Volume'] if volume_today is not None else []
 
-    # 数据处理
-    times, vega_values, hsi_index, volume_times, volumes = [], {}, [], [], []
-    for strike in selected_strikes:
-        vega_values[strike] = []
-
-    for entry in vega_data:
-        time_entry = pd.to_datetime(entry['Time'], dayfirst=True)
-        if time_entry.date() == current_date.date():
-            times.append(time_entry)
-            hsi_index.append(float(entry['HSI_Index'].replace(',', '')))
-            for strike in selected_strikes:
-                strike_vega_values = dict(zip(entry['Strike'].split('|'), entry['Vega'].split('|')))
-                vega_values[strike].append(float(strike_vega_values.get(strike, 'nan')))
-
-    for entry in volume_data:
-        volume_time_entry = pd.to_datetime(entry['Time'], dayfirst=True)
-        if volume_time_entry.date() == current_date.date():
-            volume_times.append(volume_time_entry)
-            volumes.append(int(entry['Volume']))
-
-    # 创建 DataFrame
-    df = pd.DataFrame(list(zip(times, hsi_index, *vega_values.values())), columns=['Time', 'HSI_Index'] + selected_strikes)
-    df.set_index('Time', inplace=True)
-
-    # Vega 差分与信号标记
-    vega_diffs = df[selected_strikes].diff()
-    std_devs = vega_diffs.std()
+    # 创建 DataFrame（缺少的行权价为 NaN）
+    if vega_today is None:
+        df = pd.DataFrame(columns=['HSI_Index'] + selected_strikes, index=pd.DatetimeIndex([], name='Time'))
+    else:
+        df = vega_today.reindex(columns=['HSI_Index'] + selected_strikes)
+
+    # Vega 差分与信号标记：所有行权价在宽表上一次计算
     multiplier = 0.14
-    thresholds = {strike: {'buy': -multiplier * std_dev, 'sell': multiplier * std_dev} for strike, std_dev in std_devs.items()}
-    trades = []
-    for strike in selected_strikes:
-        df[f'{strike}_Vega_diff'] = df[strike].diff()
-        std_dev = df[f'{strike}_Vega_diff'].std()
-        threshold_buy = -multiplier * std_dev
-        threshold_sell = multiplier * std_dev
-
-        df[f'{strike}_buy_signal'] = (df[f'{strike}_Vega_diff'] < threshold_buy)
-        df[f'{strike}_sell_signal'] = (df[f'{strike}_Vega_diff'] > threshold_sell)
-
-        # 模拟交易逻辑（简化版）
-        # 注意：实际应用中需要更复杂的逻辑
-    # 标记买卖点
-    #buy_signals, sell_signals = {strike: [] for strike in selected_strikes}, {strike: [] for strike in selected_strikes}
-    #buy_signals_text, sell_signals_text = {strike: [] for strike in selected_strikes}, {strike: [] for strike in selected_strikes}
-
-    # 标记买卖点
-    buy_signals, sell_signals = {strike: [] for strike in selected_strikes}, {strike: [] for strike in selected_strikes}
-    buy_signals_text, sell_signals_text = {strike: [] for strike in selected_strikes}, {strike: [] for strike in selected_strikes}
-    all_signals = []
-
-    # 创建图表
-    fig = make_subplots(rows=2, cols=1, shared_xaxes=True, vertical_spacing=0.1, specs=[[{"secondary_y": True}], [{}]])
-    fig.add_trace(go.Scatter(x=df.index, y=df['HSI_Index'], mode='lines', name='HSI Index'), row=1, col=1, secondary_y=False)
-    for strike in selected_strikes:
-        for time, vega_diff in vega_diffs[strike].items():
-            if vega_diff < thresholds[strike]['buy']:
-                buy_signals[strike].append(time)
-                buy_signals_text[strike].append(f"Time: {time}<br>Vega: {df.loc[time, strike]}<br>HSI Index: {df.loc[time, 'HSI_Index']}")
-            elif vega_diff > thresholds[strike]['sell']:
-                sell_signals[strike].append(time)
-                sell_signals_text[strike].append(f"Time: {time}<br>Vega: {df.loc[time, strike]}<br>HSI Index: {df.loc[time, 'HSI_Index']}")
-                
-        for time, text in zip(buy_signals[strike], buy_signals_text[strike]):
-            all_signals.append({
-            "time": time,
-            "type": "BUY",
-            "details": text,
-            "Quanity": 1
-        })
-    # 处理卖出信号
-        for time, text in zip(sell_signals[strike], sell_signals_text[strike]):
-            all_signals.append({
-                "time": time,
-                "type": "SELL",
-                "details": text,
-                "Quanity": 1
-            })
-    all_signals.sort(key=lambda x: x['time'])
-    
+    vegas = df[selected_strikes]
+    vega_diffs = vegas.diff()
+    std_devs = vega_diffs.std()
+    buy_signals = vega_diffs.lt(-multiplier * std_devs, axis=1)
+    sell_signals = vega_diffs.gt(multiplier * std_devs, axis=1)
+
+    # 标记买卖点：每个信号一行（时间、类型、行权价、Vega、HSI），按时间排序
+    signal_frames = []
+    for signal_type, mask in (("BUY", buy_signals), ("SELL", sell_signals)):
+        hits = vegas.reset_index(drop=True).where(mask.to_numpy()).stack().dropna()
+        rows = hits.index.get_level_values(0)
+        signal_frames.append(pd.DataFrame({
+            "time": df.index[rows],
+            "type": signal_type,
+            "strike": hits.index.get_level_values(1),
+            "vega": hits.to_numpy(),
+            "hsi_index": df['HSI_Index'].to_numpy()[rows],
+            "Quanity": 1,
+        }))
+    all_signals = pd.concat(signal_frames).sort_values('time', kind='stable')
+
     # 转换成JSON格式
-    signals_json = json.dumps(all_signals, indent=4, default=str)
+    signals_json = all_signals.to_json(orient='records', date_format='iso', indent=4)
     # 写入到文件
     #with open('signals.json', 'w') as file:
         #file.write(signals_json)
 
+    # 创建图表：HSI、成交量，每个行权价一组 Vega / 买入 / 卖出
+    fig = make_subplots(rows=2, cols=1, shared_xaxes=True, vertical_spacing=0.1, specs=[[{"secondary_y": True}], [{}]])
+    fig.add_trace(go.Scatter(x=df.index, y=df['HSI_Index'], mode='lines', name='HSI Index'), row=1, col=1, secondary_y=False)
     fig.add_trace(go.Bar(x=volume_times, y=volumes, name='Volume'), row=2, col=1)
-    fig.add_trace(go.Scatter(x=df.index, y=df[strike], mode='lines', name=f'Vega {strike}'), row=1, col=1, secondary_y=True)
-    fig.add_trace(go.Scatter(x=df.index[df[f'{strike}_buy_signal']], y=df[strike][df[f'{strike}_buy_signal']], mode='markers', marker_symbol='triangle-up', marker_color='green', name=f'Buy {strike}'), row=1, col=1, secondary_y=True)
-    fig.add_trace(go.Scatter(x=df.index[df[f'{strike}_sell_signal']], y=df[strike][df[f'{strike}_sell_signal']], mode='markers', marker_symbol='triangle-down', marker_color='red', name=f'Sell {strike}'), row=1, col=1, secondary_y=True)
+    for strike in selected_strikes:
+        buy, sell = buy_signals[strike], sell_signals[strike]
+        fig.add_trace(go.Scatter(x=df.index, y=df[strike], mode='lines', name=f'Vega {strike}', legendgroup=strike), row=1, col=1, secondary_y=True)
+        fig.add_trace(go.Scatter(x=df.index[buy], y=df[strike][buy], mode='markers', marker_symbol='triangle-up', marker_color='green', name=f'Buy {strike}', legendgroup=strike), row=1, col=1, secondary_y=True)
+        fig.add_trace(go.Scatter(x=df.index[sell], y=df[strike][sell], mode='markers', marker_symbol='triangle-down', marker_color='red', name=f'Sell {strike}', legendgroup=strike), row=1, col=1, secondary_y=True)
     # 更新图表布局
     fig.update_layout(title='HSI Index and Vega Values with Volume', template="plotly_dark")
     fig.update_yaxes(title_text="HSI Index / Vega Value", row=1, col=1, secondary_y=False)
@@ -152,13 +417,44 @@ def load_and_update_chart():
 
 @app.route('/graph-data')
 def graph_data():
-    graph_json = load_and_update_chart()  # 确保这个函数返回图表的JSON数据
+    # /graph-data?strikes=16000,16500,17000
+    graph_json = load_and_update_chart(parse_strikes(request.args.get('strikes')))  # 确保这个函数返回图表的JSON数据
     return graph_json
 
+@app.route('/stream')
+def stream():
+    """
+    Server-Sent Events：连接后先推送当前图表，之后数据文件每次变化推送一次
+
+    页面中使用 new EventSource('/stream?strikes=16000,16500') 代替轮询 /graph-data。
+    """
+    strikes = parse_strikes(request.args.get('strikes'))
+
+    def events():
+        updates = broadcaster.subscribe()
+        try:
+            yield f"data: {load_and_update_chart(strikes)}\n\n"
+            while True:
+                try:
+                    updates.get(timeout=15)
+                except queue.Empty:
+                    # 保持连接，避免代理超时断开
+                    yield ": keep-alive\n\n"
+                    continue
+                yield f"data: {load_and_update_chart(strikes)}\n\n"
+        finally:
+            broadcaster.unsubscribe(updates)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
 @app.route('/')
 def index():
-    graph_json = load_and_update_chart()
+    graph_json = load_and_update_chart(parse_strikes(request.args.get('strikes')))
     return render_template('index.html', graph_json=graph_json)
 
 if __name__ == '__main__':
+    # debug 模式下重载器会另外启动一个子进程运行应用，只在该子进程中监视文件
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        start_monitoring()
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,125 @@
+"""
+web_v4 爬蟲端到端基準測試
+
+在本地啟動 tips_mock 模擬服務器，以無頭瀏覽器對 1..N 間公司執行完整的下載流程，
+輸出每組公司數的耗時及吞吐量。每次測試使用全新的暫存目錄（不重用會話及表單記錄），
+因此結果包含登錄及瀏覽器流程的全部開銷。
+
+    python bench_scraper.py --companies 1,2,4,8 --latency 0.2 --json bench.json
+    python bench_scraper.py --baseline bench.json --tolerance 0.2   # 比基線慢超過 20% 時返回 1
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import tips_mock
+
+
+def point_scraper_at(web_v4, base_url: str, work_dir: str):
+    """讓 web_v4 使用模擬服務器及獨立的暫存目錄"""
+    config = web_v4.Config
+    config.BASE_URL = base_url
+    config.INITIAL_URL = f"{base_url}/tips/_security/login.jsp"
+    config.POPUP_URL = f"{base_url}/tips/Login.do"
+    config.HOME_URL = f"{base_url}/tips/index.jsp"
+    config.BASE_DOWNLOAD_PATH = os.path.join(work_dir, 'download_data')
+    config.STAGING['dir'] = os.path.join(work_dir, 'staging')
+    config.SESSIONS['dir'] = os.path.join(work_dir, 'sessions')
+    config.DIRECT_HTTP['payload_file'] = os.path.join(work_dir, 'form_payloads.json')
+    config.JOURNAL['file'] = os.path.join(work_dir, 'run_journal.jsonl')
+    os.makedirs(config.BASE_DOWNLOAD_PATH, exist_ok=True)
+    web_v4._form_payloads = None
+
+
+def run_trial(web_v4, base_url: str, company_count: int, concurrency: int, profile: str) -> dict:
+    companies = [f"B{index:02d}" for index in range(company_count)]
+    with tempfile.TemporaryDirectory(prefix='tips_bench_') as work_dir:
+        point_scraper_at(web_v4, base_url, work_dir)
+        web_v4.reset_spans()
+        start = time.perf_counter()
+        results = asyncio.run(web_v4.run_async(companies=companies, max_concurrency=concurrency, profile=profile))
+        elapsed = time.perf_counter() - start
+
+    tasks = [r for company_results in results.values() for r in company_results]
+    succeeded = sum(1 for r in tasks if r['success'])
+    return {
+        'companies': company_count,
+        'concurrency': concurrency,
+        'seconds': round(elapsed, 3),
+        'reports': len(tasks),
+        'succeeded': succeeded,
+        'reports_per_minute': round(succeeded / elapsed * 60, 2) if elapsed else 0.0,
+    }
+
+
+def compare_with_baseline(trials: list, baseline_file: str, tolerance: float) -> bool:
+    """與基線比較，任一組公司數比基線慢超過 tolerance 時返回 False"""
+    with open(baseline_file, 'r', encoding='utf-8') as f:
+        baseline = {trial['companies']: trial for trial in json.load(f)['trials']}
+    ok = True
+    for trial in trials:
+        previous = baseline.get(trial['companies'])
+        if not previous:
+            continue
+        ratio = trial['seconds'] / previous['seconds'] if previous['seconds'] else 1.0
+        status = "OK" if ratio <= 1 + tolerance else "變慢"
+        print(f"{trial['companies']:>4} 間公司: {previous['seconds']:.2f}s -> {trial['seconds']:.2f}s "
+              f"({ratio - 1:+.0%}) {status}")
+        ok = ok and ratio <= 1 + tolerance
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description="web_v4 爬蟲端到端基準測試")
+    parser.add_argument("--companies", default="1,2,4", help="要測試的公司數，逗號分隔")
+    parser.add_argument("--concurrency", type=int, default=None, help="同時處理的公司數，預設等於公司數")
+    parser.add_argument("--repeat", type=int, default=1, help="每組重複次數，取最快的一次")
+    parser.add_argument("--latency", type=float, default=0.2, help="模擬報表生成延遲（秒）")
+    parser.add_argument("--page-latency", type=float, default=0.0, help="模擬其他頁面延遲（秒）")
+    parser.add_argument("--report-kb", type=int, default=64, help="模擬報表大小 (KB)")
+    parser.add_argument("--empty-rate", type=float, default=0.0, help="空報表比例 (0-1)")
+    parser.add_argument("--profile", default="production", help="web_v4 瀏覽器配置")
+    parser.add_argument("--json", metavar="FILE", help="把結果寫入 JSON 文件")
+    parser.add_argument("--baseline", metavar="FILE", help="與之前 --json 輸出的結果比較")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="允許比基線慢的比例")
+    parser.add_argument("--verbose", action="store_true", help="顯示 web_v4 的日誌")
+    args = parser.parse_args()
+
+    import web_v4
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.WARNING)
+    settings = tips_mock.MockSettings(args.latency, args.page_latency, args.report_kb, args.empty_rate)
+    server, base_url = tips_mock.start_server(settings)
+
+    trials = []
+    try:
+        for company_count in [int(n) for n in args.companies.split(',') if n.strip()]:
+            concurrency = args.concurrency or company_count
+            runs = [run_trial(web_v4, base_url, company_count, concurrency, args.profile)
+                    for _ in range(max(1, args.repeat))]
+            best = min(runs, key=lambda trial: trial['seconds'])
+            trials.append(best)
+            print(f"{best['companies']:>4} 間公司 (並發 {best['concurrency']}): {best['seconds']:.2f} 秒，"
+                  f"成功 {best['succeeded']}/{best['reports']}，{best['reports_per_minute']:.1f} 份報表/分鐘")
+    finally:
+        server.shutdown()
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'settings': vars(args), 'trials': trials}, f, ensure_ascii=False, indent=2)
+
+    failed = any(trial['succeeded'] < trial['reports'] for trial in trials) and args.empty_rate == 0
+    if failed:
+        print("有報表下載失敗")
+    if args.baseline and not compare_with_baseline(trials, args.baseline, args.tolerance):
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import asyncio
+import time
+
+import web_v4
+from web_v4 import AdaptiveLimiter, PlaywrightTimeoutError
+
+
+def ok():
+    return {'timeout': False, 'error': False}
+
+
+def timed_out():
+    return {'timeout': True, 'error': False}
+
+
+def test_alternating_healthy_latencies_keep_the_ceiling():
+    limiter = AdaptiveLimiter('Monthly Uncollect (download)', 4)
+    limits = []
+    for index in range(40):
+        limiter._adjust(1.0 if index % 2 else 4.0, ok())
+        limits.append(int(limiter.limit))
+    assert limits[-10:] == [4] * 10
+
+
+def test_timeouts_decrease_and_successes_recover_to_the_ceiling():
+    limiter = AdaptiveLimiter('Inventory (download)', 8)
+    limiter._adjust(1.0, timed_out())
+    assert int(limiter.limit) == 4
+    limiter._adjust(1.0, timed_out())
+    assert int(limiter.limit) == 2
+    for _ in range(60):
+        limiter._adjust(1.0, ok())
+    assert limiter.limit == 8
+
+
+def test_sustained_slowdown_reduces_the_limit():
+    limiter = AdaptiveLimiter('TV Export (preview)', 8)
+    for _ in range(20):
+        limiter._adjust(1.0, ok())
+    for _ in range(5):
+        limiter._adjust(3.0, ok())
+    assert limiter.limit < 8
+
+
+def test_healthy_limiters_grow_the_company_pool_up_to_the_cap(monkeypatch):
+    monkeypatch.setitem(web_v4.Config.ADAPTIVE, 'max_companies', 3)
+    monkeypatch.setattr(web_v4.Config, 'PARALLEL_CHAINS', 1)
+
+    async def run():
+        web_v4.reset_limiters(2)
+        with web_v4.span_labels(company='C1', task='TV Export'):
+            for _ in range(20):
+                async with web_v4.report_slot('preview'):
+                    pass
+        return web_v4.company_pool(), web_v4._limiters[('TV Export', 'preview')]
+
+    pool, limiter = asyncio.run(run())
+    assert pool.size == 3
+    assert limiter.ceiling == 3
+
+
+def test_no_data_is_not_counted_as_a_timeout():
+    async def run():
+        web_v4.reset_limiters(2)
+        with web_v4.span_labels(company='C1', task='Monthly Uncollect'):
+            token = web_v4._no_data.set(False)
+            try:
+                async with web_v4.report_slot('download'):
+                    web_v4.mark_no_data()
+                    raise PlaywrightTimeoutError('download')
+            except PlaywrightTimeoutError:
+                pass
+            finally:
+                web_v4._no_data.reset(token)
+        limiter = web_v4._limiters[('Monthly Uncollect', 'download')]
+        return limiter, web_v4._breakers['C1']
+
+    limiter, breaker = asyncio.run(run())
+    assert limiter.timeouts == 0
+    assert limiter.limit == 2
+    assert breaker.failures == 0
+
+
+def test_leaving_expect_download_or_no_data_does_not_wait_for_the_download():
+    class Page:
+        async def wait_for_event(self, event, timeout):
+            await asyncio.sleep(timeout / 1000)
+
+    async def run():
+        async with web_v4.expect_download_or_no_data(Page(), 5000):
+            pass
+
+    start = time.perf_counter()
+    asyncio.run(run())
+    assert time.perf_counter() - start < 1
@@ -0,0 +1,346 @@
+"""
+TIPS 離線模擬服務器
+
+只實現 web_v4.py 用到的部分：登錄彈出窗口、P1 / processfunction / process("N") 腳本鉤子、
+functionPage / reportWin iframe、#go_back 空報表頁面以及 xls / csv / pdf 下載。
+報表生成延遲、報表大小及空報表比例可調，用於在沒有 ap1.dchl.org 的環境下測試和基準測試爬蟲。
+
+    python tips_mock.py --port 8765 --latency 0.3 --report-kb 64
+    set TIPS_BASE_URL=http://127.0.0.1:8765 後運行 web_v4.py
+"""
+import argparse
+import hashlib
+import html
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# 各功能頁上的按鈕：sub_menu -> {按鈕: 報表}
+FUNCTIONS = {
+    'SO1': {'A': 'audit', 'B': 'monthly_uncollect'},
+    'SO2': {'D': 'uncollected', 'E': 'collections'},
+    'SO3': {'D': 'exchange_invoice'},
+    'IN4': {'C': 'inventory_c', 'D': 'inventory_excel'},
+    'BA2': {'C': 'tv'},
+}
+FUNCTION_MENUS = {'SO1': 'SOF', 'SO2': 'SOF', 'SO3': 'SOF', 'IN4': 'INV', 'BA2': 'BAS'}
+
+# 報表表單
+#   fields: 表單欄位 (name, 類型, 預設值)；select 的預設值為 (選項, ...)
+#   stages: process("6") 第幾次提交才返回文件；之前的提交返回帶 Confirm 按鈕的預覽頁
+#   form:   表單名稱
+REPORTS = {
+    'audit': {
+        'fields': [('SS03', 'text', ''), ('OUT_TYPE', 'select', ('xls', 'pdf'))],
+        'stages': 2,
+    },
+    'monthly_uncollect': {
+        'fields': [('SA13B', 'text', ''), ('SA13E', 'text', '')],
+        'stages': 2,
+    },
+    'uncollected': {
+        'fields': [('SA13B', 'text', ''), ('SA13E', 'text', '')],
+        'stages': 2,
+    },
+    'collections': {
+        'fields': [('ST07B', 'text', ''), ('OUT_TYPE', 'select', ('xls', 'pdf'))],
+        'stages': 2,
+    },
+    'exchange_invoice': {
+        'fields': [('SA13', 'text', '')],
+        'stages': 2,
+    },
+    'inventory_excel': {
+        'fields': [('OUT_TYPE', 'hidden', 'xls')],
+        'stages': 1,
+    },
+    # PDF 需先提交一次再重放表單取得文件，CSV 直接下載
+    'inventory_c': {
+        'form': 'IN4R745f',
+        'fields': [('OUT_TYPE', 'select', ('pdf', 'csv'))],
+        'stages': {'pdf': 2, 'csv': 1},
+    },
+    # 第一次 process("6") 載入數據並顯示 Save 按鈕，process("25") 導出 Excel
+    'tv': {
+        'fields': [('pageRowCount', 'text', '20'), ('maxRowCount', 'text', '200')],
+        'stages': 2,
+        'export_action': '25',
+    },
+}
+
+SHELL = """<html><head><title>TIPS</title>
+<script>
+function lock() {{}}
+function P1(id) {{
+    var menu = document.getElementById(id);
+    if (menu) {{ menu.className = 'open'; }}
+}}
+function processfunction(menu, subMenu) {{
+    window.frames['functionPage'].location.href = '/tips/function.jsp?menu=' + menu + '&sub=' + subMenu;
+}}
+function process(code) {{
+    var form = document.forms[0];
+    form.actionCode.value = code;
+    form.alias.value = code;
+    form.submit();
+}}
+</script></head>
+<body>
+<div id="nav">
+<a id="A0" href="#">Sales</a> <a id="A1" href="#">Inventory</a> <a id="A3" href="#">Basic Data</a>
+<a href="/tips/index.jsp" target="_top">Home</a>
+</div>
+<iframe name="functionPage" src="{function_src}" width="600" height="60"></iframe>
+<div id="main">{main}</div>
+<iframe name="reportWin" src="{report_src}" width="600" height="60"></iframe>
+</body></html>"""
+
+BACK_LINK = '<a href="javascript:history.go(-1)">Back</a>'
+
+
+class MockSettings:
+    def __init__(self, latency: float = 0.2, page_latency: float = 0.0, report_kb: int = 64,
+                 empty_rate: float = 0.0):
+        self.latency = latency            # 每次 process() 提交（報表生成）的延遲秒數
+        self.page_latency = page_latency  # 其他頁面的延遲秒數
+        self.report_kb = report_kb        # 下載文件大小 (KB)
+        self.empty_rate = empty_rate      # 返回空報表 (#go_back) 的比例，按公司/報表/日期固定
+        self.lock = threading.Lock()
+        self.stats = {'logins': 0, 'pages': 0, 'reports': 0, 'downloads': 0, 'empty': 0}
+
+    def count(self, key: str):
+        with self.lock:
+            self.stats[key] += 1
+
+
+def is_empty_report(settings: MockSettings, company: str, report: str, fields: dict) -> bool:
+    if settings.empty_rate <= 0:
+        return False
+    key = f"{company}|{report}|{sorted(fields.items())}".encode('utf-8')
+    bucket = int(hashlib.md5(key).hexdigest()[:8], 16) / 0xFFFFFFFF
+    return bucket < settings.empty_rate
+
+
+def report_body(settings: MockSettings, report: str, out_type: str, company: str) -> bytes:
+    """生成大約 report_kb 大小的報表內容：xls 為 HTML 表格（與 TIPS 相同），另有 csv / pdf"""
+    size = settings.report_kb * 1024
+    if out_type == 'pdf':
+        head = b'%PDF-1.4\n% TIPS mock ' + report.encode('ascii') + b'\n'
+        return head + b'0' * max(0, size - len(head) - 6) + b'\n%%EOF'
+    row = f"{company},{report},ITEM{{0:08d}},100,200\n" if out_type == 'csv' else \
+        f"<tr><td>{company}</td><td>{report}</td><td>ITEM{{0:08d}}</td><td>100</td><td>200</td></tr>\n"
+    rows = []
+    total = 0
+    index = 0
+    while total < size:
+        line = row.format(index)
+        rows.append(line)
+        total += len(line)
+        index += 1
+    if out_type == 'csv':
+        return ("COMPANY,REPORT,ITEM,QTY,AMOUNT\n" + "".join(rows)).encode('utf-8')
+    return ("<html><body><table>\n" + "".join(rows) + "</table></body></html>").encode('utf-8')
+
+
+def render_form(report: str, sub_menu: str, stage: int, values: dict) -> str:
+    spec = REPORTS[report]
+    inputs = []
+    for name, kind, default in spec['fields']:
+        value = values.get(name)
+        if kind == 'select':
+            selected = value or default[0]
+            options = "".join(f'<option value="{o}"{" selected" if o == selected else ""}>{o}</option>'
+                              for o in default)
+            inputs.append(f'{name} <select name="{name}">{options}</select>')
+        elif kind == 'hidden':
+            inputs.append(f'<input type="hidden" name="{name}" value="{html.escape(value or default)}">')
+        else:
+            inputs.append(f'{name} <input type="text" name="{name}" value="{html.escape(value or default)}">')
+
+    if report == 'tv' and stage > 1:
+        # 數據已載入，顯示 Save 按鈕
+        buttons = '<input type="button" name="save" value="Save" onclick="process(\'10\')">'
+    else:
+        buttons = '<input class="BTN_PWR" type="button" value="Confirm" onclick="process(\'6\');">'
+
+    form_name = spec.get('form', f"{sub_menu}{report}f")
+    return (f'<form name="{form_name}" method="post" action="/tips/report.do">'
+            f'<input type="hidden" name="report" value="{report}">'
+            f'<input type="hidden" name="sub" value="{sub_menu}">'
+            f'<input type="hidden" name="stage" value="{stage}">'
+            f'<input type="hidden" name="actionCode" value="">'
+            f'<input type="hidden" name="alias" value="">'
+            + "<br>".join(inputs) + "<br>" + buttons + '</form>')
+
+
+class TipsHandler(BaseHTTPRequestHandler):
+    server_version = "TIPSMock/1.0"
+
+    @property
+    def settings(self) -> MockSettings:
+        return self.server.settings
+
+    def log_message(self, format, *args):
+        pass
+
+    def company(self):
+        for part in self.headers.get('Cookie', '').split(';'):
+            name, _, value = part.strip().partition('=')
+            if name == 'TIPSSESSION' and value:
+                return value
+        return None
+
+    def send_html(self, body: str, status: int = 200, headers: dict = None):
+        data = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def redirect(self, location: str, headers: dict = None):
+        self.send_response(302)
+        self.send_header('Location', location)
+        self.send_header('Content-Length', '0')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+
+    def send_file(self, body: bytes, file_name: str, content_type: str):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Disposition', f'attachment; filename="{file_name}"')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def shell(self, main: str = '', sub_menu: str = None, report_src: str = 'about:blank') -> str:
+        function_src = 'about:blank'
+        if sub_menu:
+            function_src = f'/tips/function.jsp?menu={FUNCTION_MENUS[sub_menu]}&sub={sub_menu}'
+        return SHELL.format(function_src=function_src, main=main, report_src=report_src)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if self.settings.page_latency:
+            time.sleep(self.settings.page_latency)
+        self.settings.count('pages')
+
+        if url.path == '/tips/_security/login.jsp':
+            return self.send_html("<html><head><title>TIPS</title></head><body>"
+                                  "<script>window.open('/tips/Login.do', 'tipsMain');</script></body></html>")
+        if url.path == '/tips/Login.do':
+            return self.send_html('<html><head><title>TIPS Login</title></head><body>'
+                                  '<form method="post" action="/tips/Login.do">'
+                                  'User <input type="text" name="LOGINID"> '
+                                  'Password <input type="password" name="PWD"> '
+                                  '<input type="submit" name="login" value="Login"></form></body></html>')
+        if url.path == '/tips/empty.jsp':
+            return self.send_html(f"<html><body>No data. {BACK_LINK}</body></html>")
+        if url.path == '/tips/preview.jsp':
+            return self.send_html("<html><body>Report ready.</body></html>")
+
+        if not self.company():
+            return self.redirect('/tips/_security/login.jsp')
+        if url.path in ('/tips/', '/tips/index.jsp'):
+            return self.send_html(self.shell())
+        if url.path == '/tips/function.jsp':
+            sub_menu = query.get('sub', '')
+            buttons = "".join(
+                f'<input class="FunButton" type="button" value="{button}" accesskey="{button}" '
+                f'onclick="top.location.href=\'/tips/form.do?sub={sub_menu}&btn={button}\'">'
+                for button in FUNCTIONS.get(sub_menu, {}))
+            return self.send_html(f"<html><body>{buttons}</body></html>")
+        if url.path == '/tips/form.do':
+            sub_menu = query.get('sub', '')
+            report = FUNCTIONS.get(sub_menu, {}).get(query.get('btn'))
+            if not report:
+                return self.send_html("Not Found", status=404)
+            return self.send_html(self.shell(render_form(report, sub_menu, 1, {}), sub_menu))
+        self.send_html("Not Found", status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        fields = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode('utf-8'),
+                                               keep_blank_values=True).items()}
+        url = urlparse(self.path)
+
+        if url.path == '/tips/Login.do':
+            company = fields.get('LOGINID', '').split('.')[0]
+            if not company or fields.get('PWD') != '0000':
+                return self.redirect('/tips/Login.do')
+            self.settings.count('logins')
+            return self.redirect('/tips/index.jsp', {'Set-Cookie': f'TIPSSESSION={company}; Path=/tips'})
+
+        company = self.company()
+        if not company:
+            return self.redirect('/tips/_security/login.jsp')
+        if url.path != '/tips/report.do' or fields.get('report') not in REPORTS:
+            return self.send_html("Not Found", status=404)
+
+        report = fields['report']
+        sub_menu = fields.get('sub', '')
+        spec = REPORTS[report]
+        out_type = fields.get('OUT_TYPE', 'xls')
+        stages = spec['stages'][out_type] if isinstance(spec['stages'], dict) else spec['stages']
+        stage = int(fields.get('stage') or 1)
+        action = fields.get('actionCode')
+
+        time.sleep(self.settings.latency)
+        self.settings.count('reports')
+        data_fields = {k: v for k, v in fields.items() if k not in ('stage', 'actionCode', 'alias')}
+        if is_empty_report(self.settings, company, report, data_fields):
+            self.settings.count('empty')
+            main = f'<input type="button" id="go_back" value="Back" onclick="history.go(-1)"> {BACK_LINK}'
+            return self.send_html(self.shell(main, sub_menu, '/tips/empty.jsp'))
+
+        if stage >= stages and action == spec.get('export_action', '6'):
+            self.settings.count('downloads')
+            extension = 'xls' if report == 'tv' else out_type
+            content_type = {'pdf': 'application/pdf', 'csv': 'text/csv'}.get(extension, 'application/vnd.ms-excel')
+            body = report_body(self.settings, report, extension, company)
+            return self.send_file(body, f"{report}.{extension}", content_type)
+
+        # 預覽頁：保留已填的欄位，下一次提交返回文件
+        form = render_form(report, sub_menu, stage + 1, fields)
+        self.send_html(self.shell(form, sub_menu, '/tips/preview.jsp'))
+
+
+def start_server(settings: MockSettings = None, host: str = '127.0.0.1', port: int = 0):
+    """在後台線程啟動模擬服務器，返回 (server, base_url)；port 為 0 時自動選擇端口"""
+    server = ThreadingHTTPServer((host, port), TipsHandler)
+    server.daemon_threads = True
+    server.settings = settings or MockSettings()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="TIPS 離線模擬服務器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--latency", type=float, default=0.2, help="報表生成延遲（秒）")
+    parser.add_argument("--page-latency", type=float, default=0.0, help="其他頁面延遲（秒）")
+    parser.add_argument("--report-kb", type=int, default=64, help="下載文件大小 (KB)")
+    parser.add_argument("--empty-rate", type=float, default=0.0, help="空報表比例 (0-1)")
+    args = parser.parse_args()
+
+    settings = MockSettings(args.latency, args.page_latency, args.report_kb, args.empty_rate)
+    server = ThreadingHTTPServer((args.host, args.port), TipsHandler)
+    server.settings = settings
+    print(f"TIPS 模擬服務器: http://{args.host}:{args.port}/tips/index.jsp")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"統計: {settings.stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,9 @@
-from playwright.sync_api import sync_playwright, Page
+from playwright.async_api import async_playwright, Page, TimeoutError as PlaywrightTimeoutError
+import asyncio
+import collections
+import contextlib
+import contextvars
+import functools
 import logging
 import time
 import os
@@ -9,15 +14,180 @@ import schedule
 from pathlib import Path
 from dateutil.relativedelta import relativedelta
 import sys
-import win32com.client as win32
-import pythoncom
+import json
+import random
+import hashlib
+import math
+import sqlite3
+import tempfile
+import threading
+import types
+import weakref
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+try:
+    import win32com.client as win32
+    import pythoncom
+except ImportError:  # 非 Windows 環境只能使用純 Python 轉換
+    win32 = None
+    pythoncom = None
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 class Config:
-    INITIAL_URL = "http://ap1.dchl.org/tips/_security/login.jsp"
-    POPUP_URL = "http://ap1.dchl.org/tips/Login.do"
+    # TIPS_BASE_URL 可指向其他 TIPS 服務器，例如 tips_mock.py 啟動的本地模擬服務器
+    BASE_URL = os.environ.get("TIPS_BASE_URL", "http://ap1.dchl.org").rstrip('/')
+    INITIAL_URL = f"{BASE_URL}/tips/_security/login.jsp"
+    POPUP_URL = f"{BASE_URL}/tips/Login.do"
+    HOME_URL = f"{BASE_URL}/tips/index.jsp"
     TIMEOUTS = {'element': 15000, 'popup': 10000, 'download': 20000}
+    # 瀏覽器配置：debug 為有界面的 Edge，方便排查，保持 Playwright 原有的默認超時；production 為無頭 Chromium，
+    # 經 CDP 阻擋圖片、字體和媒體請求（不使用 route，以免停用 HTTP 緩存；保留樣式表，可見性判斷依賴 CSS），
+    # 並以較短的 element 超時作為元素操作的默認超時（頁面導航仍為 Playwright 默認的 30 秒）
+    BROWSER_PROFILES = {
+        'debug': {
+            'launch': {'channel': 'msedge', 'headless': False},
+            'block_resources': [],
+            'timeouts': {},
+            'viewport': None,
+        },
+        'production': {
+            'launch': {'headless': True, 'args': ['--blink-settings=imagesEnabled=false']},
+            'block_resources': ['image', 'font', 'media'],
+            'timeouts': {'element': 8000, 'popup': 8000, 'download': 15000},
+            'viewport': {'width': 1024, 'height': 720},
+        },
+    }
+    BROWSER_PROFILE = os.environ.get("TIPS_BROWSER_PROFILE", "debug")
+    BASE_DOWNLOAD_PATH = r'\\files01-wtc.kmml.local\ON-Warehouse\各場庫存及容量\python_data\download_data'
+    COMPANIES = ["BV", "BD", "TS", "TD", "MM", "FR", "WH", "ED", "EF", "ES", "EB", "SM"]  # 可以根据需要添加更多公司
+    CONVERT_EXCLUDE = {"SM"}  # 只下載、不轉換到資料庫更新資料夾的公司
+    CONVERT_OUTPUT_PATH = r'\\files01-wtc.kmml.local\ON-Warehouse\各場庫存及容量\({company})資料庫更新'
+    # 同時處理的公司數量上限（同一瀏覽器內的 context 數），設為 1 即逐間串行處理
+    MAX_CONCURRENT_COMPANIES = int(os.environ.get("TIPS_MAX_CONCURRENCY", "4"))
+    # 同一公司內互不依賴的報表鏈可在不同頁面上並行，設為 1 即按註冊表順序串行
+    PARALLEL_CHAINS = int(os.environ.get("TIPS_PARALLEL_CHAINS", "1"))
+    # 就緒等待：預設等待具體信號；legacy_sleeps 為 True 時退回原來的固定 sleep
+    READINESS = {
+        'legacy_sleeps': os.environ.get("TIPS_LEGACY_SLEEPS") == "1",
+        'signal_timeout': 10,  # 秒
+    }
+    # 文件轉換：backend 為 'python' 時不需要 Excel，'excel' 則經 COM 調用 Excel 另存
+    CONVERSION = {
+        'backend': os.environ.get("TIPS_CONVERT_BACKEND", "python"),
+        'workers': min(8, os.cpu_count() or 1),
+        'html_to_biff': False,  # 為 True 時把 HTML 格式的 .xls 轉成真正的 BIFF（需要 xlwt）
+        # 記錄每對輸入/輸出的哈希、大小和修改時間，未變的文件跳過轉換
+        'manifest': os.path.join(BASE_DOWNLOAD_PATH, 'conversion_manifest.json'),
+    }
+    # 轉換流水線：下載發佈後立即排隊轉換，與其他公司的下載並行；queue_size 為排隊文件數上限
+    PIPELINE = {
+        'enabled': os.environ.get("TIPS_PIPELINE", "1") == "1",
+        'queue_size': 16,
+    }
+    # 下載先保存到本地暫存目錄，再以大塊緩衝流式寫入網絡共享並原子替換
+    STAGING = {
+        'dir': os.path.join(tempfile.gettempdir(), 'tips_staging'),
+        'chunk_size': 4 * 1024 * 1024,
+        'verify': False,  # 為 True 時寫入後重新讀取共享上的文件校驗 SHA-256
+    }
+    # 會話重用：每間公司的 cookies / storage state 保存在 dir 下，超過 max_age 秒即重新登錄
+    SESSIONS = {
+        'dir': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sessions'),
+        'max_age': 8 * 3600,
+        'probe_timeout': 3000,
+    }
+    # 直接 HTTP 下載：瀏覽器流程記錄下每個報表最終提交的表單，之後以會話 cookie 直接重放
+    DIRECT_HTTP = {
+        'enabled': os.environ.get("TIPS_DIRECT_HTTP", "1") == "1",
+        'payload_file': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'form_payloads.json'),
+    }
+    # 運行記錄：每次運行把 (公司, 報表, 日期) 的結果追加到 JSONL，--resume 只重跑未完成的任務
+    JOURNAL = {
+        'file': os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_journal.jsonl'),
+    }
+    # 運行歷史 (SQLite)：每次運行各公司、各報表的耗時、文件大小及結果；--history-report 輸出最近 window 次的趨勢，
+    #   最近一次耗時超過基線中位數 slow_factor 倍或文件大小偏離 size_factor 倍時標記為退化
+    HISTORY = {
+        'file': os.environ.get("TIPS_HISTORY_DB",
+                               os.path.join(os.path.dirname(os.path.abspath(__file__)), 'run_history.sqlite3')),
+        'window': 20,
+        'slow_factor': 2.0,
+        'size_factor': 2.0,
+    }
+    # 失敗的下載及發佈最多重試 attempts 次，等待時間按 backoff 秒指數增長，上限 max_backoff 秒
+    RETRY = {
+        'attempts': int(os.environ.get("TIPS_RETRIES", "2")),
+        'backoff': 2.0,
+        'max_backoff': 30.0,
+    }
+    # 報表生成的自適應並發：每種報表每個步驟的同時請求數從 同時處理的公司數 × PARALLEL_CHAINS 開始，
+    #   按 AIMD 在 [min, 該上限] 內調整；平均延遲超過最近 window 次成功延遲中位數的 slow_factor 倍視為服務器擁塞；
+    #   所有限流器都已達上限且延遲正常時，同時處理的公司數從 MAX_CONCURRENT_COMPANIES 逐步增加，最多 max_companies 間；
+    #   公司連續 breaker_threshold 次超時後暫停 breaker_pause 秒（每次觸發加倍，上限 breaker_max_pause）
+    ADAPTIVE = {
+        'enabled': os.environ.get("TIPS_ADAPTIVE", "1") == "1",
+        'max_companies': int(os.environ.get("TIPS_MAX_COMPANIES", "8")),
+        'min': 1,
+        'window': 20,
+        'slow_factor': 2.0,
+        'decrease': 0.5,
+        'breaker_threshold': 3,
+        'breaker_pause': 60,
+        'breaker_max_pause': 600,
+    }
+    # 常駐模式 (--daemon)：保持瀏覽器及已登錄的 context，按排程觸發任務
+    #   jobs: at 為每日固定時間 (HH:MM)，every_minutes 為間隔分鐘數（0 表示停用）；tasks 為空表示全部報表
+    DAEMON = {
+        'status_port': int(os.environ.get("TIPS_STATUS_PORT", "8766")),
+        'jobs': {
+            'nightly': {'at': os.environ.get("TIPS_NIGHTLY_AT", "06:00"), 'tasks': []},
+            'inventory': {
+                'every_minutes': int(os.environ.get("TIPS_INVENTORY_EVERY", "0")),
+                'tasks': ['Inventory Excel', 'Inventory PDF', 'Inventory CSV'],
+            },
+        },
+    }
+    # 耗時追蹤導出文件：.json 為 Chrome trace event 格式，其他副檔名為 OpenMetrics 文本；None 表示不導出
+    TRACE = {
+        'file': os.environ.get("TIPS_TRACE_FILE"),
+    }
+    # form: 表單名稱；anchor: 用於定位表單的元素；fields: 重放時覆蓋的欄位，支持 {date} / {prev_month}
+    # 下載文件名取自 REPORT_TASKS 的 output
+    DIRECT_REPORTS = {
+        'Daily Product Audit': {
+            'anchor': "input[type='button'][value='Confirm'][onclick=\"process('6');\"]",
+            'fields': {'SS03': '{date}', 'OUT_TYPE': 'xls'},
+        },
+        'Monthly Uncollect': {
+            'anchor': 'input[name="SA13B"]',
+            'fields': {'SA13B': '{prev_month}', 'SA13E': '{date}'},
+        },
+        'Uncollected Order Detail': {
+            'anchor': "input[type='button'][value='Confirm'][onclick=\"process('6');\"]",
+            'fields': {'SA13B': '{date}', 'SA13E': '{date}'},
+        },
+        'Print Collections': {
+            'anchor': 'input[name="ST07B"]',
+            'fields': {'ST07B': '{date}', 'OUT_TYPE': 'xls'},
+        },
+        'Exchange Invoice': {
+            'anchor': 'input[name="SA13"]',
+            'fields': {'SA13': '{date}'},
+        },
+        'Inventory Excel': {
+            'anchor': None,
+            'fields': {},
+        },
+        'Inventory PDF': {
+            'form': 'IN4R745f',
+            'fields': {'OUT_TYPE': 'pdf'},
+        },
+        'Inventory CSV': {
+            'anchor': 'select[name="OUT_TYPE"]',
+            'fields': {'OUT_TYPE': 'csv'},
+        },
+    }
     SELECTORS = {
         'login': {
             'username': 'input[name="LOGINID"]',
@@ -88,146 +258,1106 @@ class Config:
         }
     }
 
-def close_popup_during_download(page):
+####### 耗時追蹤 Start #######
+# 各階段的中文名稱，用於摘要輸出
+TRACE_PHASES = {
+    'login': '登錄',
+    'navigate': '菜單導航',
+    'server': '報表生成',
+    'wait': '就緒等待',
+    'download': '等待下載',
+    'save': '保存到本地',
+    'publish': '發佈到共享',
+    'http': '直接請求',
+    'ui': '頁面操作',
+    'convert': '文件轉換',
+}
+_spans = []
+_span_labels = contextvars.ContextVar('span_labels', default={})
+_current_span = contextvars.ContextVar('current_span', default=None)
+_trace_origin = time.perf_counter()
+
+@contextlib.contextmanager
+def span_labels(**labels):
+    """為範圍內記錄的 span 加上公司、報表等標籤"""
+    token = _span_labels.set({**_span_labels.get(), **labels})
+    try:
+        yield
+    finally:
+        _span_labels.reset(token)
+
+@contextlib.contextmanager
+def span(phase: str, name: Optional[str] = None, detached: bool = False):
+    """
+    記錄一段操作的耗時
+
+    嵌套的 span 從外層扣除自身耗時，摘要按各 span 的自身耗時 (self) 統計。
+    detached 為 True 時不計入外層（例如在後台線程中與任務並行的發佈）。
+    """
+    record = {'phase': phase, 'name': name or phase, **_span_labels.get(),
+              'start': time.perf_counter(), 'children': 0.0}
+    parent = None if detached else _current_span.get()
+    token = _current_span.set(record)
+    try:
+        yield record
+    finally:
+        _current_span.reset(token)
+        record['duration'] = time.perf_counter() - record['start']
+        record['self'] = max(0.0, record['duration'] - record.pop('children'))
+        if parent is not None and 'children' in parent:
+            parent['children'] += record['duration']
+        _spans.append(record)
+
+def traced(phase: str, detached: bool = False):
+    """以 span 包裝函數（支持協程函數）"""
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with span(phase, func.__name__, detached):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(phase, func.__name__, detached):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def reset_spans():
+    _spans.clear()
+
+def _phase_totals(spans: list) -> dict:
+    totals = {}
+    for record in spans:
+        totals[record['phase']] = totals.get(record['phase'], 0.0) + record['self']
+    return totals
+
+def _format_phases(totals: dict, limit: int = 4) -> str:
+    total = sum(totals.values()) or 1.0
+    top = sorted(totals.items(), key=lambda item: item[1], reverse=True)[:limit]
+    return "，".join(f"{TRACE_PHASES.get(phase, phase)} {seconds:.1f} 秒 ({seconds / total:.0%})"
+                    for phase, seconds in top)
+
+def log_trace_summary():
+    """按報表及公司輸出各階段耗時佔比"""
+    if not _spans:
+        return
+    logging.info("\n========= 各階段耗時摘要 =========")
+    logging.info(f"全部: {_format_phases(_phase_totals(_spans))}")
+
+    by_task, by_company = {}, {}
+    for record in _spans:
+        if 'task' in record:
+            by_task.setdefault(record['task'], []).append(record)
+        if 'company' in record:
+            by_company.setdefault(record['company'], []).append(record)
+    logging.info("按報表:")
+    for task, spans in by_task.items():
+        logging.info(f"  {task}: {_format_phases(_phase_totals(spans))}")
+    logging.info("按公司:")
+    for company, spans in by_company.items():
+        logging.info(f"  {company}: {_format_phases(_phase_totals(spans))}")
+
+def export_trace(path: str):
+    """
+    導出記錄的 span
+
+    .json 導出為 Chrome trace event 格式（可在 chrome://tracing 或 Perfetto 打開，每間公司一條軌道），
+    其他副檔名導出為 OpenMetrics 文本。
+    """
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        if path.lower().endswith('.json'):
+            lanes = {}
+            events = []
+            for record in _spans:
+                lane = record.get('company', 'main')
+                tid = lanes.setdefault(lane, len(lanes) + 1)
+                events.append({
+                    'name': record['name'],
+                    'cat': record['phase'],
+                    'ph': 'X',
+                    'ts': round((record['start'] - _trace_origin) * 1e6),
+                    'dur': round(record['duration'] * 1e6),
+                    'pid': 1,
+                    'tid': tid,
+                    'args': {key: record[key] for key in ('company', 'task', 'date') if key in record},
+                })
+            for lane, tid in lanes.items():
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid, 'args': {'name': lane}})
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f, ensure_ascii=False)
+        else:
+            totals = {}
+            for record in _spans:
+                key = (record.get('company', ''), record.get('task', ''), record['phase'])
+                seconds, count = totals.get(key, (0.0, 0))
+                totals[key] = (seconds + record['self'], count + 1)
+            lines = [
+                "# TYPE tips_phase_seconds counter",
+                "# UNIT tips_phase_seconds seconds",
+                "# HELP tips_phase_seconds Self time spent in each scraper phase.",
+            ]
+            for (company, task, phase), (seconds, _) in sorted(totals.items()):
+                lines.append(f'tips_phase_seconds_total{{company="{company}",task="{task}",phase="{phase}"}} {seconds:.6f}')
+            lines.append("# TYPE tips_phase_spans counter")
+            lines.append("# HELP tips_phase_spans Number of spans recorded in each scraper phase.")
+            for (company, task, phase), (_, count) in sorted(totals.items()):
+                lines.append(f'tips_phase_spans_total{{company="{company}",task="{task}",phase="{phase}"}} {count}')
+            lines.append("# EOF")
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write("\n".join(lines) + "\n")
+        logging.info(f"已導出耗時追蹤: {path}")
+    except Exception as e:
+        logging.warning(f"導出耗時追蹤失敗: {str(e)}")
+
+######## 耗時追蹤 _ END #########
+
+####### 自適應並發 Start #######
+class AdaptiveLimiter:
+    """
+    單一報表類型、單一步驟（preview / download / direct）的 AIMD 並發上限
+
+    所有公司共用，上限從 ceiling（能同時進行的請求數）開始。超時、出錯或平均延遲超過
+    最近 window 次成功延遲中位數的 slow_factor 倍時上限按 decrease 比例減少；
+    成功且延遲正常時每輪 +1，最多恢復到 ceiling。已在 ceiling 時繼續累計的增量滿 1 後
+    要求增加同時處理的公司數（見 CompanyPool），ceiling 隨之提高。
+    """
+
+    def __init__(self, name: str, ceiling: int):
+        self.name = name
+        self.ceiling = float(max(1, ceiling))
+        self.limit = self.ceiling
+        self.in_flight = 0
+        self.latency = None       # 延遲的指數移動平均（秒）
+        self.samples = collections.deque(maxlen=Config.ADAPTIVE['window'])  # 最近成功的延遲
+        self.completed = self.timeouts = self.errors = 0
+        self.headroom = 0.0       # 已達 ceiling 後累計的增量
+        self.condition = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def release(self, elapsed: float, outcome: dict):
+        async with self.condition:
+            self.in_flight -= 1
+            self._adjust(elapsed, outcome)
+            self.condition.notify_all()
+        if self.headroom >= 1:
+            self.headroom = 0.0
+            await grow_company_pool()
+
+    def baseline(self) -> Optional[float]:
+        """最近成功延遲的中位數，隨服務器的正常速度變化"""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[len(ordered) // 2]
+
+    def _adjust(self, elapsed: float, outcome: dict):
+        cfg = Config.ADAPTIVE
+        self.completed += 1
+        if outcome['timeout']:
+            self.timeouts += 1
+        elif outcome['error']:
+            self.errors += 1
+        else:
+            self.latency = elapsed if self.latency is None else 0.8 * self.latency + 0.2 * elapsed
+            self.samples.append(elapsed)
+
+        previous = int(self.limit)
+        baseline = self.baseline()
+        congested = outcome['timeout'] or outcome['error'] or \
+            (baseline is not None and self.latency > baseline * cfg['slow_factor'])
+        if congested:
+            self.limit = max(float(cfg['min']), self.limit * cfg['decrease'])
+            self.headroom = 0.0
+        elif self.limit >= self.ceiling:
+            self.headroom += 1 / self.limit
+        else:
+            self.limit = min(self.ceiling, self.limit + 1 / self.limit)
+        if int(self.limit) != previous:
+            logging.info(f"{self.name} 並發上限調整為 {int(self.limit)}"
+                         f"（平均延遲 {self.latency or 0:.1f} 秒，超時 {self.timeouts} 次）")
+
+class CircuitBreaker:
+    """公司連續 breaker_threshold 次超時後暫停該公司的報表請求，暫停時間每次觸發加倍"""
+
+    def __init__(self, company: str):
+        self.company = company
+        self.failures = 0
+        self.trips = 0
+        self.open_until = 0.0
+
+    def record(self, timed_out: bool):
+        cfg = Config.ADAPTIVE
+        if not timed_out:
+            self.failures = 0
+            return
+        self.failures += 1
+        if self.failures >= cfg['breaker_threshold']:
+            self.trips += 1
+            self.failures = 0
+            pause = min(cfg['breaker_max_pause'], cfg['breaker_pause'] * 2 ** (self.trips - 1))
+            self.open_until = time.monotonic() + pause
+            logging.warning(f"公司 {self.company} 連續 {cfg['breaker_threshold']} 次超時，暫停 {pause:.0f} 秒")
+
+    async def wait(self):
+        remaining = self.open_until - time.monotonic()
+        if remaining > 0:
+            with span('wait', 'circuit_breaker'):
+                await asyncio.sleep(remaining)
+
+class CompanyPool:
+    """
+    同時處理的公司數：從 size 開始，TIPS 應付得來時由限流器要求逐步增加，最多到 cap
+
+    減少由各限流器負責（限制同時進行的報表請求），因此這裡只會增加。
+    """
+
+    def __init__(self, size: int, cap: int):
+        self.size = max(1, size)
+        self.cap = max(self.size, cap)
+        self.active = 0
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.active < self.size)
+            self.active += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self.condition:
+            self.active -= 1
+            self.condition.notify_all()
+
+    async def grow(self) -> bool:
+        async with self.condition:
+            if self.size >= self.cap:
+                return False
+            self.size += 1
+            self.condition.notify_all()
+        logging.info(f"TIPS 延遲正常，同時處理的公司數增加到 {self.size}")
+        return True
+
+_limiters = {}
+_breakers = {}
+_company_pool = None
+_report_slot = contextvars.ContextVar('report_slot', default=None)
+
+def limiter_ceiling() -> int:
+    """每個限流器的上限：同時處理的公司數 × PARALLEL_CHAINS，即沒有限流時最多同時進行的請求數"""
+    return _company_pool.size * max(1, Config.PARALLEL_CHAINS)
+
+def reset_limiters(max_concurrency: Optional[int] = None):
+    """清除已學習的並發上限、同時處理的公司數及斷路器（每次獨立運行開始時調用，常駐模式則啟動時調用一次）"""
+    global _company_pool
+    _limiters.clear()
+    _breakers.clear()
+    size = max_concurrency or Config.MAX_CONCURRENT_COMPANIES
+    cap = Config.ADAPTIVE['max_companies'] if Config.ADAPTIVE['enabled'] else size
+    _company_pool = CompanyPool(size, cap)
+
+async def grow_company_pool():
+    """所有限流器都已達上限時增加同時處理的公司數，並提高各限流器的上限"""
+    if _company_pool is None or any(limiter.limit < limiter.ceiling for limiter in _limiters.values()):
+        return
+    if await _company_pool.grow():
+        for limiter in _limiters.values():
+            limiter.ceiling = float(limiter_ceiling())
+
+def company_pool() -> CompanyPool:
+    if _company_pool is None:
+        reset_limiters()
+    return _company_pool
+
+@contextlib.asynccontextmanager
+async def report_slot(phase: str):
+    """
+    佔用當前報表在某一步驟的一個名額
+
+    phase 為 'preview'（process("6") 預覽）、'download'（提交到下載開始）或 'direct'（直接 HTTP 請求），
+    各步驟耗時差別很大，分開限流。報表類型及公司取自 span_labels 的 task / company 標籤。
+    TIPS 表示沒有數據 (mark_no_data) 的請求不計為超時。
+    """
+    if not Config.ADAPTIVE['enabled'] or _report_slot.get() is not None:
+        yield
+        return
+    company_pool()
+    labels = _span_labels.get()
+    key = (labels.get('task', 'unknown'), phase)
+    company = labels.get('company', 'unknown')
+    if key not in _limiters:
+        _limiters[key] = AdaptiveLimiter(f"{key[0]} ({phase})", limiter_ceiling())
+    if company not in _breakers:
+        _breakers[company] = CircuitBreaker(company)
+    limiter, breaker = _limiters[key], _breakers[company]
+
+    await breaker.wait()
+    await limiter.acquire()
+    outcome = {'timeout': False, 'error': False}
+    token = _report_slot.set(outcome)
+    start = time.perf_counter()
+    try:
+        yield
+    except (PlaywrightTimeoutError, asyncio.TimeoutError):
+        outcome['timeout'] = True
+        raise
+    except Exception:
+        outcome['error'] = True
+        raise
+    finally:
+        _report_slot.reset(token)
+        if _no_data.get():
+            outcome['timeout'] = outcome['error'] = False
+        breaker.record(outcome['timeout'])
+        await limiter.release(time.perf_counter() - start, outcome)
+
+def note_timeout():
+    """在 report_slot 範圍內捕獲超時（不再向外拋出）時調用，使限流器及斷路器仍能記錄"""
+    outcome = _report_slot.get()
+    if outcome is not None:
+        outcome['timeout'] = True
+
+def log_limiter_summary():
+    if not _limiters:
+        return
+    logging.info("\n========= 報表並發摘要 =========")
+    logging.info(f"同時處理的公司數: {company_pool().size}")
+    for limiter in _limiters.values():
+        latency = f"{limiter.latency:.1f} 秒" if limiter.latency is not None else "-"
+        logging.info(f"{limiter.name}: 上限 {int(limiter.limit)}，平均延遲 {latency}，"
+                     f"完成 {limiter.completed}，超時 {limiter.timeouts}，錯誤 {limiter.errors}")
+    for company, breaker in _breakers.items():
+        if breaker.trips:
+            logging.info(f"公司 {company} 因連續超時暫停 {breaker.trips} 次")
+
+######## 自適應並發 _ END #########
+
+####### 就緒等待 Start #######
+_readiness_trackers = contextvars.ContextVar('readiness_trackers', default=())
+
+class ReadinessTracker:
+    """累計就緒等待相對於舊版固定 sleep 節省的秒數"""
+
+    def __init__(self):
+        self.saved = 0.0
+        self.waits = 0
+
+@contextlib.contextmanager
+def track_readiness():
+    """在當前任務（及其嵌套範圍）內統計就緒等待節省的時間"""
+    tracker = ReadinessTracker()
+    token = _readiness_trackers.set(_readiness_trackers.get() + (tracker,))
     try:
-        # 獲取所有打開的頁面
-        pages = page.context.pages
-        for popup in pages:
-            if popup != page:  # 不是主頁面
-                # 檢查是否是下載消息窗口
-                if "Download Message" in popup.title():
-                    logging.info("檢測到下載消息窗口")
-                    # 由於沒有明確的關閉按鈕，我們直接關閉這個頁面
-                    popup.close()
-                    logging.info("已關閉下載消息窗口")
-                    return True
+        yield tracker
+    finally:
+        _readiness_trackers.reset(token)
+
+def _record_wait(fallback: float, elapsed: float):
+    for tracker in _readiness_trackers.get():
+        tracker.saved += fallback - elapsed
+        tracker.waits += 1
+
+async def first_signal(*signals):
+    """等待多個信號中最先完成的一個，並取消其餘信號"""
+    tasks = [asyncio.ensure_future(signal) for signal in signals]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            task.exception()  # 標記異常已讀取，超時等錯誤交由調用方的後續步驟處理
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+@traced('wait')
+async def pace(fallback: float, signal=None):
+    """
+    等待具體的就緒信號，取代固定的 sleep
+
+    Args:
+        fallback: 舊版的固定等待秒數，開啟 legacy_sleeps 時使用
+        signal: 返回就緒信號（awaitable）的函數；為 None 表示後續步驟本身會等待，
+            此時省下的時間仍會花在後續步驟上，不計入節省時間
+    """
+    start = time.perf_counter()
+    if Config.READINESS['legacy_sleeps']:
+        await asyncio.sleep(fallback)
+    elif signal is None:
+        return
+    else:
+        try:
+            await asyncio.wait_for(signal(), Config.READINESS['signal_timeout'])
+        except (asyncio.TimeoutError, PlaywrightTimeoutError):
+            logging.debug("等待就緒信號超時，繼續執行")
+    _record_wait(fallback, time.perf_counter() - start)
+
+@traced('server')
+async def tips_evaluate(page: Page, script: str, fallback: float):
+    """
+    執行 TIPS 的 JS 鉤子，並等待它提交後的新頁面（主頁面或 reportWin）載入完成
+
+    只等待響應或 load 狀態並不足夠：響應頭到達時舊頁面仍然顯示，且舊頁面早已 load，
+    之後檢查返回鏈接會看到舊頁面。
+    """
+    async with report_slot('preview'):
+        if Config.READINESS['legacy_sleeps']:
+            await page.evaluate(script)
+            await pace(fallback)
+            return
+
+        start = time.perf_counter()
+        navigated = asyncio.ensure_future(page.wait_for_event(
+            'framenavigated',
+            predicate=lambda frame: frame == page.main_frame or frame.name == 'reportWin',
+            timeout=Config.READINESS['signal_timeout'] * 1000,
+        ))
+        try:
+            await page.evaluate(script)
+            frame = await navigated
+            await frame.wait_for_load_state('load')
+        except PlaywrightTimeoutError:
+            note_timeout()
+            logging.debug(f"等待 {script} 提交後的頁面超時，繼續執行")
+        finally:
+            if not navigated.done():
+                navigated.cancel()
+        _record_wait(fallback, time.perf_counter() - start)
+
+class NavigationState:
+    """記錄頁面當前展開的菜單、所在模塊及 functionPage 中的功能頁"""
+
+    def __init__(self):
+        self.menu = None       # P1 展開的頂部菜單，例如 "A0"
+        self.function = None   # processfunction 打開的 (menu, sub_menu)
+        self.module = None     # 最近一個報表任務所屬的模塊
+        self.dirty = False     # 上一個任務失敗，頁面狀態不可信
+        self.home_reloads = 0
+        self.document = 0      # 主框架每載入一個新文件加 1
+        self.menu_document = None  # 執行 P1 時的文件
+
+    def reset(self):
+        self.menu = self.function = self.module = None
+        self.dirty = False
+
+    def document_changed(self):
+        """主框架載入了新文件（例如點擊 A/B/D 功能按鈕），菜單及功能頁需要重新打開"""
+        self.document += 1
+        self.menu = self.function = None
+
+_navigation_states = weakref.WeakKeyDictionary()
+
+def navigation_state(page: Page) -> NavigationState:
+    state = _navigation_states.get(page)
+    if state is None:
+        state = _navigation_states[page] = NavigationState()
+
+        def on_frame_navigated(frame, state=state):
+            if frame == page.main_frame:
+                state.document_changed()
+
+        page.on("framenavigated", on_frame_navigated)
+    return state
+
+@traced('navigate')
+async def enter_module(page: Page, module: str):
+    """
+    任務開始前按導航狀態決定是否需要返回主頁
+
+    同一模塊內的報表直接切換；只有換到另一個模塊、上一個任務失敗，
+    或頁面上已看不到導航欄時才重新載入主頁。
+    """
+    state = navigation_state(page)
+    if state.module is not None:
+        home_selector = Config.SELECTORS['navigation']['home']
+        if state.dirty or state.module != module or not await page.locator(home_selector).is_visible():
+            await return_to_home(page)
+    state.module = module
+
+@traced('navigate')
+async def open_menu(page: Page, menu_id: str):
+    """展開頂部菜單 (P1)，等待菜單腳本可用；菜單已在當前文件中展開時跳過"""
+    state = navigation_state(page)
+    if state.menu == menu_id and state.menu_document == state.document:
+        logging.debug(f"菜單 {menu_id} 已展開，跳過")
+        return
+    document = state.document
+    await page.evaluate(f'P1("{menu_id}")')
+    await pace(1, lambda: page.wait_for_function("() => typeof processfunction === 'function'"))
+    if state.document == document:
+        state.menu = menu_id
+        state.menu_document = document
+
+@traced('navigate')
+async def open_function(page: Page, menu: str, sub_menu: str):
+    """打開功能頁 (processfunction)，等待 functionPage iframe 完成導航"""
+    navigation_state(page).function = (menu, sub_menu)
+    script = f'processfunction("{menu}","{sub_menu}")'
+    if Config.READINESS['legacy_sleeps']:
+        await page.evaluate(script)
+        await pace(1)
+        return
+
+    start = time.perf_counter()
+    try:
+        async with page.expect_event('framenavigated', predicate=lambda f: f.name == 'functionPage',
+                                     timeout=Config.READINESS['signal_timeout'] * 1000) as frame_info:
+            await page.evaluate(script)
+        frame = await frame_info.value
+        await frame.wait_for_load_state('domcontentloaded')
+    except PlaywrightTimeoutError:
+        logging.debug(f"等待 functionPage 載入 {sub_menu} 超時，繼續執行")
+    _record_wait(1, time.perf_counter() - start)
+
+######## 就緒等待 _ END #########
+
+####### 下載發佈 Start #######
+_publish_trackers = contextvars.ContextVar('publish_trackers', default=())
+# 為恢復頁面狀態而在瀏覽器中重跑的前置任務：其文件已由直接請求取得，下載後不再發佈
+_navigation_only = contextvars.ContextVar('navigation_only', default=False)
+
+@contextlib.contextmanager
+def navigation_only():
+    token = _navigation_only.set(True)
+    try:
+        yield
+    finally:
+        _navigation_only.reset(token)
+
+class PublishTracker:
+    """記錄任務期間在後台發佈到網絡共享的文件"""
+
+    def __init__(self):
+        self.tasks = []
+
+    async def wait(self) -> bool:
+        """等待所有發佈完成，全部成功時返回 True"""
+        ok = True
+        for result in await asyncio.gather(*self.tasks, return_exceptions=True):
+            if isinstance(result, Exception):
+                logging.error(f"發佈文件到網絡共享失敗: {str(result)}")
+                ok = False
+        return ok
+
+@contextlib.contextmanager
+def track_publishes():
+    tracker = PublishTracker()
+    token = _publish_trackers.set(_publish_trackers.get() + (tracker,))
+    try:
+        yield tracker
+    finally:
+        _publish_trackers.reset(token)
+
+def staging_path(download_path: str, file_name: str) -> str:
+    """
+    為每次下載創建一個唯一的本地暫存文件；不同下載目錄各自使用獨立的暫存子目錄
+
+    同一報表重新下載時，上一次的後台發佈可能仍在讀取舊的暫存文件，因此不能重用同一路徑。
+    """
+    folder = hashlib.md5(download_path.encode('utf-8')).hexdigest()[:12]
+    local_dir = os.path.join(Config.STAGING['dir'], folder)
+    os.makedirs(local_dir, exist_ok=True)
+    stem, ext = os.path.splitext(file_name)
+    fd, local_path = tempfile.mkstemp(prefix=f"{stem}.", suffix=ext, dir=local_dir)
+    os.close(fd)
+    return local_path
+
+@traced('publish', detached=True)
+def publish_file(local_path: str, dest_path: str) -> str:
+    """
+    以大塊緩衝把本地文件流式寫入網絡共享，計算 SHA-256 後原子替換到目標位置
+
+    讀取方只會看到舊文件或完整的新文件，不會看到半寫入的文件。
+
+    Returns:
+        str: 文件的 SHA-256
+    """
+    chunk_size = Config.STAGING['chunk_size']
+    # 每次發佈使用各自的臨時文件，同一目標的並發發佈不會互相覆蓋
+    fd, partial_path = tempfile.mkstemp(prefix=f"{os.path.basename(dest_path)}.", suffix='.partial',
+                                        dir=os.path.dirname(dest_path) or None)
+    digest = hashlib.sha256()
+    written = 0
+    try:
+        with os.fdopen(fd, 'wb', buffering=chunk_size) as dst, open(local_path, 'rb') as src:
+            while True:
+                chunk = src.read(chunk_size)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                dst.write(chunk)
+                written += len(chunk)
+            dst.flush()
+            os.fsync(dst.fileno())
+
+        if os.path.getsize(partial_path) != written:
+            raise IOError(f"寫入大小不一致: {partial_path}")
+        if Config.STAGING['verify']:
+            check = hashlib.sha256()
+            with open(partial_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    check.update(chunk)
+            if check.hexdigest() != digest.hexdigest():
+                raise IOError(f"校驗和不一致: {partial_path}")
+
+        os.replace(partial_path, dest_path)
+    except Exception:
+        with contextlib.suppress(OSError):
+            os.remove(partial_path)
+        raise
+
+    os.remove(local_path)
+    logging.info(f"已發佈 {os.path.basename(dest_path)} ({written} bytes, sha256 {digest.hexdigest()[:12]})")
+    return digest.hexdigest()
+
+def publish_with_retry(local_path: str, dest_path: str) -> str:
+    """發佈文件，網絡共享暫時不可用時退避重試"""
+    attempt = 1
+    while True:
+        try:
+            return publish_file(local_path, dest_path)
+        except Exception as e:
+            if attempt > Config.RETRY['attempts']:
+                raise
+            delay = retry_delay(attempt)
+            logging.warning(f"發佈 {os.path.basename(dest_path)} 失敗: {str(e)}，{delay:.1f} 秒後重試")
+            time.sleep(delay)
+            attempt += 1
+
+async def _publish_and_queue(local_path: str, dest_path: str) -> str:
+    digest = await asyncio.to_thread(publish_with_retry, local_path, dest_path)
+    pipeline = _conversion_pipeline.get()
+    if pipeline is not None:
+        await pipeline.put(dest_path)
+    return digest
+
+def publish_in_background(local_path: str, dest_path: str):
+    """在線程池中發佈文件，瀏覽器會話無需等待網絡共享寫入；發佈後交給轉換流水線"""
+    if _navigation_only.get():
+        logging.info(f"{os.path.basename(dest_path)} 已由直接請求取得，本次下載只用於導航，不再發佈")
+        os.remove(local_path)
+        return None
+    task = asyncio.ensure_future(_publish_and_queue(local_path, dest_path))
+    for tracker in _publish_trackers.get():
+        tracker.tasks.append(task)
+    return task
+
+@traced('save')
+def stage_bytes(body: bytes, download_path: str, file_name: str) -> bool:
+    """把 HTTP 響應內容寫入本地暫存並排程發佈"""
+    local_path = staging_path(download_path, file_name)
+    with open(local_path, 'wb') as f:
+        f.write(body)
+    publish_in_background(local_path, os.path.join(download_path, file_name))
+    return True
+
+@contextlib.asynccontextmanager
+async def expect_download_or_no_data(page: Page, timeout: float):
+    """
+    與 page.expect_download 相同，但離開範圍時不再等待下載
+
+    TIPS 顯示返回鏈接（沒有數據）時可以直接返回，不會等到下載超時。
+    返回的對象與 expect_download 一樣以 .value 取得下載。
+    """
+    waiter = asyncio.ensure_future(page.wait_for_event('download', timeout=timeout))
+    try:
+        yield types.SimpleNamespace(value=waiter)
+    finally:
+        if not waiter.done():
+            waiter.cancel()
+        # 沒有被讀取的結果或異常不再報告
+        waiter.add_done_callback(lambda future: future.cancelled() or future.exception())
+
+@traced('download')
+async def wait_for_download(download_info):
+    """等待瀏覽器開始下載，即 TIPS 生成並返回報表的時間"""
+    try:
+        return await download_info.value
+    except PlaywrightTimeoutError:
+        note_timeout()
+        raise
+
+@traced('save')
+async def save_download(download, download_path: str, file_name: str) -> bool:
+    """
+    把 Playwright 下載保存到本地暫存，檢查大小後在後台發佈到下載目錄
+
+    save_as 返回時文件已完整寫入本地，因此不再需要輪詢文件大小。
+    """
+    local_path = staging_path(download_path, file_name)
+    await download.save_as(local_path)
+    file_size = os.path.getsize(local_path)
+    if file_size == 0:
+        logging.warning("警告：下載的文件大小為0字節")
+        os.remove(local_path)
         return False
+    logging.info(f"下載成功！文件大小: {file_size} bytes")
+    publish_in_background(local_path, os.path.join(download_path, file_name))
+    return True
+
+async def finish_publishes(company_results: list):
+    """等待各任務的後台發佈完成；發佈失敗的任務標記為失敗"""
+    for result in company_results:
+        tracker = result.pop('publish', None)
+        if tracker and not await tracker.wait() and result['success']:
+            logging.warning(f"{result['task']} 已下載但未能發佈到網絡共享")
+            result['success'] = False
+
+######## 下載發佈 _ END #########
+
+####### 會話重用 Start #######
+def session_state_path(company: str) -> str:
+    return os.path.join(Config.SESSIONS['dir'], f"{company}.json")
+
+def load_session_state(company: str) -> Optional[str]:
+    """返回仍在有效期內的會話文件路徑，否則返回 None"""
+    path = session_state_path(company)
+    try:
+        age = time.time() - os.path.getmtime(path)
+    except OSError:
+        return None
+    if age > Config.SESSIONS['max_age']:
+        logging.info(f"公司 {company} 的會話已保存 {age / 3600:.1f} 小時，需要重新登錄")
+        return None
+    return path
+
+async def save_session_state(context, company: str):
+    """保存 cookies 與 storage state，供之後的運行或重試直接重用"""
+    try:
+        os.makedirs(Config.SESSIONS['dir'], exist_ok=True)
+        await context.storage_state(path=session_state_path(company))
+        logging.info(f"已保存公司 {company} 的會話")
     except Exception as e:
-        logging.error(f"處理彈出窗口時發生錯誤: {str(e)}")
+        logging.warning(f"保存公司 {company} 的會話失敗: {str(e)}")
+
+def discard_session_state(company: str):
+    try:
+        os.remove(session_state_path(company))
+    except OSError:
+        pass
+
+async def probe_session(page: Page) -> bool:
+    """打開主頁並確認仍處於登錄狀態：沒有被重定向到登錄頁且能看到 Sales 菜單"""
+    try:
+        await page.goto(Config.HOME_URL, wait_until='domcontentloaded', timeout=Config.TIMEOUTS['popup'])
+        if '_security/login' in page.url or 'Login.do' in page.url:
+            return False
+        sales_selector = Config.SELECTORS['navigation']['sales_menu']
+        await page.wait_for_selector(sales_selector, state="visible", timeout=Config.SESSIONS['probe_timeout'])
+        return True
+    except Exception as e:
+        logging.info(f"會話驗證失敗: {str(e)}")
         return False
-    
-def wait_for_popup(page: Page) -> Optional[Page]:
+
+@traced('login')
+async def open_company_session(browser, company: str):
+    """
+    為公司打開已登錄的 context，優先重用保存的會話，失效時才完整登錄
+
+    Returns:
+        tuple: (context, 已登錄的頁面)；登錄失敗時頁面為 None
+    """
+    state_path = load_session_state(company)
+    if state_path:
+        context = await new_browser_context(browser, storage_state=state_path)
+        page = await new_page(context)
+        if await probe_session(page):
+            logging.info(f"公司 {company} 重用已保存的會話，跳過登錄")
+            return context, page
+        logging.info(f"公司 {company} 的已保存會話無效，重新登錄")
+        discard_session_state(company)
+        await context.close()
+
+    context = await new_browser_context(browser)
+    page = await new_page(context)
+
+    username = f"{company}.OM079"
+    password = "0000"
+
+    popup_page = await wait_for_popup(page)
+    if not popup_page:
+        logging.error("無法打開彈出窗口")
+        return context, None
+
+    logged_in_page = await login_system(popup_page, username, password)
+    if logged_in_page:
+        await save_session_state(context, company)
+    return context, logged_in_page
+
+######## 會話重用 _ END #########
+
+####### 直接 HTTP 下載 Start #######
+_form_payloads = None
+
+def load_form_payloads() -> dict:
+    """讀取已記錄的報表表單（首次調用時從文件載入）"""
+    global _form_payloads
+    if _form_payloads is None:
+        try:
+            with open(Config.DIRECT_HTTP['payload_file'], 'r', encoding='utf-8') as f:
+                _form_payloads = json.load(f)
+        except FileNotFoundError:
+            _form_payloads = {}
+        except Exception as e:
+            logging.warning(f"讀取表單記錄失敗，將重新記錄: {str(e)}")
+            _form_payloads = {}
+    return _form_payloads
+
+def form_payload_key(report: str, company: Optional[str] = None) -> str:
+    """表單按 (公司, 報表) 分開記錄：隱藏欄位可能帶有公司資料，不能在其他公司的會話中重放"""
+    if company is None:
+        company = _span_labels.get().get('company', '')
+    return f"{company}/{report}"
+
+def _save_form_payloads(report: str):
+    """寫入臨時文件後再替換，避免半寫入的記錄"""
+    payload_file = Config.DIRECT_HTTP['payload_file']
+    tmp_file = f"{payload_file}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(load_form_payloads(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, payload_file)
+        return True
+    except Exception as e:
+        logging.warning(f"保存 {report} 表單記錄失敗: {str(e)}")
+        return False
+
+def remember_form_payload(report: str, url: str, fields: dict):
+    """保存當前公司該報表最終提交的表單"""
+    load_form_payloads()[form_payload_key(report)] = {'url': url, 'fields': fields}
+    if _save_form_payloads(report):
+        logging.info(f"已記錄 {report} 的表單，共 {len(fields)} 個欄位")
+
+def forget_form_payload(report: str):
+    """刪除當前公司該報表的表單記錄，下次改用瀏覽器流程並重新記錄"""
+    if load_form_payloads().pop(form_payload_key(report), None) is not None:
+        _save_form_payloads(report)
+
+async def record_form_payload(page: Page, report: str):
+    """在瀏覽器流程提交下載前，抓取當前表單以供之後直接重放"""
+    spec = Config.DIRECT_REPORTS[report]
     try:
-        with page.expect_popup(timeout=Config.TIMEOUTS['popup']) as popup_info:
-            page.goto(Config.INITIAL_URL)
-        popup_page = popup_info.value
+        payload = await page.evaluate('''([formName, anchor]) => {
+            let form = formName ? document.forms[formName] : null;
+            if (!form && anchor) {
+                const el = document.querySelector(anchor);
+                form = el ? el.form : null;
+            }
+            form = form || document.forms[0];
+            if (!form) {
+                return null;
+            }
+            const fields = {};
+            for (let element of form.elements) {
+                if (!element.name) continue;
+                if ((element.type === 'checkbox' || element.type === 'radio') && !element.checked) continue;
+                fields[element.name] = element.value;
+            }
+            return {url: form.getAttribute('action') ? form.action : location.href, fields: fields};
+        }''', [spec.get('form'), spec.get('anchor')])
+        if payload:
+            remember_form_payload(report, payload['url'], payload['fields'])
+    except Exception as e:
+        logging.warning(f"記錄 {report} 表單失敗: {str(e)}")
+
+def direct_reports(company: Optional[str] = None) -> set:
+    """該公司已記錄表單、可以直接請求的報表"""
+    payloads = load_form_payloads()
+    return {report for report in Config.DIRECT_REPORTS if form_payload_key(report, company) in payloads}
+
+def _render_fields(report: str, target_date: str) -> dict:
+    recorded = load_form_payloads()[form_payload_key(report)]['fields']
+    prev_month = (datetime.strptime(target_date, "%Y%m%d") - relativedelta(months=1)).strftime("%Y%m%d")
+    fields = dict(recorded)
+    for name, value in Config.DIRECT_REPORTS[report]['fields'].items():
+        fields[name] = value.format(date=target_date, prev_month=prev_month)
+    fields['actionCode'] = '6'
+    fields['alias'] = '6'
+    return fields
+
+@traced('http')
+async def fetch_report_direct(request, report: str, download_path: str, target_date: str) -> bool:
+    """
+    以已記錄的表單直接 POST 取得報表，不經過瀏覽器界面
+
+    Args:
+        request: 帶有登錄會話 cookie 的 APIRequestContext（context.request）
+        report: DIRECT_REPORTS 中的報表名稱
+        download_path: 下載目錄
+        target_date: 報表日期 (YYYYMMDD)
+    """
+    try:
+        file_name = REPORT_TASKS_BY_NAME[report]['output'].format(date=target_date)
+        url = load_form_payloads()[form_payload_key(report)]['url']
+        fields = _render_fields(report, target_date)
+
+        logging.info(f"直接請求 {report} 報表...")
+        async with report_slot('direct'):
+            response = await request.post(url, form=fields, timeout=Config.TIMEOUTS['download'])
+        if not response.ok:
+            logging.error(f"{report} 請求失敗，狀態碼: {response.status}")
+            return False
+
+        body = await response.body()
+        content_type = response.headers.get('content-type', '').lower()
+        disposition = response.headers.get('content-disposition', '').lower()
+        if not body:
+            logging.error(f"{report} 返回空內容")
+            return False
+        if 'text/html' in content_type and b'go_back' in body:
+            logging.info(f"{report} 沒有可下載的報表")
+            mark_no_data()
+            return False
+        # 會話過期後的登錄頁、預覽頁或錯誤頁同樣返回 200 text/html，不能當作報表保存
+        is_file = 'attachment' in disposition or (
+            file_name.endswith(('.pdf', '.csv')) and content_type and 'text/html' not in content_type)
+        if not is_file or (file_name.endswith('.pdf') and not body.startswith(b'%PDF')):
+            logging.warning(f"{report} 返回的不是報表文件 ({content_type or '未知類型'})，"
+                            f"刪除表單記錄並改用瀏覽器下載")
+            forget_form_payload(report)
+            return False
+
+        logging.info(f"{report} 下載成功！文件大小: {len(body)} bytes")
+        return stage_bytes(body, download_path, file_name)
+    except Exception as e:
+        logging.error(f"直接請求 {report} 時發生錯誤: {str(e)}")
+        return False
+
+######## 直接 HTTP 下載 _ END #########
+
+async def close_download_message(page: Page):
+    """
+    context 的 "page" 事件處理：新窗口載入後按標題分類，下載消息窗口立即關閉
+
+    由 new_browser_context 訂閱，下載函數不需要再檢查彈出窗口。
+    """
+    try:
+        await page.wait_for_load_state('domcontentloaded', timeout=Config.TIMEOUTS['popup'])
+        if "Download Message" in await page.title():
+            logging.info("檢測到下載消息窗口")
+            # 由於沒有明確的關閉按鈕，我們直接關閉這個頁面
+            await page.close()
+            logging.info("已關閉下載消息窗口")
+    except Exception as e:
+        logging.debug(f"檢查新窗口時發生錯誤: {str(e)}")
+
+async def wait_for_popup(page: Page) -> Optional[Page]:
+    try:
+        async with page.expect_popup(timeout=Config.TIMEOUTS['popup']) as popup_info:
+            await page.goto(Config.INITIAL_URL)
+        popup_page = await popup_info.value
+        # 登錄頁在資源攔截設定完成後才繼續操作
+        await block_page_resources(popup_page)
         logging.info(f"彈出窗口已打開，URL: {popup_page.url}")
         return popup_page
     except Exception as e:
         logging.error(f"等待彈出窗口時發生錯誤: {str(e)}")
         return None
 
-def login_system(page: Page, username: str, password: str) -> Optional[Page]:
+async def login_system(page: Page, username: str, password: str) -> Optional[Page]:
     try:
         logging.info(f"正在登錄，當前頁面 URL: {page.url}")
-        page.wait_for_load_state('networkidle')
+        await page.wait_for_load_state('networkidle')
         
         selectors = Config.SELECTORS['login']
         for selector in selectors.values():
-            page.wait_for_selector(selector, state="visible", timeout=Config.TIMEOUTS['element'])
+            await page.wait_for_selector(selector, state="visible", timeout=Config.TIMEOUTS['element'])
         
-        page.fill(selectors['username'], username)
-        time.sleep(0.5)
-        page.fill(selectors['password'], password)
-        time.sleep(0.5)
-        with page.expect_navigation():
-            page.click(selectors['submit'])
+        await page.fill(selectors['username'], username)
+        await pace(0.5)
+        await page.fill(selectors['password'], password)
+        await pace(0.5)
+        async with page.expect_navigation():
+            await page.click(selectors['submit'])
         
-        page.wait_for_load_state('networkidle')
+        await page.wait_for_load_state('networkidle')
         logging.info(f"登錄完成，當前頁面 URL: {page.url}")
         return page
     except Exception as e:
         logging.error(f"登錄過程中發生錯誤: {str(e)}")
-        page.screenshot(path="login_error.png")
+        await page.screenshot(path="login_error.png")
         return None
 
-def return_to_home(page: Page):
+@traced('navigate')
+async def return_to_home(page: Page):
     """返回系統主頁"""
     try:
         logging.info("返回主頁...")
         home_selector = Config.SELECTORS['navigation']['home']
-        page.wait_for_selector(home_selector, state="visible", timeout=Config.TIMEOUTS['element'])
-        page.evaluate('''() => {
+        await page.wait_for_selector(home_selector, state="visible", timeout=Config.TIMEOUTS['element'])
+        await page.evaluate('''() => {
             lock();
             window.top.location.href = '/tips/index.jsp';
         }''')
-        page.wait_for_load_state('networkidle')
-        time.sleep(1)
+        await page.wait_for_load_state('networkidle')
+        await pace(1, lambda: page.wait_for_selector(home_selector, state="visible"))
+        state = navigation_state(page)
+        state.reset()
+        state.home_reloads += 1
         logging.info("已返回主頁")
     except Exception as e:
         logging.error(f"返回主頁時發生錯誤: {str(e)}")
         raise
 
-def print_daily_product_audit(login_page: Page, download_path: str, target_date: str) -> bool:
+async def print_daily_product_audit(login_page: Page, download_path: str, target_date: str) -> bool:
     try:
         logging.info("開始下載 Daily Product Audit 報表...")
 
         logging.info("點擊 Sales 菜單...")
         sales_selector = Config.SELECTORS['navigation']['sales_menu']
-        login_page.wait_for_selector(sales_selector, state="visible", timeout=Config.TIMEOUTS['element'])
-        login_page.evaluate('P1("A0")')
-        time.sleep(1)
+        await login_page.wait_for_selector(sales_selector, state="visible", timeout=Config.TIMEOUTS['element'])
+        await open_menu(login_page, "A0")
         
         logging.info("點擊 Sales Management...")
-        login_page.evaluate('processfunction("SOF","SO1")')
-        time.sleep(1)
+        await open_function(login_page, "SOF", "SO1")
         
         frame = login_page.frame_locator('iframe[name="functionPage"]')
         a_button_selector = Config.SELECTORS['audit']['a_button']
-        frame.locator(a_button_selector).wait_for(state="visible", timeout=Config.TIMEOUTS['element'])
-        frame.locator(a_button_selector).click()
+        await frame.locator(a_button_selector).wait_for(state="visible", timeout=Config.TIMEOUTS['element'])
+        await frame.locator(a_button_selector).click()
         
-        login_page.wait_for_load_state('networkidle')
-        time.sleep(1)
+        await login_page.wait_for_load_state('networkidle')
+        await pace(1)
         
         date_selector = Config.SELECTORS['audit']['date']
-        login_page.wait_for_selector(date_selector, state="visible", timeout=Config.TIMEOUTS['element'])
-        login_page.fill(date_selector, target_date)
+        await login_page.wait_for_selector(date_selector, state="visible", timeout=Config.TIMEOUTS['element'])
+        await login_page.fill(date_selector, target_date)
         
         select_selector = Config.SELECTORS['audit']['format_select']
-        login_page.wait_for_selector(select_selector, state="visible", timeout=Config.TIMEOUTS['element'])
-        login_page.select_option(select_selector, 'xls')
+        await login_page.wait_for_selector(select_selector, state="visible", timeout=Config.TIMEOUTS['element'])
+        await login_page.select_option(select_selector, 'xls')
         
-        login_page.evaluate('process("6")')
-        time.sleep(2)
+        await tips_evaluate(login_page, 'process("6")', 2)
 
         report_frame = login_page.frame_locator('iframe[name="reportWin"]')
         back_selector = Config.SELECTORS['audit']['back_link']
 
-        if report_frame.locator(back_selector).is_visible(timeout=1500):
+        if await report_frame.locator(back_selector).is_visible(timeout=1500):
             logging.info("需要返回上一頁")
-            report_frame.locator(back_selector).click()
-            time.sleep(0.5)
+            mark_no_data()
+            await report_frame.locator(back_selector).click()
+            await pace(0.5)
             logging.info("已返回上一頁")
             return False  # 直接返回，不再繼續執行下載操作
 
         # 只有在沒有看到"返回"按鈕時才執行下載操作
-        with login_page.expect_download(timeout=Config.TIMEOUTS['download']) as download_info:
+        async with report_slot('download'), login_page.expect_download(timeout=Config.TIMEOUTS['download']) as download_info:
             logging.info("點擊 Confirm 按鈕...")
+            await record_form_payload(login_page, 'Daily Product Audit')
             confirm_button = login_page.locator("input[type='button'][value='Confirm'][onclick=\"process('6');\"]")
-            confirm_button.click()
+            await confirm_button.click()
 
             try:
-                download = download_info.value
+                download = await wait_for_download(download_info)
                 logging.info("下載已開始，等待完成...")
 
                 download_file_name = f"Daily_Product_Audit.xls"
-                download_file_path = os.path.join(download_path, download_file_name)
-                
-                download.save_as(download_file_path)
-                
-                max_wait_time = 20
-                start_time = time.time()
-                while time.time() - start_time < max_wait_time:
-                    if os.path.exists(download_file_path):
-                        file_size = os.path.getsize(download_file_path)
-                        if file_size > 0:
-                            logging.info(f"下載成功！文件大小: {file_size} bytes")
-                            return True
-                    time.sleep(1)
-
-                logging.error("文件下載超時或文件大小為0")
-                return False
+                return await save_download(download, download_path, download_file_name)
 
             except TimeoutError:
                 logging.error("下載超時")
@@ -239,7 +1369,7 @@ def print_daily_product_audit(login_page: Page, download_path: str, target_date:
 
     return False
 
-def print_monthly_uncollect(login_page: Page, download_path: str, target_date: str) -> bool:
+async def print_monthly_uncollect(login_page: Page, download_path: str, target_date: str) -> bool:
     try:
         logging.info("開始下載 Monthly Uncollect 報表...")
 
@@ -249,158 +1379,130 @@ def print_monthly_uncollect(login_page: Page, download_path: str, target_date: s
         
         logging.info("點擊 Sales 菜單...")
         sales_selector = Config.SELECTORS['navigation']['sales_menu']
-        login_page.wait_for_selector(sales_selector, state="visible", timeout=Config.TIMEOUTS['element'])
-        login_page.evaluate('P1("A0")')
-        time.sleep(1)
+        await login_page.wait_for_selector(sales_selector, state="visible", timeout=Config.TIMEOUTS['element'])
+        await open_menu(login_page, "A0")
 
         logging.info("點擊 Sales Management...")
-        login_page.evaluate('processfunction("SOF","SO1")')
-        time.sleep(1)
+        await open_function(login_page, "SOF", "SO1")
         
         logging.info("等待並點擊 B 按鈕...")
         frame = login_page.frame_locator('iframe[name="functionPage"]')
         b_button_selector = Config.SELECTORS['monthly_uncollect']['b_button']
-        frame.locator(b_button_selector).wait_for(state="visible", timeout=Config.TIMEOUTS['element'])
-        frame.locator(b_button_selector).click()
+        await frame.locator(b_button_selector).wait_for(state="visible", timeout=Config.TIMEOUTS['element'])
+        await frame.locator(b_button_selector).click()
         
-        login_page.wait_for_load_state('networkidle')
-        time.sleep(1)
+        await login_page.wait_for_load_state('networkidle')
+        await pace(1)
         
         logging.info(f"填寫日期範圍: {target_date_1} 到 {target_date}")
         start_date_selector = Config.SELECTORS['monthly_uncollect']['start_date']
-        login_page.wait_for_selector(start_date_selector, state="visible", timeout=Config.TIMEOUTS['element'])
-        login_page.fill(start_date_selector, target_date_1)
-        time.sleep(0.1)
+        await login_page.wait_for_selector(start_date_selector, state="visible", timeout=Config.TIMEOUTS['element'])
+        await login_page.fill(start_date_selector, target_date_1)
+        await pace(0.1)
         
         end_date_selector = Config.SELECTORS['monthly_uncollect']['end_date']
-        login_page.wait_for_selector(end_date_selector, state="visible", timeout=Config.TIMEOUTS['element'])
-        login_page.fill(end_date_selector, target_date)
+        await login_page.wait_for_selector(end_date_selector, state="visible", timeout=Config.TIMEOUTS['element'])
+        await login_page.fill(end_date_selector, target_date)
         
         logging.info("開始處理報表...")
-        login_page.evaluate('process("6")')
-        time.sleep(2)
+        await tips_evaluate(login_page, 'process("6")', 2)
         
         report_frame = login_page.frame_locator('iframe[name="reportWin"]')
         back_selector = Config.SELECTORS['monthly_uncollect']['back_link']
         
         special_back_button = login_page.locator("#go_back")
-        if special_back_button.is_visible(timeout=1500):
+        if await special_back_button.is_visible(timeout=1500):
             logging.info("檢測到特殊的返回按鈕，點擊返回")
-            special_back_button.click()
-            time.sleep(1)
+            await special_back_button.click()
+            await pace(1)
             logging.info("沒有可下載的報表")
+            mark_no_data()
             return False
 
         logging.info("開始下載報表...")
-        with login_page.expect_download(timeout=Config.TIMEOUTS['download']) as download_info:
-            login_page.evaluate('process("6")')
-            time.sleep(2)  # 給系統時間來響應
+        async with report_slot('download'), \
+                expect_download_or_no_data(login_page, Config.TIMEOUTS['download']) as download_info:
+            await record_form_payload(login_page, 'Monthly Uncollect')
+            await login_page.evaluate('process("6")')
+            # 等待下載開始或出現返回鏈接，取代原來給系統響應的固定等待
+            await pace(2, lambda: first_signal(
+                asyncio.shield(download_info.value),
+                report_frame.locator(back_selector).wait_for(state="visible"),
+            ))
 
             report_frame = login_page.frame_locator('iframe[name="reportWin"]')
             back_selector = Config.SELECTORS['monthly_uncollect']['back_link']
 
-            if report_frame.locator(back_selector).is_visible(timeout=1500):
+            if await report_frame.locator(back_selector).is_visible(timeout=1500):
                 logging.info("需要返回上一頁")
-                report_frame.locator(back_selector).click()
-                login_page.wait_for_load_state('networkidle')
+                mark_no_data()
+                await report_frame.locator(back_selector).click()
+                await login_page.wait_for_load_state('networkidle')
                 return False
 
-            download = download_info.value
+            download = await wait_for_download(download_info)
             download_file_name = "Month_Uncollect.xls"  # 使用固定文件名
-            download_file_path = os.path.join(download_path, download_file_name)
-
-            download.save_as(download_file_path)
-            logging.info(f"文件已嘗試保存到: {download_file_path}")
-            if close_popup_during_download(login_page):
-                logging.info("已處理下載消息窗口")
-
-            if os.path.exists(download_file_path):
-                file_size = os.path.getsize(download_file_path)
-                logging.info(f"下載成功！文件大小: {file_size} bytes")
-                return True
-            else:
-                logging.error("文件下載失敗或找不到文件")
-                return False
+            return await save_download(download, download_path, download_file_name)
 
     except Exception as e:
         logging.error(f"執行過程中發生錯誤: {str(e)}")
         return False
-    finally:
-        try:
-            time.sleep(1)
-            return_to_home(login_page)
-        except Exception as e:
-            logging.error(f"返回主頁失敗: {str(e)}")
 
-def print_uncollected_order_detail(login_page: Page, download_path: str, target_date: str) -> bool:
+async def print_uncollected_order_detail(login_page: Page, download_path: str, target_date: str) -> bool:
     try:
         logging.info("開始下載 Uncollected Order Detail 報表...")
 
         logging.info("點擊 Collection Management...")
-        login_page.evaluate('processfunction("SOF","SO2")')
-        time.sleep(1)
+        await open_function(login_page, "SOF", "SO2")
 
         frame = login_page.frame_locator('iframe[name="functionPage"]')
         d_button_selector = Config.SELECTORS['uncollected']['d_button']
-        frame.locator(d_button_selector).wait_for(state="visible", timeout=Config.TIMEOUTS['element'])
-        frame.locator(d_button_selector).click()
+        await frame.locator(d_button_selector).wait_for(state="visible", timeout=Config.TIMEOUTS['element'])
+        await frame.locator(d_button_selector).click()
 
-        login_page.wait_for_load_state('networkidle')
-        time.sleep(1)
+        await login_page.wait_for_load_state('networkidle')
+        await pace(1)
 
         start_date_selector = Config.SELECTORS['uncollected']['start_date']
-        login_page.wait_for_selector(start_date_selector, state="visible", timeout=Config.TIMEOUTS['element'])
-        login_page.fill(start_date_selector, target_date)
-        time.sleep(0.1)
+        await login_page.wait_for_selector(start_date_selector, state="visible", timeout=Config.TIMEOUTS['element'])
+        await login_page.fill(start_date_selector, target_date)
+        await pace(0.1)
 
         end_date_selector = Config.SELECTORS['uncollected']['end_date']
-        login_page.wait_for_selector(end_date_selector, state="visible", timeout=Config.TIMEOUTS['element'])
-        login_page.fill(end_date_selector, target_date)
+        await login_page.wait_for_selector(end_date_selector, state="visible", timeout=Config.TIMEOUTS['element'])
+        await login_page.fill(end_date_selector, target_date)
 
         logging.info("點擊第一個 Confirm 按鈕...")
         confirm_button = login_page.locator("input.BTN_PWR[type='button'][value='Confirm'][onclick=\"process('6');\"]")
-        confirm_button.click()
+        await confirm_button.click()
 
-        login_page.wait_for_load_state('networkidle')
-        time.sleep(2)
+        await login_page.wait_for_load_state('networkidle')
+        await pace(2, lambda: login_page.wait_for_load_state('load'))
 
         report_frame = login_page.frame_locator('iframe[name="reportWin"]')
         back_selector = Config.SELECTORS['uncollected']['back_link']
 
-        if report_frame.locator(back_selector).is_visible(timeout=1500):
+        if await report_frame.locator(back_selector).is_visible(timeout=1500):
             logging.info("需要返回上一頁")
-            report_frame.locator(back_selector).click()
-            time.sleep(0.5)
+            mark_no_data()
+            await report_frame.locator(back_selector).click()
+            await pace(0.5)
             logging.info("已返回上一頁")
             return False  # 直接返回，不再繼續執行下載操作
 
         # 只有在沒有看到"返回"按鈕時才執行下載操作
-        with login_page.expect_download(timeout=Config.TIMEOUTS['download']) as download_info:
+        async with report_slot('download'), login_page.expect_download(timeout=Config.TIMEOUTS['download']) as download_info:
             logging.info("點擊第二個 Confirm 按鈕...")
+            await record_form_payload(login_page, 'Uncollected Order Detail')
             confirm_button = login_page.locator("input[type='button'][value='Confirm'][onclick=\"process('6');\"]")
-            confirm_button.click()
+            await confirm_button.click()
 
             try:
-                download = download_info.value
+                download = await wait_for_download(download_info)
                 logging.info("下載已開始，等待完成...")
 
                 download_file_name = f"Uncollected_Order_Detail_{target_date}.xls"
-                download_file_path = os.path.join(download_path, download_file_name)
-                
-                download.save_as(download_file_path)
-                
-                max_wait_time = 20
-                start_time = time.time()
-                while time.time() - start_time < max_wait_time:
-                    if os.path.exists(download_file_path):
-                        file_size = os.path.getsize(download_file_path)
-                        if file_size > 0:
-                            logging.info(f"下載成功！文件大小: {file_size} bytes")
-                            return True
-                    time.sleep(1)
-
-                logging.error("文件下載超時或文件大小為0")
-                return False
+                return await save_download(download, download_path, download_file_name)
 
             except TimeoutError:
                 logging.error("下載超時")
@@ -412,7 +1514,7 @@ def print_uncollected_order_detail(login_page: Page, download_path: str, target_
 
     return False
 
-def print_collections(login_page: Page, download_path: str, target_date: str) -> bool:
+async def print_collections(login_page: Page, download_path: str, target_date: str) -> bool:
     try:
         logging.info("開始下載 Print Collections 報表...")
 
@@ -421,65 +1523,49 @@ def print_collections(login_page: Page, download_path: str, target_date: str) ->
         
         logging.info("點擊 E 按鈕...")
         e_button_selector = Config.SELECTORS['collections']['e_button']
-        frame.locator(e_button_selector).wait_for(state="visible", timeout=Config.TIMEOUTS['element'])
-        frame.locator(e_button_selector).click()
+        await frame.locator(e_button_selector).wait_for(state="visible", timeout=Config.TIMEOUTS['element'])
+        await frame.locator(e_button_selector).click()
         
-        login_page.wait_for_load_state('networkidle')
-        time.sleep(1)
+        await login_page.wait_for_load_state('networkidle')
+        await pace(1)
         
         logging.info(f"填寫日期: {target_date}")
         date_selector = Config.SELECTORS['collections']['date']
-        login_page.wait_for_selector(date_selector, state="visible", timeout=Config.TIMEOUTS['element'])
-        login_page.fill(date_selector, target_date)
+        await login_page.wait_for_selector(date_selector, state="visible", timeout=Config.TIMEOUTS['element'])
+        await login_page.fill(date_selector, target_date)
         
         logging.info("選擇 Excel 格式...")
         select_selector = Config.SELECTORS['collections']['format_select']
-        login_page.wait_for_selector(select_selector, state="visible", timeout=Config.TIMEOUTS['element'])
-        login_page.select_option(select_selector, 'xls')
+        await login_page.wait_for_selector(select_selector, state="visible", timeout=Config.TIMEOUTS['element'])
+        await login_page.select_option(select_selector, 'xls')
         
         logging.info("開始處理報表...")
-        login_page.evaluate('process("6")')
-        time.sleep(2)
+        await tips_evaluate(login_page, 'process("6")', 2)
 
         # 等待頁面加載
-        login_page.wait_for_load_state('networkidle')
-        time.sleep(1)
+        await login_page.wait_for_load_state('networkidle')
+        await pace(1)
 
         # 檢查是否出現特殊的返回按鈕
         special_back_button = login_page.locator("#go_back")
-        if special_back_button.is_visible(timeout=1500):
+        if await special_back_button.is_visible(timeout=1500):
             logging.info("檢測到特殊的返回按鈕，點擊返回")
-            special_back_button.click()
-            time.sleep(1)
+            await special_back_button.click()
+            await pace(1)
             logging.info("沒有可下載的報表")
+            mark_no_data()
             return False
 
         # 如果沒有特殊返回按鈕，進行下載
         logging.info("開始下載報表...")
-        with login_page.expect_download(timeout=Config.TIMEOUTS['download']) as download_info:
+        async with report_slot('download'), login_page.expect_download(timeout=Config.TIMEOUTS['download']) as download_info:
             try:
-                login_page.evaluate('process("6")')
-                time.sleep(2)
-                download = download_info.value
+                await record_form_payload(login_page, 'Print Collections')
+                await login_page.evaluate('process("6")')
+                await pace(2)
+                download = await wait_for_download(download_info)
                 download_file_name = f"Collections.xls"
-                download_file_path = os.path.join(download_path, download_file_name)
-                
-                download.save_as(download_file_path)
-                
-                max_wait_time = 20
-                start_time = time.time()
-                while time.time() - start_time < max_wait_time:
-                    if close_popup_during_download(login_page):
-                        logging.info("已處理下載消息窗口")
-                    if os.path.exists(download_file_path):
-                        file_size = os.path.getsize(download_file_path)
-                        if file_size > 0:
-                            logging.info(f"下載成功！文件大小: {file_size} bytes")
-                            return True
-                    time.sleep(1)
-
-                logging.error("文件下載超時或文件大小為0")
-                return False
+                return await save_download(download, download_path, download_file_name)
 
             except TimeoutError:
                 logging.error("下載超時")
@@ -491,69 +1577,52 @@ def print_collections(login_page: Page, download_path: str, target_date: str) ->
 
     return False
 
-def print_exchange_invoice(login_page: Page, download_path: str, target_date: str) -> bool:
+async def print_exchange_invoice(login_page: Page, download_path: str, target_date: str) -> bool:
     try:
         logging.info("開始處理 Exchange Invoice 報表...")
 
         logging.info("點擊 Exchange Invoice...")
-        login_page.evaluate('processfunction("SOF","SO3")')
-        time.sleep(1)
+        await open_function(login_page, "SOF", "SO3")
 
         logging.info("切換到 iframe...")
         frame = login_page.frame_locator('iframe[name="functionPage"]')
 
         logging.info("點擊 D 按鈕...")
         d_button_selector = Config.SELECTORS['exchange_invoice']['d_button']
-        frame.locator(d_button_selector).wait_for(state="visible", timeout=Config.TIMEOUTS['element'])
-        frame.locator(d_button_selector).click()
+        await frame.locator(d_button_selector).wait_for(state="visible", timeout=Config.TIMEOUTS['element'])
+        await frame.locator(d_button_selector).click()
 
-        login_page.wait_for_load_state('networkidle')
-        time.sleep(1)
+        await login_page.wait_for_load_state('networkidle')
+        await pace(1)
 
         logging.info(f"填寫日期: {target_date}")
         date_selector = Config.SELECTORS['exchange_invoice']['date']
-        login_page.wait_for_selector(date_selector, state="visible", timeout=Config.TIMEOUTS['element'])
-        login_page.fill(date_selector, target_date)
+        await login_page.wait_for_selector(date_selector, state="visible", timeout=Config.TIMEOUTS['element'])
+        await login_page.fill(date_selector, target_date)
 
         logging.info("開始處理報表...")
-        login_page.evaluate('process("6")')
-        time.sleep(2)
+        await tips_evaluate(login_page, 'process("6")', 2)
 
         # 檢查是否出現特殊的返回按鈕
         special_back_button = login_page.locator("#go_back")
-        if special_back_button.is_visible(timeout=1500):
+        if await special_back_button.is_visible(timeout=1500):
             logging.info("檢測到特殊的返回按鈕，點擊返回")
-            special_back_button.click()
-            time.sleep(1)
+            await special_back_button.click()
+            await pace(1)
             logging.info("沒有可下載的報表")
+            mark_no_data()
             return False
 
         # 如果沒有特殊返回按鈕，進行下載
         logging.info("開始下載報表...")
-        with login_page.expect_download(timeout=Config.TIMEOUTS['download']) as download_info:
+        async with report_slot('download'), login_page.expect_download(timeout=Config.TIMEOUTS['download']) as download_info:
             try:
-                login_page.evaluate('process("6")')
-                time.sleep(2)
-                download = download_info.value
+                await record_form_payload(login_page, 'Exchange Invoice')
+                await login_page.evaluate('process("6")')
+                await pace(2)
+                download = await wait_for_download(download_info)
                 download_file_name = f"Exchange_Invoice.xls"
-                download_file_path = os.path.join(download_path, download_file_name)
-                
-                download.save_as(download_file_path)
-                
-                max_wait_time = 20
-                start_time = time.time()
-                while time.time() - start_time < max_wait_time:
-                    if close_popup_during_download(login_page):
-                        logging.info("已處理下載消息窗口")
-                    if os.path.exists(download_file_path):
-                        file_size = os.path.getsize(download_file_path)
-                        if file_size > 0:
-                            logging.info(f"下載成功！文件大小: {file_size} bytes")
-                            return True
-                    time.sleep(1)
-
-                logging.error("文件下載超時或文件大小為0")
-                return False
+                return await save_download(download, download_path, download_file_name)
 
             except TimeoutError:
                 logging.error("下載超時")
@@ -565,54 +1634,39 @@ def print_exchange_invoice(login_page: Page, download_path: str, target_date: st
 
     return False
 
-def print_inventory_excel(login_page: Page, download_path: str) -> bool:
+async def print_inventory_excel(login_page: Page, download_path: str) -> bool:
     try:
         logging.info("开始下载 Inventory Excel 报表...")
 
         logging.info("点击 Inventory 菜单...")
         inventory_selector = Config.SELECTORS['inventory']['menu']
-        login_page.wait_for_selector(inventory_selector, state="visible", timeout=Config.TIMEOUTS['element'])
-        login_page.evaluate('P1("A1")')
-        time.sleep(1)
+        await login_page.wait_for_selector(inventory_selector, state="visible", timeout=Config.TIMEOUTS['element'])
+        await open_menu(login_page, "A1")
 
         logging.info("点击 Inventory Reports...")
         func_config = Config.FUNCTIONS['inventory']
-        login_page.evaluate(f'processfunction("{func_config["menu"]}","{func_config["sub_menu"]}")')
-        time.sleep(1)
+        await open_function(login_page, func_config["menu"], func_config["sub_menu"])
 
         frame = login_page.frame_locator('iframe[name="functionPage"]')
 
         logging.info("点击 D 按钮...")
         d_button_selector = Config.SELECTORS['inventory']['d_button']
-        frame.locator(d_button_selector).wait_for(state="visible", timeout=Config.TIMEOUTS['element'])
-        frame.locator(d_button_selector).click()
+        await frame.locator(d_button_selector).wait_for(state="visible", timeout=Config.TIMEOUTS['element'])
+        await frame.locator(d_button_selector).click()
 
-        login_page.wait_for_load_state('networkidle')
-        time.sleep(1)
+        await login_page.wait_for_load_state('networkidle')
+        await pace(1)
 
         logging.info("开始处理报表...")
-        with login_page.expect_download(timeout=Config.TIMEOUTS['download']) as download_info:
-            login_page.evaluate('process("6")')
+        async with report_slot('download'), login_page.expect_download(timeout=Config.TIMEOUTS['download']) as download_info:
+            await record_form_payload(login_page, 'Inventory Excel')
+            await login_page.evaluate('process("6")')
 
             try:
-                download = download_info.value
+                download = await wait_for_download(download_info)
                 current_date = datetime.now().strftime("%Y%m%d")
                 download_file_name = f"Inventory.xls"
-                download_file_path = os.path.join(download_path, download_file_name)
-
-                download.save_as(download_file_path)
-                logging.info(f"文件已尝试保存到: {download_file_path}")
-
-                if os.path.exists(download_file_path):
-                    file_size = os.path.getsize(download_file_path)
-                    logging.info(f"下载成功！文件大小: {file_size} bytes")
-                    if file_size == 0:
-                        logging.warning("警告：下载的文件大小为0字节")
-                        return False
-                    return True
-                else:
-                    logging.error("文件下载失败或找不到文件")
-                    return False
+                return await save_download(download, download_path, download_file_name)
             except Exception as e:
                 logging.error(f"下载过程中发生错误: {str(e)}")
                 return False
@@ -620,13 +1674,8 @@ def print_inventory_excel(login_page: Page, download_path: str) -> bool:
     except Exception as e:
         logging.error(f"执行过程中发生错误: {str(e)}")
         return False
-    finally:
-        try:
-            return_to_home(login_page)
-        except Exception as e:
-            logging.error(f"返回主页失败: {str(e)}")
 
-def download_inventory_pdf(login_page: Page, download_path: str) -> bool:
+async def download_inventory_pdf(login_page: Page, download_path: str) -> bool:
     try:
         logging.info("開始下載 Inventory PDF 報告...")
 
@@ -634,19 +1683,19 @@ def download_inventory_pdf(login_page: Page, download_path: str) -> bool:
 
         logging.info("點擊 C 按鈕...")
         c_button_selector = Config.SELECTORS['pdf_download']['c_button']
-        frame.locator(c_button_selector).wait_for(state="visible", timeout=Config.TIMEOUTS['element'])
-        frame.locator(c_button_selector).click()
+        await frame.locator(c_button_selector).wait_for(state="visible", timeout=Config.TIMEOUTS['element'])
+        await frame.locator(c_button_selector).click()
 
-        login_page.wait_for_load_state('networkidle')
-        time.sleep(1)
+        await login_page.wait_for_load_state('networkidle')
+        await pace(1)
 
         logging.info("點擊 Confirm 按鈕...")
-        login_page.evaluate('process("6")')
+        await login_page.evaluate('process("6")')
 
-        login_page.wait_for_load_state('networkidle')
-        time.sleep(3)
+        await login_page.wait_for_load_state('networkidle')
+        await pace(3, lambda: login_page.wait_for_function("() => !!document.forms['IN4R745f']"))
 
-        form_data = login_page.evaluate('''() => {
+        form_data = await login_page.evaluate('''() => {
             const form = document.forms['IN4R745f'];
             const formData = {};
             for (let element of form.elements) {
@@ -659,15 +1708,16 @@ def download_inventory_pdf(login_page: Page, download_path: str) -> bool:
             formData['alias'] = '6';
             return formData;
         }''')
+        remember_form_payload('Inventory PDF', login_page.url, form_data)
 
         headers = {
             'Content-Type': 'application/x-www-form-urlencoded',
             'Accept': 'application/pdf',
-            'Cookie': '; '.join([f"{c['name']}={c['value']}" for c in login_page.context.cookies()])
+            'Cookie': '; '.join([f"{c['name']}={c['value']}" for c in await login_page.context.cookies()])
         }
 
         logging.info("發送 POST 請求下載 PDF...")
-        response = login_page.context.request.post(
+        response = await login_page.context.request.post(
             login_page.url,
             form=form_data,
             headers=headers
@@ -675,24 +1725,14 @@ def download_inventory_pdf(login_page: Page, download_path: str) -> bool:
 
         if response.ok:
             filename = f"inventory_report.pdf"
-            download_file_path = os.path.join(download_path, filename)
-
-            with open(download_file_path, 'wb') as f:
-                f.write(response.body())
+            body = await response.body()
+            logging.info(f"PDF 文件已取得，大小: {len(body)} bytes")
 
-            if os.path.exists(download_file_path):
-                file_size = os.path.getsize(download_file_path)
-                logging.info(f"PDF 文件已保存，大小: {file_size} bytes")
-                
-                with open(download_file_path, 'rb') as f:
-                    if f.read(4).startswith(b'%PDF'):
-                        logging.info("成功下載 PDF 文件")
-                        return True
-                    else:
-                        logging.warning("警告：保存的文件可能不是 PDF 格式")
-                        return False
+            if body.startswith(b'%PDF'):
+                logging.info("成功下載 PDF 文件")
+                return stage_bytes(body, download_path, filename)
             else:
-                logging.error("文件未能成功保存")
+                logging.warning("警告：保存的文件可能不是 PDF 格式")
                 return False
         else:
             logging.error(f"請求失敗，狀態碼: {response.status}")
@@ -701,13 +1741,8 @@ def download_inventory_pdf(login_page: Page, download_path: str) -> bool:
     except Exception as e:
         logging.error(f"執行 PDF 下載過程中發生錯誤: {str(e)}")
         return False
-    finally:
-        try:
-            return_to_home(login_page)
-        except Exception as e:
-            logging.error(f"返回主頁失敗: {str(e)}")
 
-def inventory_csv(login_page: Page, download_path: str) -> bool:
+async def inventory_csv(login_page: Page, download_path: str) -> bool:
     try:
         logging.info("開始下載 Inventory CSV 報告...")
 
@@ -715,44 +1750,38 @@ def inventory_csv(login_page: Page, download_path: str) -> bool:
 
         logging.info("點擊 C 按鈕...")
         c_button_selector = Config.SELECTORS['pdf_download']['c_button']
-        frame.locator(c_button_selector).wait_for(state="visible", timeout=Config.TIMEOUTS['element'])
-        frame.locator(c_button_selector).click()
+        await frame.locator(c_button_selector).wait_for(state="visible", timeout=Config.TIMEOUTS['element'])
+        await frame.locator(c_button_selector).click()
 
-        login_page.wait_for_load_state('networkidle')
-        time.sleep(1)
+        await login_page.wait_for_load_state('networkidle')
+        await pace(1)
 
         logging.info("選擇 CSV 格式...")
         select_selector = Config.SELECTORS['inventory_csv']['format_select']
-        login_page.wait_for_selector(select_selector, state="visible", timeout=Config.TIMEOUTS['element'])
-        login_page.select_option(select_selector, 'csv')
+        await login_page.wait_for_selector(select_selector, state="visible", timeout=Config.TIMEOUTS['element'])
+        await login_page.select_option(select_selector, 'csv')
 
         logging.info("點擊 Confirm 按鈕...")
-        with login_page.expect_download(timeout=Config.TIMEOUTS['download']) as download_info:
-            login_page.evaluate('process("6")')
-            time.sleep(2)
-
+        async with report_slot('download'), \
+                expect_download_or_no_data(login_page, Config.TIMEOUTS['download']) as download_info:
+            await record_form_payload(login_page, 'Inventory CSV')
+            await login_page.evaluate('process("6")')
             back_selector = Config.SELECTORS['audit']['back_link']
-            if login_page.locator(back_selector).is_visible(timeout=1500):
+            await pace(2, lambda: first_signal(
+                asyncio.shield(download_info.value),
+                login_page.locator(back_selector).wait_for(state="visible"),
+            ))
+            if await login_page.locator(back_selector).is_visible(timeout=1500):
                 logging.info("需要返回上一頁")
-                login_page.locator(back_selector).click()
-                login_page.wait_for_load_state('networkidle')
+                mark_no_data()
+                await login_page.locator(back_selector).click()
+                await login_page.wait_for_load_state('networkidle')
                 return False
 
             try:
-                download = download_info.value
+                download = await wait_for_download(download_info)
                 download_file_name = f"inventory.csv"
-                download_file_path = os.path.join(download_path, download_file_name)
-
-                download.save_as(download_file_path)
-                logging.info(f"文件已嘗試保存到: {download_file_path}")
-
-                if os.path.exists(download_file_path):
-                    file_size = os.path.getsize(download_file_path)
-                    logging.info(f"下載成功！文件大小: {file_size} bytes")
-                    return True
-                else:
-                    logging.error("文件下載失敗或找不到文件")
-                    return False
+                return await save_download(download, download_path, download_file_name)
             except Exception as e:
                 logging.error(f"下載過程中發生錯誤: {str(e)}")
                 return False
@@ -760,84 +1789,64 @@ def inventory_csv(login_page: Page, download_path: str) -> bool:
     except Exception as e:
         logging.error(f"執行過程中發生錯誤: {str(e)}")
         return False
-    finally:
-        try:
-            return_to_home(login_page)
-        except Exception as e:
-            logging.error(f"返回主頁失敗: {str(e)}")
 
-def wait_for_save_button(page, timeout=60000):
+async def wait_for_save_button(page, timeout=60000):
     try:
         save_button_selector = "input[type='button'][name='save'][value='Save'][onclick=\"process('10')\"]"
-        page.wait_for_selector(save_button_selector, state='visible', timeout=timeout)
+        await page.wait_for_selector(save_button_selector, state='visible', timeout=timeout)
         logging.info("Save 按鈕已出現")
         return True
     except TimeoutError:
         logging.warning("等待 Save 按鈕出現超時")
         return False
     
-def export_tv_data(login_page: Page, download_path: str) -> bool:
+async def export_tv_data(login_page: Page, download_path: str) -> bool:
     try:
         logging.info("開始執行 TV 數據導出...")
 
         logging.info("點擊 Basic Data 選單...")
         basic_data_selector = Config.SELECTORS['tv_export']['basic_data_menu']
-        login_page.wait_for_selector(basic_data_selector, state="visible", timeout=Config.TIMEOUTS['element'])
-        login_page.evaluate('P1("A3")')
-        time.sleep(1)
+        await login_page.wait_for_selector(basic_data_selector, state="visible", timeout=Config.TIMEOUTS['element'])
+        await open_menu(login_page, "A3")
 
         logging.info("點擊 TV...")
         func_config = Config.FUNCTIONS['tv_export']
-        login_page.evaluate(f'processfunction("{func_config["menu"]}","{func_config["sub_menu"]}")')
-        time.sleep(1)
+        await open_function(login_page, func_config["menu"], func_config["sub_menu"])
 
         frame = login_page.frame_locator('iframe[name="functionPage"]')
 
         logging.info("點擊 C 按鈕...")
         c_button_selector = Config.SELECTORS['tv_export']['c_button']
-        frame.locator(c_button_selector).wait_for(state="visible", timeout=Config.TIMEOUTS['element'])
-        frame.locator(c_button_selector).click()
+        await frame.locator(c_button_selector).wait_for(state="visible", timeout=Config.TIMEOUTS['element'])
+        await frame.locator(c_button_selector).click()
 
-        login_page.wait_for_load_state('networkidle')
-        time.sleep(1)
+        await login_page.wait_for_load_state('networkidle')
+        await pace(1)
 
         logging.info("填寫 PageRowCount 和 MaxRowCount...")
         page_row_selector = Config.SELECTORS['tv_export']['page_row_count']
         max_row_selector = Config.SELECTORS['tv_export']['max_row_count']
-        login_page.wait_for_selector(page_row_selector, state="visible", timeout=Config.TIMEOUTS['element'])
-        login_page.fill(page_row_selector, '9999')
-        login_page.wait_for_selector(max_row_selector, state="visible", timeout=Config.TIMEOUTS['element'])
-        login_page.fill(max_row_selector, '9999')
+        await login_page.wait_for_selector(page_row_selector, state="visible", timeout=Config.TIMEOUTS['element'])
+        await login_page.fill(page_row_selector, '9999')
+        await login_page.wait_for_selector(max_row_selector, state="visible", timeout=Config.TIMEOUTS['element'])
+        await login_page.fill(max_row_selector, '9999')
 
         logging.info("點擊第一個 Confirm 按鈕...")
-        login_page.evaluate('process("6")')
+        async with report_slot('preview'):
+            await login_page.evaluate('process("6")')
 
-        logging.info("等待數據加載...")
-        wait_for_save_button(login_page)
+            logging.info("等待數據加載...")
+            await wait_for_save_button(login_page)
 
         logging.info("點擊導出 Excel 按鈕...")
-        with login_page.expect_download(timeout=30000) as download_info:
-            login_page.evaluate('process("25")')
+        async with report_slot('download'), login_page.expect_download(timeout=30000) as download_info:
+            await login_page.evaluate('process("25")')
 
             try:
-                download = download_info.value
+                download = await wait_for_download(download_info)
                 current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
                 download_file_name = f"TV.xls"
-                download_file_path = os.path.join(download_path, download_file_name)
-
-                download.save_as(download_file_path)
-                logging.info(f"文件已嘗試保存到: {download_file_path}")
-
-                if os.path.exists(download_file_path):
-                    file_size = os.path.getsize(download_file_path)
-                    logging.info(f"下載成功！文件大小: {file_size} bytes")
-                    if file_size == 0:
-                        logging.warning("警告：下載的文件大小為0字節")
-                        return False
-                    return True
-                else:
-                    logging.error("文件下載失敗或找不到文件")
-                    return False
+                return await save_download(download, download_path, download_file_name)
             except Exception as e:
                 logging.error(f"下載過程中發生錯誤: {str(e)}")
                 return False
@@ -845,11 +1854,6 @@ def export_tv_data(login_page: Page, download_path: str) -> bool:
     except Exception as e:
         logging.error(f"執行過程中發生錯誤: {str(e)}")
         return False
-    finally:
-        try:
-            return_to_home(login_page)
-        except Exception as e:
-            logging.error(f"返回主頁失敗: {str(e)}")
 
 def get_desktop_path(company_name: str) -> str:
     """
@@ -909,9 +1913,325 @@ def safe_quit_excel(excel):
     except:
         pass
 
-def excel_save_multiple_files(file_mappings):
+def detect_workbook_format(path) -> str:
+    """
+    根據文件內容判斷實際格式
+
+    TIPS 下載的 .xls 多數其實是 HTML 表格，因此不能只看副檔名。
+
+    Returns:
+        str: 'xls' (BIFF/OLE2)、'xlsx'、'html' 或 'csv'
+    """
+    with open(path, 'rb') as f:
+        head = f.read(2048)
+    if head.startswith(b'\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1'):
+        return 'xls'
+    if head.startswith(b'PK\x03\x04'):
+        return 'xlsx'
+    lowered = head.lstrip(b'\xef\xbb\xbf \t\r\n').lower()
+    if lowered.startswith(b'<') or b'<table' in lowered or b'<html' in lowered:
+        return 'html'
+    return 'csv'
+
+def read_workbook(path, source_format: str) -> list:
+    """讀取工作簿，返回 [(工作表名稱, DataFrame), ...]"""
+    import pandas as pd
+
+    if source_format == 'html':
+        tables = pd.read_html(str(path), header=None)
+        return [(f"Sheet{i + 1}", table) for i, table in enumerate(tables)]
+    if source_format == 'csv':
+        return [("Sheet1", pd.read_csv(path, header=None, dtype=str, encoding_errors='replace'))]
+    engine = 'xlrd' if source_format == 'xls' else 'openpyxl'
+    sheets = pd.read_excel(path, sheet_name=None, header=None, engine=engine)
+    return list(sheets.items())
+
+def _write_xls(sheets: list, path):
+    """以 xlwt 寫出 BIFF 格式的 .xls"""
+    import xlwt
+
+    book = xlwt.Workbook(encoding='utf-8')
+    for name, frame in sheets:
+        sheet = book.add_sheet(str(name)[:31])
+        for row_index, row in enumerate(frame.itertuples(index=False)):
+            for col_index, value in enumerate(row):
+                if value is None or value != value:  # NaN
+                    continue
+                if hasattr(value, 'item'):
+                    value = value.item()
+                sheet.write(row_index, col_index, value)
+    book.save(str(path))
+
+def _write_xlsx(sheets: list, path):
+    import pandas as pd
+
+    with pd.ExcelWriter(str(path), engine='openpyxl') as writer:
+        for name, frame in sheets:
+            frame.to_excel(writer, sheet_name=str(name)[:31], header=False, index=False)
+
+def convert_file(mapping: dict) -> tuple:
+    """
+    不經 Excel 把單個下載文件轉換為目標文件（可在子進程中執行）
+
+    來源與目標格式相同時直接複製字節，與 Excel SaveAs 保留原格式的行為一致；
+    格式不同時（例如 HTML 表格 -> .xlsx）才解析表格並重新寫出。
+    輸出先寫入臨時文件再原子替換。
+
+    Returns:
+        tuple: (輸入文件, 輸出文件, 是否成功, 訊息)
+    """
+    input_file = mapping['input']
+    output_file = mapping['output']
+    input_path = Path(input_file)
+    output_path = Path(output_file)
+    if not input_path.exists():
+        return input_file, output_file, False, "文件不存在"
+
+    partial_path = output_path.with_name(output_path.name + '.partial')
+    try:
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        source_format = detect_workbook_format(input_path)
+        target_format = output_path.suffix.lower().lstrip('.')
+
+        if source_format == target_format or (
+                target_format == 'xls' and source_format == 'html' and not Config.CONVERSION['html_to_biff']):
+            shutil.copyfile(input_path, partial_path)
+        else:
+            sheets = read_workbook(input_path, source_format)
+            if target_format == 'xlsx':
+                _write_xlsx(sheets, partial_path)
+            elif target_format == 'xls':
+                _write_xls(sheets, partial_path)
+            else:
+                return input_file, output_file, False, f"不支持的目標格式: {target_format}"
+
+        os.replace(partial_path, output_path)
+        return input_file, output_file, True, source_format
+    except Exception as e:
+        with contextlib.suppress(OSError):
+            os.remove(partial_path)
+        return input_file, output_file, False, str(e)
+
+def convert_files_python(file_mappings, workers: Optional[int] = None) -> list:
+    """以進程池並行轉換多個文件，不需要 Excel；返回轉換成功的映射"""
+    if workers is None:
+        workers = Config.CONVERSION['workers']
+
+    converted = []
+    if workers <= 1 or len(file_mappings) <= 1:
+        results = map(convert_file, file_mappings)
+        for mapping, (input_file, output_file, ok, message) in zip(file_mappings, results):
+            _report_conversion(input_file, output_file, ok, message)
+            if ok:
+                converted.append(mapping)
+        return converted
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(convert_file, file_mappings)
+        for mapping, (input_file, output_file, ok, message) in zip(file_mappings, results):
+            _report_conversion(input_file, output_file, ok, message)
+            if ok:
+                converted.append(mapping)
+    return converted
+
+def _report_conversion(input_file, output_file, ok, message):
+    if ok:
+        print(f"文件 {input_file} 已成功另存為 {output_file}")
+    elif message == "文件不存在":
+        print(f"文件不存在: {input_file}")
+    else:
+        print(f"處理文件 {input_file} 時發生錯誤: {message}")
+
+def file_signature(path, with_hash: bool = True) -> dict:
+    """返回文件的大小、修改時間及（可選）SHA-256"""
+    stat = os.stat(path)
+    signature = {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
+    if with_hash:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(Config.STAGING['chunk_size']), b''):
+                digest.update(chunk)
+        signature['sha256'] = digest.hexdigest()
+    return signature
+
+def load_conversion_manifest() -> dict:
+    try:
+        with open(Config.CONVERSION['manifest'], 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print(f"讀取轉換記錄失敗，將全部重新轉換: {e}")
+        return {}
+
+def save_conversion_manifest(manifest: dict):
+    manifest_file = Config.CONVERSION['manifest']
+    tmp_file = f"{manifest_file}.tmp"
+    try:
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, manifest_file)
+    except Exception as e:
+        print(f"保存轉換記錄失敗: {e}")
+
+def conversion_is_current(mapping: dict, manifest: dict) -> bool:
+    """
+    判斷輸出是否已與輸入同步
+
+    輸出文件須與記錄一致；輸入的大小和修改時間未變時直接視為未變，
+    修改時間變了（例如重新下載了同樣的內容）則比對 SHA-256。
+    """
+    entry = manifest.get(mapping['output'])
+    if not entry or entry.get('input_path') != mapping['input']:
+        return False
+    try:
+        output_sig = file_signature(mapping['output'], with_hash=False)
+        input_sig = file_signature(mapping['input'], with_hash=False)
+    except OSError:
+        return False
+    if output_sig != entry['output']:
+        return False
+    recorded = entry['input']
+    if input_sig['size'] != recorded['size']:
+        return False
+    if input_sig['mtime'] == recorded['mtime']:
+        return True
+    if file_signature(mapping['input'])['sha256'] == recorded['sha256']:
+        recorded['mtime'] = input_sig['mtime']
+        return True
+    return False
+
+def record_conversion(mapping: dict, manifest: dict):
+    manifest[mapping['output']] = {
+        'input_path': mapping['input'],
+        'input': file_signature(mapping['input']),
+        'output': file_signature(mapping['output'], with_hash=False),
+    }
+
+def excel_save_multiple_files(file_mappings, backend: Optional[str] = None, force: bool = False):
     """
     批量另存為Excel文件到指定路徑
+
+    參數:
+    file_mappings (list): 包含源文件和目標文件路徑的字典列表
+    backend (str): 'python'（預設，不需要 Excel）或 'excel'（經 COM 調用 Excel）
+    force (bool): 忽略轉換記錄，全部重新轉換
+    """
+    backend = backend or Config.CONVERSION['backend']
+    manifest = load_conversion_manifest()
+
+    if force:
+        pending = list(file_mappings)
+    else:
+        pending = [m for m in file_mappings if not conversion_is_current(m, manifest)]
+        skipped = len(file_mappings) - len(pending)
+        if skipped:
+            print(f"{skipped} 個文件自上次轉換後沒有變化，已跳過")
+    if not pending:
+        save_conversion_manifest(manifest)
+        return
+
+    if backend == 'excel':
+        started = time.time_ns()
+        excel_com_save_multiple_files(pending)
+        converted = [m for m in pending
+                     if os.path.exists(m['output']) and os.stat(m['output']).st_mtime_ns >= started]
+    else:
+        converted = convert_files_python(pending)
+
+    for mapping in converted:
+        try:
+            record_conversion(mapping, manifest)
+        except OSError as e:
+            print(f"無法記錄 {mapping['output']} 的轉換狀態: {e}")
+    save_conversion_manifest(manifest)
+
+_conversion_pipeline = contextvars.ContextVar('conversion_pipeline', default=None)
+
+class ConversionPipeline:
+    """
+    下載與轉換的生產者/消費者流水線
+
+    文件發佈到下載目錄後立即放入有上限的隊列，由後台工作者在進程池中轉換到
+    ({company})資料庫更新，與其餘公司的下載並行。隊列已滿時發佈任務會等待，
+    避免轉換落後太多。只支持 python 轉換後端。
+    """
+
+    def __init__(self, file_mappings: list, force: bool = False, workers: Optional[int] = None):
+        self.by_input = {os.path.normcase(m['input']): m for m in file_mappings}
+        self.force = force
+        self.workers = workers or Config.CONVERSION['workers']
+        self.handled = set()
+        self.converted = self.skipped = self.failed = 0
+        self.busy = 0.0
+        self.last_queued = self.last_done = None
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=Config.PIPELINE['queue_size'])
+        self.manifest = await asyncio.to_thread(load_conversion_manifest)
+        self.executor = ProcessPoolExecutor(max_workers=self.workers)
+        self.tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+        self.token = _conversion_pipeline.set(self)
+
+    async def put(self, published_path: str):
+        """文件發佈完成後調用；不在轉換列表中的文件忽略"""
+        mapping = self.by_input.get(os.path.normcase(published_path))
+        if mapping is None:
+            return
+        self.handled.add(mapping['output'])
+        self.last_queued = time.perf_counter()
+        await self.queue.put(mapping)
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            mapping = await self.queue.get()
+            if mapping is None:
+                return
+            start = time.perf_counter()
+            try:
+                if not self.force and await asyncio.to_thread(conversion_is_current, mapping, self.manifest):
+                    self.skipped += 1
+                    continue
+                with span('convert', os.path.basename(mapping['output']), detached=True):
+                    input_file, output_file, ok, message = await loop.run_in_executor(
+                        self.executor, convert_file, mapping)
+                _report_conversion(input_file, output_file, ok, message)
+                if ok:
+                    await asyncio.to_thread(record_conversion, mapping, self.manifest)
+                    self.converted += 1
+                else:
+                    self.failed += 1
+            except Exception as e:
+                print(f"處理文件 {mapping['input']} 時發生錯誤: {e}")
+                self.failed += 1
+            finally:
+                self.busy += time.perf_counter() - start
+                self.last_done = time.perf_counter()
+
+    async def close(self):
+        """等待隊列中的文件全部轉換完成並保存轉換記錄"""
+        _conversion_pipeline.reset(self.token)
+        for _ in self.tasks:
+            await self.queue.put(None)
+        await asyncio.gather(*self.tasks)
+        self.executor.shutdown()
+        await asyncio.to_thread(save_conversion_manifest, self.manifest)
+
+    def remaining(self) -> list:
+        """本次沒有經流水線處理的映射（例如下載失敗的報表），留待運行結束後批量檢查"""
+        return [m for m in self.by_input.values() if m['output'] not in self.handled]
+
+    def log_summary(self):
+        logging.info("\n========= 轉換流水線摘要 =========")
+        logging.info(f"已轉換: {self.converted}，未變跳過: {self.skipped}，失敗: {self.failed}")
+        logging.info(f"轉換耗時合計: {self.busy:.2f} 秒")
+        if self.last_queued is not None and self.last_done is not None:
+            logging.info(f"最後一個文件發佈後 {max(0.0, self.last_done - self.last_queued):.2f} 秒完成全部轉換")
+
+def excel_com_save_multiple_files(file_mappings):
+    """
+    經 COM 調用 Excel 批量另存為Excel文件到指定路徑
     
     參數:
     file_mappings (list): 包含源文件和目標文件路徑的字典列表
@@ -1005,181 +2325,812 @@ def register_excel_com():
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def run(playwright):
-    #if datetime.today().weekday() == 0:  # 0 代表星期一
-    #    logging.info("今天是星期一，程式不執行")
-    #    return
+####### 報表任務 Start #######
+# 報表任務註冊表
+#   name:        任務名稱（亦用於日誌、結果摘要及直接 HTTP 下載的表單記錄）
+#   func:        瀏覽器下載函數
+#   uses_date:   下載函數是否需要 target_date
+#   output:      下載文件名，支持 {date}
+#   convert_to:  轉換到 ({company})資料庫更新 的目標文件名，支持 {company}；None 表示不轉換
+#   depends_on:  必須先在同一頁面上執行的任務（下載函數依賴前一任務留下的菜單/頁面狀態）
+#   module:      所屬的 TIPS 模塊；同一模塊的報表連續執行，不必返回主頁
+#   backfill:    補數模式下是否按日期逐日重新下載
+REPORT_TASKS = [
+    {
+        'name': 'Daily Product Audit',
+        'func': print_daily_product_audit,
+        'uses_date': True,
+        'output': 'Daily_Product_Audit.xls',
+        'convert_to': '({company})每日銷售數.xls',
+        'depends_on': [],
+        'module': 'SOF',
+        'backfill': True,
+    },
+    {
+        'name': 'Monthly Uncollect',
+        'func': print_monthly_uncollect,
+        'uses_date': True,
+        'output': 'Month_Uncollect.xls',
+        'convert_to': '({company}) EDC客未取數(12個月).xls',
+        'depends_on': [],
+        'module': 'SOF',
+        'backfill': False,
+    },
+    {
+        'name': 'Uncollected Order Detail',
+        'func': print_uncollected_order_detail,
+        'uses_date': True,
+        'output': 'Uncollected_Order_Detail_{date}.xls',
+        'convert_to': '客未取貨.xls',
+        'depends_on': ['Monthly Uncollect'],
+        'module': 'SOF',
+        'backfill': True,
+    },
+    {
+        'name': 'Print Collections',
+        'func': print_collections,
+        'uses_date': True,
+        'output': 'Collections.xls',
+        'convert_to': 'Collection Detail.xls',
+        'depends_on': ['Uncollected Order Detail'],
+        'module': 'SOF',
+        'backfill': True,
+    },
+    {
+        'name': 'Exchange Invoice',
+        'func': print_exchange_invoice,
+        'uses_date': True,
+        'output': 'Exchange_Invoice.xls',
+        'convert_to': '換貨紀錄.xls',
+        'depends_on': ['Print Collections'],
+        'module': 'SOF',
+        'backfill': True,
+    },
+    {
+        'name': 'Inventory Excel',
+        'func': print_inventory_excel,
+        'uses_date': False,
+        'output': 'Inventory.xls',
+        'convert_to': '({company})Inventory.xls',
+        'depends_on': [],
+        'module': 'INV',
+        'backfill': False,
+    },
+    {
+        'name': 'Inventory PDF',
+        'func': download_inventory_pdf,
+        'uses_date': False,
+        'output': 'inventory_report.pdf',
+        'convert_to': None,
+        'depends_on': ['Inventory Excel'],
+        'module': 'INV',
+        'backfill': False,
+    },
+    {
+        'name': 'Inventory CSV',
+        'func': inventory_csv,
+        'uses_date': False,
+        'output': 'inventory.csv',
+        'convert_to': None,
+        'depends_on': ['Inventory PDF'],
+        'module': 'INV',
+        'backfill': False,
+    },
+    {
+        'name': 'TV Export',
+        'func': export_tv_data,
+        'uses_date': False,
+        'output': 'TV.xls',
+        'convert_to': '({company})TV info maintenance.xls',
+        'depends_on': [],
+        'module': 'BAS',
+        'backfill': False,
+    },
+]
+REPORT_TASKS_BY_NAME = {task['name']: task for task in REPORT_TASKS}
+
+def plan_task_chains(tasks: list) -> list:
+    """
+    按依賴關係把任務分成互不相關的執行鏈
 
-    base_download_path = r'\\files01-wtc.kmml.local\ON-Warehouse\各場庫存及容量\python_data\download_data'
-    companies = ["BV", "BD", "TS", "TD", "MM", "FR", "WH", "ED", "EF", "ES", "EB", "SM"]  # 可以根据需要添加更多公司
-    all_results = {}
+    每條鏈內按依賴拓撲排序（無依賴約束時保持註冊順序），不同鏈之間沒有依賴，
+    可以交錯或在不同頁面上並行執行。只計算 tasks 內部的依賴。
+    首個任務屬於同一模塊的鏈相鄰排列。
 
+    Returns:
+        list: [[task, ...], ...]
+    """
+    names = [task['name'] for task in tasks]
+    by_name = {task['name']: task for task in tasks}
+    parent = {name: name for name in names}
+
+    def find(name):
+        while parent[name] != name:
+            parent[name] = parent[parent[name]]
+            name = parent[name]
+        return name
+
+    for task in tasks:
+        for dep in task['depends_on']:
+            if dep in by_name:
+                parent[find(task['name'])] = find(dep)
+
+    ordered, done = [], set()
+    while len(ordered) < len(names):
+        ready = [name for name in names if name not in done
+                 and all(dep in done or dep not in by_name for dep in by_name[name]['depends_on'])]
+        if not ready:
+            raise ValueError(f"報表任務存在循環依賴: {[n for n in names if n not in done]}")
+        ordered.append(ready[0])
+        done.add(ready[0])
+
+    chains = {}
+    for name in ordered:
+        chains.setdefault(find(name), []).append(by_name[name])
+
+    # 同一模塊的執行鏈排在一起，減少在模塊之間來回返回主頁
+    modules = []
+    for chain in chains.values():
+        if chain[0]['module'] not in modules:
+            modules.append(chain[0]['module'])
+    return sorted(chains.values(), key=lambda chain: modules.index(chain[0]['module']))
+
+def select_tasks(names) -> list:
+    """返回指定的任務及其全部前置任務，按註冊表順序排列"""
+    wanted = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name in wanted:
+            continue
+        if name not in REPORT_TASKS_BY_NAME:
+            raise ValueError(f"未知的報表任務: {name}")
+        wanted.add(name)
+        pending.extend(REPORT_TASKS_BY_NAME[name]['depends_on'])
+    return [task for task in REPORT_TASKS if task['name'] in wanted]
+
+def backfill_dates(start_date: str, end_date: str) -> list:
+    """返回 start_date 到 end_date（含）之間的每一天 (YYYYMMDD)"""
+    start = datetime.strptime(start_date, '%Y%m%d')
+    end = datetime.strptime(end_date, '%Y%m%d')
+    if end < start:
+        raise ValueError(f"補數結束日期 {end_date} 早於開始日期 {start_date}")
+    return [(start + timedelta(days=offset)).strftime('%Y%m%d') for offset in range((end - start).days + 1)]
+
+def backfill_tasks() -> list:
+    """補數模式要執行的任務：按日期出數的報表，連同它們在導航上依賴的前置任務"""
+    return select_tasks(task['name'] for task in REPORT_TASKS if task['backfill'])
+
+def build_file_mappings(companies: list, target_date: str, tasks: Optional[list] = None) -> list:
+    """根據任務註冊表生成下載文件到 ({company})資料庫更新 的轉換映射"""
+    file_mappings = []
     for company in companies:
-        logging.info(f"\n開始處理公司: {company}")
-        company_start_time = time.time()
-        successful_tasks = 0
-        total_tasks = 0
-        company_results = []
-        
-        company_download_path = create_company_folder(base_download_path, company)
-        
-        browser = playwright.chromium.launch(channel="msedge", headless=False)
-        context = browser.new_context(accept_downloads=True)
-        page = context.new_page()
-
-        username = f"{company}.OM079"
-        password = "0000"
-        target_date = (datetime.today() - timedelta(days=1)).strftime('%Y%m%d')
+        base_input = Path(Config.BASE_DOWNLOAD_PATH) / company
+        base_output = Path(Config.CONVERT_OUTPUT_PATH.format(company=company))
+        for task in tasks or REPORT_TASKS:
+            if task['convert_to']:
+                file_mappings.append({
+                    'input': str(base_input / task['output'].format(date=target_date)),
+                    'output': str(base_output / task['convert_to'].format(company=company)),
+                })
+    return file_mappings
+
+async def run_report_task(task: dict, page: Page, context, download_path: str, target_date: str,
+                          direct: bool = False) -> dict:
+    """執行單個報表任務，返回 company_results 格式的結果"""
+    start_time = time.time()
+    no_data_token = _no_data.set(False)
+    with span_labels(task=task['name'], date=target_date), span('ui', task['name']), \
+            track_readiness() as readiness, track_publishes() as publishes:
+        if direct:
+            success = await fetch_report_direct(context.request, task['name'], download_path, target_date)
+        else:
+            args = (page, download_path, target_date) if task['uses_date'] else (page, download_path)
+            try:
+                await enter_module(page, task['module'])
+                success = await task['func'](*args)
+            except Exception as e:
+                logging.error(f"切換到 {task['module']} 模塊失敗: {str(e)}")
+                success = False
+    empty = _no_data.get()
+    if not direct and not success and not empty:
+        navigation_state(page).dirty = True
+    _no_data.reset(no_data_token)
+    end_time = time.time()
+
+    if success:
+        logging.info(f"{task['name']} 報表下載成功")
+    else:
+        logging.warning(f"{task['name']} 報表下載失敗或不需要下載")
+    return {"task": task['name'], "date": target_date, "success": success, "empty": empty,
+            "duration": end_time - start_time, "saved": readiness.saved, "publish": publishes,
+            "file": os.path.join(download_path, task['output'].format(date=target_date))}
+
+async def run_with_retries(task: dict, page: Page, context, download_path: str, target_date: str,
+                           direct: bool = False, prepare=None) -> dict:
+    """
+    執行報表任務，失敗時退避重試（沒有數據的報表不重試）
 
-        popup_page = wait_for_popup(page)
-        if popup_page:
-            logged_in_page = login_system(popup_page, username, password)
-            if logged_in_page:
-                logging.info("登錄成功，開始執行下載任務")
-                
-                total_tasks += 1
-                start_time = time.time()
-                success_daily = print_daily_product_audit(logged_in_page, company_download_path, target_date)
-                end_time = time.time()
-                company_results.append({"task": "Daily Product Audit", "success": success_daily, "duration": end_time - start_time})
-                if success_daily:
-                    logging.info("Daily Product Audit 報表下載成功")
-                    successful_tasks += 1
-                else:
-                    logging.warning("Daily Product Audit 報表下載失敗或不需要下載")
-                if success_daily:
-                    return_to_home(logged_in_page)
-
-                time.sleep(1.5)
-                total_tasks += 1
-                start_time = time.time()
-                # 下載 Monthly Uncollect 報表
-                success_monthly = print_monthly_uncollect(logged_in_page, company_download_path, target_date)
-                end_time = time.time()
-                company_results.append({"task": "Monthly Uncollect", "success": success_monthly, "duration": end_time - start_time})
-                if success_monthly:
-                    logging.info("Monthly Uncollect 報表下載成功")
-                    successful_tasks += 1
-                else:
-                    logging.warning("Monthly Uncollect 報表下載失敗或不需要下載")
-                
-                time.sleep(1.5)
-
-                total_tasks += 1
-                start_time = time.time()
-                # 下載 Uncollected Order Detail 報表
-                success_uncollected = print_uncollected_order_detail(logged_in_page, company_download_path, target_date)
-                end_time = time.time()
-                company_results.append({"task": "Uncollected Order Detail", "success": success_uncollected, "duration": end_time - start_time})
-                if success_uncollected:
-                    logging.info("Uncollected Order Detail 報表下載成功")
-                    successful_tasks += 1
-                else:
-                    logging.warning("Uncollected Order Detail 報表下載失敗或不需要下載")
-                return_to_home(logged_in_page)
-
-                time.sleep(1.5)
-
-                total_tasks += 1
-                start_time = time.time()
-                # 下載 Print Collections 報表
-                success_collections = print_collections(logged_in_page, company_download_path, target_date)
-                end_time = time.time()
-                company_results.append({"task": "Print Collections", "success": success_collections, "duration": end_time - start_time})
-                if success_collections:
-                    logging.info("Print Collections 報表下載成功")
-                    successful_tasks += 1
-                else:
-                    logging.warning("Print Collections 報表下載失敗或不需要下載")
-                return_to_home(logged_in_page)
-                
-                time.sleep(1.5)
-
-                total_tasks += 1
-                start_time = time.time()
-                # 下載 Exchange Invoice 報表
-                success_exchange = print_exchange_invoice(logged_in_page, company_download_path, target_date)
-                end_time = time.time()
-                company_results.append({"task": "Exchange Invoice", "success": success_exchange, "duration": end_time - start_time})
-                if success_exchange:
-                    logging.info("Exchange Invoice 報表下載成功")
-                    successful_tasks += 1
-                else:
-                    logging.warning("Exchange Invoice 報表下載失敗或不需要下載")
-                return_to_home(logged_in_page)
-                
-                time.sleep(1.5)
-
-                total_tasks += 1
-                start_time = time.time()
-                # 下載 Inventory Excel 報表
-                success_inventory = print_inventory_excel(logged_in_page, company_download_path)
-                end_time = time.time()
-                company_results.append({"task": "Inventory Excel", "success": success_inventory, "duration": end_time - start_time})
-                if success_inventory:
-                    logging.info("Inventory Excel 報表下載成功")
-                    successful_tasks += 1
-                else:
-                    logging.warning("Inventory Excel 報表下載失敗或不需要下載")
-
-                time.sleep(1.5)
-
-                total_tasks += 1
-                start_time = time.time()
-                # 下載 Inventory PDF 報表
-                success_inventory_pdf = download_inventory_pdf(logged_in_page, company_download_path)
-                end_time = time.time()
-                company_results.append({"task": "Inventory PDF", "success": success_inventory_pdf, "duration": end_time - start_time})
-                if success_inventory_pdf:
-                    logging.info("Inventory PDF 報表下載成功")
-                    successful_tasks += 1
-                else:
-                    logging.warning("Inventory PDF 報表下載失敗或不需要下載")
-                
-                time.sleep(1.5)
-                
-                total_tasks += 1
-                start_time = time.time()
-                # 下載 Inventory CSV 報表
-                success_inventory_csv = inventory_csv(logged_in_page, company_download_path)
-                end_time = time.time()
-                company_results.append({"task": "Inventory CSV", "success": success_inventory_csv, "duration": end_time - start_time})
-                if success_inventory_csv:
-                    logging.info("Inventory CSV 報表下載成功")
-                    successful_tasks += 1
+    Args:
+        prepare: 重試前調用的協程函數，用於恢復任務所需的頁面狀態
+    """
+    result = await run_report_task(task, page, context, download_path, target_date, direct)
+    attempt = 1
+    while not result['success'] and not result['empty'] and attempt <= Config.RETRY['attempts']:
+        delay = retry_delay(attempt)
+        logging.warning(f"{task['name']} 失敗，{delay:.1f} 秒後第 {attempt} 次重試")
+        await asyncio.sleep(delay)
+        if prepare:
+            await prepare()
+        retry = await run_report_task(task, page, context, download_path, target_date, direct)
+        retry['duration'] += result['duration']
+        retry['saved'] += result['saved']
+        result = retry
+        attempt += 1
+    result['attempts'] = attempt
+    return result
+
+async def _run_task_chain(chain: list, page: Page, context, download_path: str, target_date: str,
+                          navigation: frozenset = frozenset()) -> list:
+    """依次執行一條鏈；navigation 中的任務只為後續任務準備頁面狀態，不計入結果"""
+    results = []
+    for index, task in enumerate(chain):
+        if index:
+            await pace(1.5)
+        if task['name'] in navigation:
+            with navigation_only():
+                await run_report_task(task, page, context, download_path, target_date)
+            continue
+
+        async def replay_prerequisites(task=task, index=index):
+            # 下載函數依賴前置任務留下的頁面狀態：返回主頁後重新執行前置任務
+            try:
+                await return_to_home(page)
+            except Exception:
+                pass
+            needed = {t['name'] for t in select_tasks([task['name']])} - {task['name']}
+            for prerequisite in chain[:index]:
+                if prerequisite['name'] not in needed:
+                    continue
+                if prerequisite['name'] in navigation:
+                    with navigation_only():
+                        await run_report_task(prerequisite, page, context, download_path, target_date)
                 else:
-                    logging.warning("Inventory CSV 報表下載失敗或不需要下載")
-
-                time.sleep(1.5)
-
-                total_tasks += 1
-                start_time = time.time()
-                success_tv_export = export_tv_data(logged_in_page, company_download_path)
-                end_time = time.time()
-                company_results.append({"task": "TV Export", "success": success_tv_export, "duration": end_time - start_time})
-                if success_tv_export:
-                    logging.info("TV 數據導出成功")
-                    successful_tasks += 1
+                    await finish_publishes([await run_report_task(prerequisite, page, context, download_path,
+                                                                  target_date)])
+
+        result = await run_with_retries(task, page, context, download_path, target_date,
+                                        prepare=replay_prerequisites)
+        journal_result(result)
+        results.append(result)
+    return results
+
+async def run_report_tasks(context, page: Page, download_path: str, target_date: str,
+                           tasks: Optional[list] = None) -> list:
+    """
+    按註冊表調度一間公司的報表任務
+
+    已記錄表單的報表直接以 HTTP 請求取得，失敗時改走瀏覽器流程；其餘任務按依賴分成執行鏈，
+    Config.PARALLEL_CHAINS 大於 1 時，互不依賴的鏈在同一 context 的不同頁面上並行。
+    改走瀏覽器的任務連同其前置任務一起執行，已直接取得的前置任務只用於導航。
+    結果按註冊表順序返回。
+    """
+    tasks = tasks or REPORT_TASKS
+    results = []
+    browser_tasks = tasks
+    navigation = frozenset()
+    direct = direct_reports() if Config.DIRECT_HTTP['enabled'] else set()
+    if direct:
+        # 表單已記錄的報表直接以 HTTP 請求取得；失敗時改用瀏覽器流程（會重新記錄表單）
+        logging.info(f"使用已記錄的表單直接請求 {len(direct)} 個報表")
+        fallback = set()
+        for task in tasks:
+            if task['name'] in direct:
+                result = await run_report_task(task, page, context, download_path, target_date, direct=True)
+                if result['success'] or result['empty']:
+                    journal_result(result)
+                    results.append(result)
                 else:
-                    logging.warning("TV 數據導出失敗或不需要下載")
+                    fallback.add(task['name'])
+        if fallback:
+            logging.warning(f"直接請求失敗，改用瀏覽器下載: {', '.join(sorted(fallback))}")
+        names = [task['name'] for task in tasks if task['name'] not in direct or task['name'] in fallback]
+        browser_tasks = select_tasks(names) if names else []
+        navigation = frozenset(task['name'] for task in browser_tasks) - set(names)
+
+    chains = plan_task_chains(browser_tasks)
+    if Config.PARALLEL_CHAINS <= 1 or len(chains) <= 1:
+        for index, chain in enumerate(chains):
+            if index or results:
+                await pace(1.5)
+            results.extend(await _run_task_chain(chain, page, context, download_path, target_date, navigation))
+    else:
+        semaphore = asyncio.Semaphore(Config.PARALLEL_CHAINS)
+
+        async def run_chain_on_own_page(chain: list) -> list:
+            async with semaphore:
+                chain_page = await new_page(context)
+                try:
+                    await chain_page.goto(Config.HOME_URL, wait_until='domcontentloaded')
+                    return await _run_task_chain(chain, chain_page, context, download_path, target_date,
+                                                 navigation)
+                finally:
+                    await chain_page.close()
+
+        for chain_results in await asyncio.gather(*(run_chain_on_own_page(chain) for chain in chains)):
+            results.extend(chain_results)
+
+    order = {task['name']: index for index, task in enumerate(tasks)}
+    results.sort(key=lambda r: order[r['task']])
+    return results
+
+######## 報表任務 _ END #########
+
+####### 運行記錄 Start #######
+# 每個 (公司, 報表, 日期) 的最新狀態：success、empty（TIPS 表示沒有數據）或 failed
+JOURNAL_DONE = {'success', 'empty'}
+_no_data = contextvars.ContextVar('no_data', default=False)
+
+def mark_no_data():
+    """下載函數在 TIPS 表示沒有可下載的報表時調用，該任務記為 empty，不重試"""
+    _no_data.set(True)
+
+def retry_delay(attempt: int) -> float:
+    """第 attempt 次重試前的等待秒數：指數退避，並加入隨機抖動避免多間公司同時重試"""
+    delay = min(Config.RETRY['max_backoff'], Config.RETRY['backoff'] * 2 ** (attempt - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+def result_status(result: dict) -> str:
+    if result['success']:
+        return 'success'
+    return 'empty' if result.get('empty') else 'failed'
+
+def append_journal(company: str, company_results: list):
+    """把公司各任務的結果追加到運行記錄（JSONL）"""
+    now = datetime.now().isoformat(timespec='seconds')
+    try:
+        with open(Config.JOURNAL['file'], 'a', encoding='utf-8') as f:
+            for r in company_results:
+                f.write(json.dumps({
+                    'company': company,
+                    'task': r['task'],
+                    'date': r['date'],
+                    'status': result_status(r),
+                    'attempts': r.get('attempts', 1),
+                    'duration': round(r['duration'], 2),
+                    'time': now,
+                }, ensure_ascii=False) + '\n')
+    except Exception as e:
+        logging.warning(f"寫入運行記錄失敗: {str(e)}")
 
-                logging.info("所有下載任務已完成")
-            else:
-                logging.error("登錄失敗")
+class TaskJournal:
+    """每個任務完成（及其文件發佈完成）後即寫入運行記錄，程序中途中斷時已完成的任務不會丟失"""
+
+    def __init__(self, company: str):
+        self.company = company
+        self.pending = []
+
+    def add(self, result: dict):
+        self.pending.append(asyncio.ensure_future(self._record(result)))
+
+    async def _record(self, result: dict):
+        # 發佈失敗的任務不計為成功
+        await finish_publishes([result])
+        append_journal(self.company, [result])
+
+    async def wait(self):
+        """等待所有已完成任務的發佈及記錄寫入"""
+        await asyncio.gather(*self.pending)
+
+_task_journal = contextvars.ContextVar('task_journal', default=None)
+
+@contextlib.contextmanager
+def task_journal(company: str):
+    journal = TaskJournal(company)
+    token = _task_journal.set(journal)
+    try:
+        yield journal
+    finally:
+        _task_journal.reset(token)
+
+def journal_result(result: dict):
+    """登記任務的最終結果，在其發佈完成後寫入運行記錄"""
+    journal = _task_journal.get()
+    if journal is not None:
+        journal.add(result)
+
+def load_journal() -> dict:
+    """讀取運行記錄，返回 {(公司, 報表, 日期): 最新一條記錄}"""
+    journal = {}
+    try:
+        with open(Config.JOURNAL['file'], 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    journal[(entry['company'], entry['task'], entry['date'])] = entry
+                except (ValueError, KeyError):
+                    continue
+    except FileNotFoundError:
+        pass
+    return journal
+
+def pending_dates(journal: dict, companies: list, tasks: list) -> list:
+    """
+    運行記錄中仍有未完成任務的日期（由舊到新）
+
+    沒有記錄的 (公司, 報表) 亦視為未完成，例如登錄失敗或程序中斷時尚未處理的公司。
+    """
+    dates = {date for _, _, date in journal}
+    return sorted(date for date in dates
+                  if any(pending_tasks(journal, company, date, tasks) for company in companies))
+
+def pending_tasks(journal: dict, company: str, target_date: str, tasks: list) -> list:
+    """返回該公司該日期尚未完成的任務，連同它們在導航上依賴的前置任務"""
+    names = [task['name'] for task in tasks
+             if journal.get((company, task['name'], target_date), {}).get('status') not in JOURNAL_DONE]
+    return select_tasks(names) if names else []
+
+######## 運行記錄 _ END #########
+
+####### 運行歷史 Start #######
+_HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started TEXT NOT NULL,
+    mode TEXT NOT NULL,
+    concurrency INTEGER,
+    companies INTEGER,
+    duration REAL
+);
+CREATE TABLE IF NOT EXISTS task_runs (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    company TEXT NOT NULL,
+    task TEXT NOT NULL,
+    date TEXT,
+    status TEXT NOT NULL,
+    duration REAL,
+    size INTEGER,
+    attempts INTEGER
+);
+CREATE INDEX IF NOT EXISTS task_runs_by_task ON task_runs(task, run_id);
+"""
+
+def open_history() -> sqlite3.Connection:
+    connection = sqlite3.connect(Config.HISTORY['file'])
+    connection.executescript(_HISTORY_SCHEMA)
+    return connection
+
+def record_run_history(all_results: dict, mode: str, started: float, concurrency: int):
+    """把本次運行各公司、各報表的耗時、文件大小及結果寫入運行歷史"""
+    rows = []
+    for company, results in all_results.items():
+        for r in results:
+            size = None
+            if r['success'] and r.get('file'):
+                with contextlib.suppress(OSError):
+                    size = os.path.getsize(r['file'])
+            rows.append((company, r['task'], r['date'], result_status(r), round(r['duration'], 3), size,
+                         r.get('attempts', 1)))
+    try:
+        with contextlib.closing(open_history()) as connection, connection:
+            cursor = connection.execute(
+                "INSERT INTO runs (started, mode, concurrency, companies, duration) VALUES (?, ?, ?, ?, ?)",
+                (datetime.fromtimestamp(started).isoformat(timespec='seconds'), mode, concurrency,
+                 len(all_results), round(time.time() - started, 3)))
+            connection.executemany(
+                "INSERT INTO task_runs (run_id, company, task, date, status, duration, size, attempts) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", [(cursor.lastrowid, *row) for row in rows])
+        logging.info(f"已寫入運行歷史: {len(rows)} 個任務")
+    except sqlite3.Error as e:
+        logging.warning(f"寫入運行歷史失敗: {str(e)}")
+
+def _percentile(values: list, q: float) -> Optional[float]:
+    """最近秩 (nearest-rank) 百分位數"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+def _format_seconds(value: Optional[float]) -> str:
+    return f"{value:.1f}s" if value is not None else "-"
+
+def _format_size(value: Optional[float]) -> str:
+    return f"{value / 1024:.0f}KB" if value is not None else "-"
+
+def history_report(runs: Optional[int] = None) -> int:
+    """
+    輸出最近 runs 次運行的報表耗時趨勢，並標出最近一次運行的退化
+
+    以之前各次運行為基線：成功任務耗時的中位數超過基線中位數 slow_factor 倍，
+    或文件大小中位數偏離基線 size_factor 倍以上時標記。返回標記的報表數。
+    """
+    runs = runs or Config.HISTORY['window']
+    if not os.path.exists(Config.HISTORY['file']):
+        print(f"沒有運行歷史: {Config.HISTORY['file']}")
+        return 0
+    with contextlib.closing(open_history()) as connection:
+        recent = connection.execute(
+            "SELECT id, started, mode, concurrency, companies, duration FROM runs ORDER BY id DESC LIMIT ?",
+            (runs,)).fetchall()
+        if not recent:
+            print("運行歷史為空")
+            return 0
+        ids = [row[0] for row in recent]
+        placeholders = ",".join("?" * len(ids))
+        task_rows = connection.execute(
+            f"SELECT run_id, task, status, duration, size FROM task_runs WHERE run_id IN ({placeholders})",
+            ids).fetchall()
+
+    latest_id = ids[0]
+    print(f"最近 {len(recent)} 次運行 (最新: #{latest_id} {recent[0][1]} {recent[0][2]})")
+    print(f"{'報表':<40}{'次數':>6}{'失敗':>6}{'p50':>9}{'p95':>9}{'最新p50':>9}{'大小p50':>10}{'最新大小':>10}")
+
+    by_task = {}
+    for run_id, task, status, duration, size in task_rows:
+        by_task.setdefault(task, []).append((run_id, status, duration, size))
+
+    flagged = 0
+    for task, entries in by_task.items():
+        ok = [(run_id, duration, size) for run_id, status, duration, size in entries if status == 'success']
+        failures = sum(1 for _, status, _, _ in entries if status == 'failed')
+        durations = [duration for _, duration, _ in ok]
+        baseline = [duration for run_id, duration, _ in ok if run_id != latest_id]
+        latest = [duration for run_id, duration, _ in ok if run_id == latest_id]
+        baseline_sizes = [size for run_id, _, size in ok if run_id != latest_id and size]
+        latest_sizes = [size for run_id, _, size in ok if run_id == latest_id and size]
+
+        notes = []
+        base_p50, latest_p50 = _percentile(baseline, 0.5), _percentile(latest, 0.5)
+        if base_p50 and latest_p50 and latest_p50 > base_p50 * Config.HISTORY['slow_factor']:
+            notes.append(f"變慢 {latest_p50 / base_p50:.1f}x")
+        base_size, latest_size = _percentile(baseline_sizes, 0.5), _percentile(latest_sizes, 0.5)
+        if base_size and latest_size:
+            ratio = latest_size / base_size
+            if ratio > Config.HISTORY['size_factor'] or ratio < 1 / Config.HISTORY['size_factor']:
+                notes.append(f"大小變化 {ratio:.1f}x")
+        if any(run_id == latest_id and status == 'failed' for run_id, status, _, _ in entries):
+            notes.append("最新一次失敗")
+        flagged += 1 if notes else 0
+
+        print(f"{task:<40}{len(entries):>6}{failures:>6}{_format_seconds(_percentile(durations, 0.5)):>9}"
+              f"{_format_seconds(_percentile(durations, 0.95)):>9}{_format_seconds(latest_p50):>9}"
+              f"{_format_size(base_size):>10}{_format_size(latest_size):>10}"
+              + (f"  <- {'，'.join(notes)}" if notes else ""))
+
+    # 按並發數統計整次運行耗時，作為調整並發的依據
+    print("\n按並發數的運行耗時:")
+    by_concurrency = {}
+    for _, _, mode, concurrency, companies, duration in recent:
+        if duration is not None and not mode.startswith('backfill'):
+            by_concurrency.setdefault(concurrency, []).append((duration, companies))
+    for concurrency, entries in sorted(by_concurrency.items(), key=lambda item: item[0] or 0):
+        durations = [duration for duration, _ in entries]
+        per_company = [duration / companies for duration, companies in entries if companies]
+        print(f"  並發 {concurrency}: {len(entries)} 次，p50 {_format_seconds(_percentile(durations, 0.5))}，"
+              f"p95 {_format_seconds(_percentile(durations, 0.95))}，"
+              f"每間公司 {_format_seconds(_percentile(per_company, 0.5))}")
+
+    if flagged:
+        print(f"\n{flagged} 個報表在最近一次運行出現退化")
+    return flagged
+
+######## 運行歷史 _ END #########
+
+async def process_company(browser, company: str, base_download_path: str, target_dates: list,
+                          tasks: Optional[list] = None, partition_by_date: bool = False,
+                          journal: Optional[dict] = None, pool=None) -> list:
+    """
+    在獨立的瀏覽器 context 中登錄並下載單一公司的報表
+
+    多個日期共用同一次登錄，逐日執行任務。
+
+    Args:
+        browser: 已啟動的瀏覽器
+        company: 公司代碼
+        base_download_path: 下載根目錄
+        target_dates: 報表日期列表 (YYYYMMDD)
+        tasks: 要執行的報表任務，預設為 REPORT_TASKS 全部
+        partition_by_date: 為 True 時每個日期下載到 公司/日期 子資料夾
+        journal: 續跑模式下的運行記錄，只執行其中未完成的任務
+        pool: 常駐模式的 SessionPool；提供時重用其中已登錄的會話，完成後不關閉 context
+
+    Returns:
+        list: 各任務的執行結果
+    """
+    plan = []
+    for target_date in target_dates:
+        date_tasks = tasks or REPORT_TASKS
+        if journal is not None:
+            date_tasks = pending_tasks(journal, company, target_date, date_tasks)
+        if date_tasks:
+            plan.append((target_date, date_tasks))
+    if not plan:
+        logging.info(f"公司 {company} 沒有未完成的任務，跳過")
+        return []
+
+    logging.info(f"\n開始處理公司: {company}")
+    company_start_time = time.time()
+    company_results = []
+
+    company_download_path = create_company_folder(base_download_path, company)
+
+    if pool:
+        context, logged_in_page = await pool.acquire(company)
+    else:
+        context, logged_in_page = await open_company_session(browser, company)
+    with task_journal(company) as journal:
+        if logged_in_page:
+            logging.info("登錄成功，開始執行下載任務")
+            for index, (target_date, date_tasks) in enumerate(plan):
+                if index:
+                    await pace(1.5)
+                download_path = company_download_path
+                if partition_by_date:
+                    logging.info(f"公司 {company} 開始下載 {target_date} 的報表")
+                    download_path = create_company_folder(company_download_path, target_date)
+                company_results.extend(await run_report_tasks(context, logged_in_page, download_path,
+                                                              target_date, date_tasks))
+            logging.info("所有下載任務已完成")
         else:
-            logging.error("無法打開彈出窗口")
+            logging.error("登錄失敗")
+
+        # 等待後台發佈到網絡共享完成並寫入運行記錄，發佈失敗的任務不計為成功
+        await journal.wait()
+    successful_tasks = sum(1 for r in company_results if r['success'])
+
+    if pool:
+        await pool.release(company, context, logged_in_page)
+        logging.info(f"公司 {company} 的會話已保留供下次任務使用")
+    else:
+        await context.close()
+        logging.info(f"公司 {company} 的瀏覽器 context 已關閉")
+    company_end_time = time.time()
+    company_total_time = company_end_time - company_start_time
+
+    logging.info(f"\n公司 {company} 處理摘要:")
+    logging.info(f"總執行時間: {company_total_time:.2f} 秒")
+    logging.info(f"成功執行任務數: {successful_tasks}/{len(company_results)}")
+    for r in company_results:
+        label = f"{r['date']} {r['task']}" if partition_by_date else r['task']
+        logging.info(f"  {label}: 耗時 {r['duration']:.2f} 秒，就緒等待節省 {r['saved']:.2f} 秒")
+    logging.info(f"就緒等待節省時間: {sum(r['saved'] for r in company_results):.2f} 秒")
+    if logged_in_page:
+        logging.info(f"返回主頁次數: {navigation_state(logged_in_page).home_reloads}")
+    return company_results
+
+def apply_browser_profile(name: Optional[str] = None) -> dict:
+    """選擇瀏覽器配置，並以配置中的超時覆蓋 Config.TIMEOUTS"""
+    if name:
+        Config.BROWSER_PROFILE = name
+    if Config.BROWSER_PROFILE not in Config.BROWSER_PROFILES:
+        raise ValueError(f"未知的瀏覽器配置: {Config.BROWSER_PROFILE}")
+    profile = Config.BROWSER_PROFILES[Config.BROWSER_PROFILE]
+    Config.TIMEOUTS.update(profile['timeouts'])
+    logging.info(f"使用瀏覽器配置: {Config.BROWSER_PROFILE}")
+    return profile
+
+async def launch_browser(playwright):
+    profile = Config.BROWSER_PROFILES[Config.BROWSER_PROFILE]
+    return await playwright.chromium.launch(**profile['launch'])
+
+# block_resources 中各資源類型對應的 URL 模式（Network.setBlockedURLs 只能按 URL 阻擋）
+BLOCKED_URL_PATTERNS = {
+    'image': ['*.png', '*.jpg', '*.jpeg', '*.gif', '*.bmp', '*.ico', '*.webp', '*.svg'],
+    'font': ['*.woff', '*.woff2', '*.ttf', '*.otf', '*.eot'],
+    'media': ['*.mp3', '*.mp4', '*.wav', '*.avi', '*.webm', '*.ogg'],
+}
+
+_page_blocking = weakref.WeakKeyDictionary()
+
+async def _set_blocked_urls(page: Page, patterns: list):
+    try:
+        session = await page.context.new_cdp_session(page)
+        await session.send('Network.enable')
+        await session.send('Network.setBlockedURLs', {'urls': patterns})
+    except Exception as e:
+        logging.debug(f"無法設定資源攔截: {str(e)}")
 
-        browser.close()
-        logging.info("瀏覽器已關閉，程序執行完畢")
-        company_end_time = time.time()
-        company_total_time = company_end_time - company_start_time
-        
-        logging.info(f"\n公司 {company} 處理摘要:")
-        logging.info(f"總執行時間: {company_total_time:.2f} 秒")
-        logging.info(f"成功執行任務數: {successful_tasks}/{total_tasks}")
-        all_results[company] = company_results
+async def block_page_resources(page: Page):
+    """
+    按當前瀏覽器配置經 CDP 阻擋頁面（及其 iframe）的圖片、字體和媒體 URL
+
+    不使用 route，瀏覽器的 HTTP 緩存保持有效。每個頁面只設定一次；
+    context 的 "page" 事件與打開頁面的代碼同時調用時，兩者等待同一次設定完成。
+    """
+    profile = Config.BROWSER_PROFILES[Config.BROWSER_PROFILE]
+    patterns = [pattern for resource in profile['block_resources'] for pattern in BLOCKED_URL_PATTERNS[resource]]
+    if not patterns:
+        return
+    setup = _page_blocking.get(page)
+    if setup is None:
+        setup = _page_blocking[page] = asyncio.ensure_future(_set_blocked_urls(page, patterns))
+    await setup
+
+async def new_page(context) -> Page:
+    """打開新頁面，資源攔截設定完成後才返回，首次導航不會載入被攔截的資源"""
+    page = await context.new_page()
+    await block_page_resources(page)
+    return page
+
+async def new_browser_context(browser, **kwargs):
+    """按當前瀏覽器配置創建 context：設定視窗大小、默認超時並攔截不需要的資源"""
+    profile = Config.BROWSER_PROFILES[Config.BROWSER_PROFILE]
+    if profile['viewport']:
+        kwargs.setdefault('viewport', profile['viewport'])
+    context = await browser.new_context(accept_downloads=True, **kwargs)
+    if 'element' in profile['timeouts']:
+        context.set_default_timeout(Config.TIMEOUTS['element'])
+        context.set_default_navigation_timeout(30000)
+    context.on("page", close_download_message)
+    # 由網站打開的其他窗口（例如下載消息窗口）在 "page" 事件中設定
+    if profile['block_resources']:
+        context.on("page", block_page_resources)
+    return context
+
+async def scrape_companies(browser, companies: list, base_download_path: str, target_dates: list, max_concurrency: int,
+                           tasks: Optional[list] = None, partition_by_date: bool = False,
+                           journal: Optional[dict] = None, pool=None) -> dict:
+    """
+    在同一個瀏覽器中以有上限的並發數同時處理多間公司
+
+    每間公司使用獨立的 new_context()，由 CompanyPool 控制同時在線的會話數（從 max_concurrency 開始，
+    TIPS 應付得來時自適應增加）；所有會話在同一個事件循環中推進，某一間公司等待下載時不會阻塞其他公司。
+    """
+    if _company_pool is None:
+        reset_limiters(max_concurrency)
+    slots = company_pool()
+
+    async def scrape_one(company: str) -> list:
+        async with slots:
+            try:
+                with span_labels(company=company):
+                    return await process_company(browser, company, base_download_path, target_dates, tasks,
+                                                 partition_by_date, journal, pool)
+            except Exception as e:
+                logging.error(f"處理公司 {company} 時發生錯誤: {str(e)}")
+                return []
+
+    results = await asyncio.gather(*(scrape_one(company) for company in companies))
+    log_limiter_summary()
+    # 按公司列表原有順序返回，使摘要輸出與串行模式一致
+    return dict(zip(companies, results))
+
+async def run_async(companies: Optional[list] = None, target_dates: Optional[list] = None,
+                    max_concurrency: Optional[int] = None, tasks: Optional[list] = None,
+                    profile: Optional[str] = None, partition_by_date: bool = False,
+                    journal: Optional[dict] = None, pipeline: Optional[ConversionPipeline] = None) -> dict:
+    """
+    異步下載引擎：啟動一個瀏覽器並並發處理所有公司，返回每間公司的任務結果
+
+    提供 pipeline 時，文件在下載過程中即排隊轉換，返回前等待轉換完成。
+    """
+    apply_browser_profile(profile)
+    if companies is None:
+        companies = Config.COMPANIES
+    if target_dates is None:
+        target_dates = [(datetime.today() - timedelta(days=1)).strftime('%Y%m%d')]
+    if max_concurrency is None:
+        max_concurrency = Config.MAX_CONCURRENT_COMPANIES
+
+    reset_limiters(max_concurrency)
+    logging.info(f"同時處理 {max_concurrency} 間公司（自適應上限 {company_pool().cap} 間）")
+    if pipeline:
+        await pipeline.start()
+    try:
+        async with async_playwright() as playwright:
+            browser = await launch_browser(playwright)
+            try:
+                return await scrape_companies(browser, companies, Config.BASE_DOWNLOAD_PATH, target_dates,
+                                              max_concurrency, tasks, partition_by_date, journal)
+            finally:
+                await browser.close()
+                logging.info("瀏覽器已關閉，程序執行完畢")
+    finally:
+        if pipeline:
+            await pipeline.close()
 
-    # 輸出總體摘要
+def log_run_summary(all_results: dict):
+    """輸出總體摘要"""
     logging.info("\n========= 總體執行結果摘要 =========")
     for company, results in all_results.items():
         if results:
@@ -1189,51 +3140,319 @@ def run(playwright):
             logging.info(f"總執行時間: {round(total_time, 2)} 秒")
             logging.info(f"成功數量: {total_success}/{len(results)}")
 
-    if not register_excel_com():
+def run(max_concurrency: Optional[int] = None, force_convert: bool = False, profile: Optional[str] = None,
+        backfill: Optional[tuple] = None, resume: bool = False, trace: Optional[str] = None):
+    #if datetime.today().weekday() == 0:  # 0 代表星期一
+    #    logging.info("今天是星期一，程式不執行")
+    #    return
+
+    reset_spans()
+    run_start = time.time()
+
+    # 續跑模式：只重跑運行記錄中未成功的 (公司, 報表, 日期)
+    journal = load_journal() if resume else None
+    if resume:
+        logging.info(f"續跑模式：運行記錄共 {len(journal)} 條")
+
+    if backfill:
+        # 補數模式：每間公司登錄一次，逐日下載按日期出數的報表到 公司/日期 子資料夾
+        target_dates = backfill_dates(*backfill)
+        logging.info(f"補數模式: {target_dates[0]} 到 {target_dates[-1]}，共 {len(target_dates)} 天")
+        all_results = asyncio.run(run_async(target_dates=target_dates, max_concurrency=max_concurrency,
+                                            tasks=backfill_tasks(), profile=profile, partition_by_date=True,
+                                            journal=journal))
+    else:
+        target_date = (datetime.today() - timedelta(days=1)).strftime('%Y%m%d')
+        all_results = {}
+        run_latest = True
+        if resume:
+            # 昨天照常下載並轉換所有公司未完成或沒有記錄的任務；運行記錄中較早且仍未完成的日期
+            # 按補數方式下載到 公司/日期 子資料夾，避免覆蓋較新的報表
+            run_latest = any(pending_tasks(journal, company, target_date, REPORT_TASKS)
+                             for company in Config.COMPANIES)
+            earlier = [date for date in pending_dates(journal, Config.COMPANIES, backfill_tasks())
+                       if date < target_date]
+            if not run_latest and not earlier:
+                logging.info("運行記錄中沒有未完成的任務")
+            if earlier:
+                logging.info(f"續跑較早日期的報表: {', '.join(earlier)}（不執行文件轉換）")
+                all_results = asyncio.run(run_async(target_dates=earlier, max_concurrency=max_concurrency,
+                                                    tasks=backfill_tasks(), profile=profile,
+                                                    partition_by_date=True, journal=journal))
+        # 根據任務註冊表生成文件映射
+        companies = [company for company in Config.COMPANIES if company not in Config.CONVERT_EXCLUDE]
+        file_mappings = build_file_mappings(companies, target_date)
+        pipeline = None
+        if run_latest and Config.PIPELINE['enabled'] and Config.CONVERSION['backend'] == 'python':
+            pipeline = ConversionPipeline(file_mappings, force=force_convert)
+        if run_latest:
+            latest_results = asyncio.run(run_async(target_dates=[target_date], max_concurrency=max_concurrency,
+                                                   profile=profile, journal=journal, pipeline=pipeline))
+            for company, results in latest_results.items():
+                all_results[company] = all_results.get(company, []) + results
+
+    log_run_summary(all_results)
+    record_run_history(all_results, 'backfill' if backfill else 'resume' if resume else 'daily', run_start,
+                       max_concurrency or Config.MAX_CONCURRENT_COMPANIES)
+
+    if backfill:
+        # ({company})資料庫更新 只保存最新一天的數據，補數下載不覆蓋
+        logging.info("補數模式不執行文件轉換")
+    else:
+        if Config.CONVERSION['backend'] == 'excel' and not register_excel_com():
+            print("無法註冊Excel COM組件，程序將退出")
+            sys.exit(1)
+
+        if pipeline:
+            # 流水線已轉換本次下載的文件，其餘（例如下載失敗的報表）按轉換記錄檢查
+            pipeline.log_summary()
+            file_mappings = pipeline.remaining()
+        with span('convert', 'excel_save_multiple_files'):
+            excel_save_multiple_files(file_mappings, force=force_convert)
+
+    log_trace_summary()
+    trace = trace or Config.TRACE['file']
+    if trace:
+        export_trace(trace)
+
+####### 常駐模式 Start #######
+class SessionPool:
+    """常駐模式下保留每間公司已登錄的 context 及頁面，供之後的任務直接重用"""
+
+    def __init__(self, browser):
+        self.browser = browser
+        self.sessions = {}
+
+    async def acquire(self, company: str):
+        """取出公司的會話；仍然有效時直接返回，否則重新打開（必要時登錄）"""
+        session = self.sessions.pop(company, None)
+        if session:
+            context, page = session
+            if not page.is_closed() and await probe_session(page):
+                state = navigation_state(page)
+                state.reset()
+                state.home_reloads = 0
+                return context, page
+            logging.info(f"公司 {company} 的常駐會話已失效，重新登錄")
+            with contextlib.suppress(Exception):
+                await context.close()
+        return await open_company_session(self.browser, company)
+
+    async def release(self, company: str, context, page):
+        if page is None:
+            await context.close()
+            return
+        self.sessions[company] = (context, page)
+
+    async def warm(self, companies: list, max_concurrency: int):
+        """預先為各公司登錄"""
+        semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+        async def warm_one(company: str):
+            async with semaphore:
+                try:
+                    context, page = await self.acquire(company)
+                    await self.release(company, context, page)
+                except Exception as e:
+                    logging.error(f"預先登錄公司 {company} 失敗: {str(e)}")
+
+        await asyncio.gather(*(warm_one(company) for company in companies))
+        logging.info(f"已預先登錄 {len(self.sessions)}/{len(companies)} 間公司")
+
+    async def close(self):
+        for context, _ in self.sessions.values():
+            with contextlib.suppress(Exception):
+                await context.close()
+        self.sessions.clear()
+
+class DaemonStatus:
+    """常駐模式的狀態，由狀態服務線程讀取"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {
+            'started': datetime.now().isoformat(timespec='seconds'),
+            'state': 'starting',
+            'current_job': None,
+            'warm_sessions': [],
+            'jobs': {},
+        }
+
+    def update(self, **values):
+        with self.lock:
+            self.data.update(values)
+
+    def update_job(self, name: str, **values):
+        with self.lock:
+            self.data['jobs'].setdefault(name, {}).update(values)
+
+    def snapshot(self) -> str:
+        with self.lock:
+            return json.dumps(self.data, ensure_ascii=False, indent=2)
+
+def start_status_server(status: DaemonStatus, port: int):
+    """在後台線程提供本地狀態查詢：GET http://127.0.0.1:{port}/status"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class StatusHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.rstrip('/') not in ('', '/status'):
+                self.send_response(404)
+                self.end_headers()
+                return
+            body = status.snapshot().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), StatusHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logging.info(f"狀態服務: http://127.0.0.1:{port}/status")
+    return server
+
+async def run_daemon_job(name: str, pool: SessionPool, status: DaemonStatus, max_concurrency: int):
+    """執行一次排程任務：使用常駐會話下載，並把本次的報表轉換到 ({company})資料庫更新"""
+    job = Config.DAEMON['jobs'][name]
+    tasks = select_tasks(job['tasks']) if job['tasks'] else REPORT_TASKS
+    target_date = (datetime.today() - timedelta(days=1)).strftime('%Y%m%d')
+    companies = [company for company in Config.COMPANIES if company not in Config.CONVERT_EXCLUDE]
+    file_mappings = build_file_mappings(companies, target_date, tasks)
+
+    logging.info(f"\n========= 開始排程任務 {name} ({target_date}) =========")
+    status.update(state='running', current_job=name)
+    status.update_job(name, last_start=datetime.now().isoformat(timespec='seconds'))
+    reset_spans()
+    start_time = time.time()
+    pipeline = None
+    if Config.PIPELINE['enabled'] and Config.CONVERSION['backend'] == 'python':
+        pipeline = ConversionPipeline(file_mappings)
+        await pipeline.start()
+    try:
+        all_results = await scrape_companies(pool.browser, Config.COMPANIES, Config.BASE_DOWNLOAD_PATH,
+                                             [target_date], max_concurrency, tasks, pool=pool)
+    finally:
+        if pipeline:
+            await pipeline.close()
+
+    log_run_summary(all_results)
+    record_run_history(all_results, f"daemon:{name}", start_time, max_concurrency)
+    if pipeline:
+        pipeline.log_summary()
+        file_mappings = pipeline.remaining()
+    with span('convert', 'excel_save_multiple_files'):
+        await asyncio.to_thread(excel_save_multiple_files, file_mappings)
+    log_trace_summary()
+
+    results = [r for company_results in all_results.values() for r in company_results]
+    status.update_job(name, last_end=datetime.now().isoformat(timespec='seconds'),
+                      last_duration=round(time.time() - start_time, 2),
+                      last_success=f"{sum(1 for r in results if r['success'])}/{len(results)}")
+    status.update(state='idle', current_job=None, warm_sessions=sorted(pool.sessions))
+
+async def run_daemon(profile: Optional[str] = None, run_now: bool = False, max_concurrency: Optional[int] = None):
+    """
+    常駐模式：保持瀏覽器及各公司已登錄的 context，按 Config.DAEMON 排程觸發任務
+
+    同一時間只執行一個任務；任務仍在隊列中時重複觸發會被忽略。
+    """
+    apply_browser_profile(profile)
+    if max_concurrency is None:
+        max_concurrency = Config.MAX_CONCURRENT_COMPANIES
+    if Config.CONVERSION['backend'] == 'excel' and not register_excel_com():
         print("無法註冊Excel COM組件，程序將退出")
         sys.exit(1)
-    
-    companies = ["BV", "BD", "TS", "TD", "MM", "FR", "WH", "ED", "EF", "ES", "EB"]
-    
-    # 生成文件映射
-    file_mappings = []
-    for company in companies:
-        base_input = Path(f'//files01-wtc.kmml.local/ON-Warehouse/各場庫存及容量/python_data/download_data/{company}')
-        base_output = Path(f'//files01-wtc.kmml.local/ON-Warehouse/各場庫存及容量/({company})資料庫更新')
-        
-        mappings = [
-            {
-                'input': str(base_input / 'Inventory.xls'),
-                'output': str(base_output / f'({company})Inventory.xls')
-            },
-            {
-                'input': str(base_input / 'TV.xls'),
-                'output': str(base_output / f'({company})TV info maintenance.xls')
-            },
-            {
-                'input': str(base_input / 'Daily_Product_Audit.xls'),
-                'output': str(base_output / f'({company})每日銷售數.xls')
-            },
-            {
-                'input': str(base_input / 'Month_Uncollect.xls'),
-                'output': str(base_output / f'({company}) EDC客未取數(12個月).xls')
-            },
-            {
-                'input': str(base_input / 'Uncollected.xls'),
-                'output': str(base_output / '客未取貨.xls')
-            },
-            {
-                'input': str(base_input / 'Collections.xls'),
-                'output': str(base_output / 'Collection Detail.xls')
-            },
-            {
-                'input': str(base_input / 'Exchange_Invoice.xls'),
-                'output': str(base_output / '換貨紀錄.xls')
-            }
-        ]
-        file_mappings.extend(mappings)
-    
-    excel_save_multiple_files(file_mappings)
+    # 並發上限在各次排程任務之間保留
+    reset_limiters(max_concurrency)
+
+    status = DaemonStatus()
+    status_server = start_status_server(status, Config.DAEMON['status_port'])
+    queue = asyncio.Queue()
+    queued = set()
+
+    def trigger(name: str):
+        if name in queued:
+            logging.info(f"排程任務 {name} 已在隊列中，忽略本次觸發")
+            return
+        queued.add(name)
+        queue.put_nowait(name)
+
+    scheduler = schedule.Scheduler()
+    for name, job in Config.DAEMON['jobs'].items():
+        if job.get('at'):
+            scheduler.every().day.at(job['at']).do(trigger, name)
+        elif job.get('every_minutes'):
+            scheduler.every(job['every_minutes']).minutes.do(trigger, name)
+        else:
+            continue
+        logging.info(f"已排程任務 {name}: {job}")
+    if run_now:
+        trigger('nightly')
+
+    async def worker(pool: SessionPool):
+        while True:
+            name = await queue.get()
+            queued.discard(name)
+            try:
+                await run_daemon_job(name, pool, status, max_concurrency)
+            except Exception as e:
+                logging.error(f"排程任務 {name} 執行失敗: {str(e)}")
+                status.update(state='idle', current_job=None)
+                status.update_job(name, last_error=str(e))
+
+    async with async_playwright() as playwright:
+        browser = await launch_browser(playwright)
+        pool = SessionPool(browser)
+        worker_task = None
+        try:
+            await pool.warm(Config.COMPANIES, max_concurrency)
+            status.update(state='idle', warm_sessions=sorted(pool.sessions))
+            worker_task = asyncio.ensure_future(worker(pool))
+            while True:
+                scheduler.run_pending()
+                for job in scheduler.jobs:
+                    status.update_job(job.job_func.args[0], next_run=job.next_run.isoformat(timespec='seconds'))
+                await asyncio.sleep(1)
+        finally:
+            if worker_task:
+                worker_task.cancel()
+            await pool.close()
+            await browser.close()
+            status_server.shutdown()
+            logging.info("常駐模式已停止")
+
+######## 常駐模式 _ END #########
+
+def parse_args(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="TIPS 報表下載")
+    parser.add_argument("--force-convert", action="store_true", help="忽略轉換記錄，全部重新轉換")
+    parser.add_argument("--backfill", nargs=2, metavar=("START", "END"),
+                        help="補數模式，下載 START 到 END（含，YYYYMMDD）每天的報表")
+    parser.add_argument("--resume", action="store_true", help="只重跑運行記錄中未成功的報表")
+    parser.add_argument("--trace", metavar="FILE", help="導出耗時追蹤（.json 為 Chrome trace，其他為 OpenMetrics）")
+    parser.add_argument("--history-report", nargs="?", type=int, const=0, metavar="RUNS",
+                        help="輸出最近 RUNS 次運行的報表耗時趨勢及退化（預設 Config.HISTORY['window']）")
+    parser.add_argument("--daemon", action="store_true", help="常駐模式，按 Config.DAEMON 排程執行")
+    parser.add_argument("--run-now", action="store_true", help="常駐模式啟動後立即執行一次 nightly 任務")
+    parser.add_argument("--profile", choices=sorted(Config.BROWSER_PROFILES), help="瀏覽器配置")
+    return parser.parse_args(argv)
+
 if __name__ == "__main__":
-    with sync_playwright() as playwright:
-        run(playwright)
\ No newline at end of file
+    args = parse_args()
+    if args.history_report is not None:
+        history_report(args.history_report)
+    elif args.daemon:
+        try:
+            asyncio.run(run_daemon(profile=args.profile, run_now=args.run_now))
+        except KeyboardInterrupt:
+            pass
+    else:
+        run(force_convert=args.force_convert, profile=args.profile, backfill=args.backfill, resume=args.resume,
+            trace=args.trace)